@@ -0,0 +1,128 @@
+"""
+Benchmark de los extractores de título y precio.
+
+Recorre un corpus de páginas de producto guardadas (*.html en un directorio) con
+cada extractor de extractors.EXTRACTORS y con la cadena completa, y muestra
+páginas/segundo, pico de memoria y cuántas páginas coinciden con el resultado de
+BeautifulSoup. Cada extractor se mide en un proceso propio: el pico de RSS incluye
+la memoria de libxml2, que tracemalloc no ve.
+
+Sin --corpus se generan páginas sintéticas (~1,5 MB) con las distintas plantillas
+de precio de Amazon.
+
+Uso:
+    python bench_extractors.py --corpus paginas_guardadas/ --repeat 3
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from extractors import EXTRACTORS, SoupExtractor, extract_product
+
+PRICE_LAYOUTS = [
+    # Plantilla actual: precio principal en corePrice con a-offscreen
+    '<div id="corePrice_feature_div"><span class="a-price"><span class="a-offscreen">{price} €</span>'
+    '<span aria-hidden="true"><span class="a-price-whole">{whole},</span><span class="a-price-fraction">{fraction}</span>'
+    '<span class="a-price-symbol">€</span></span></span></div>',
+    # Plantilla antigua
+    '<span id="priceblock_ourprice" class="a-size-medium a-color-price">{price} €</span>',
+    '<span id="priceblock_dealprice" class="a-size-medium a-color-price">{price} €</span>',
+    # Solo parte entera y decimal
+    '<span class="a-price-symbol">€</span><span class="a-price-whole">{whole},</span><span class="a-price-fraction">{fraction}</span>',
+    # Sin precio (producto no disponible)
+    '<div id="availability"><span>No disponible.</span></div>',
+]
+
+
+def generate_corpus(directory, pages, size):
+    """Genera páginas de producto sintéticas con relleno hasta el tamaño indicado."""
+    rng = random.Random(42)
+    filler_block = "".join(
+        f'<div class="a-section a-spacing-small"><span class="a-size-base">Característica {i}</span>'
+        f'<ul class="a-unordered-list"><li><span class="a-list-item">Texto descriptivo {i}</span></li></ul></div>\n'
+        for i in range(200)
+    )
+    for i in range(pages):
+        whole, fraction = rng.randint(5, 2500), rng.randint(0, 99)
+        price = f"{whole:,}".replace(",", ".") + f",{fraction:02d}"
+        layout = PRICE_LAYOUTS[i % len(PRICE_LAYOUTS)].format(price=price, whole=f"{whole:,}".replace(",", "."), fraction=f"{fraction:02d}")
+        head = f'<html><head><title>Producto {i}</title><script>var data = "{"x" * 20000}";</script></head><body>'
+        title = f'<div id="titleSection"><h1><span id="productTitle" class="a-size-large"> Producto de prueba {i} </span></h1></div>'
+        body = [head, filler_block, title, layout]
+        while sum(map(len, body)) < size:
+            body.append(filler_block)
+        body.append("</body></html>")
+        with open(os.path.join(directory, f"page_{i:04d}.html"), "w", encoding="utf-8") as f:
+            f.write("".join(body))
+
+
+def load_corpus(directory):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path, "rb") as f:
+            pages.append(f.read())
+    return pages
+
+
+def measure(name, pages, repeat, queue):
+    if name == "cadena":
+        extract = extract_product
+    else:
+        extractor = next(extractor for extractor in EXTRACTORS if extractor.name == name)
+        extract = extractor.extract
+
+    reference = [SoupExtractor().extract(html) for html in pages] if name != "beautifulsoup" else None
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    for _ in range(repeat):
+        results = [extract(html) for html in pages]
+    elapsed = time.perf_counter() - started
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+    # Pasada aparte para la memoria de Python: tracemalloc ralentiza mucho la extracción
+    tracemalloc.start()
+    for html in pages:
+        extract(html)
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    matches = len(pages) if reference is None else sum(a == b for a, b in zip(results, reference))
+    queue.put((name, len(pages) * repeat / elapsed, python_peak / 2 ** 20, rss_peak / 1024, matches))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="Directorio con páginas de producto guardadas (*.html)")
+    parser.add_argument("--pages", type=int, default=50, help="Páginas sintéticas a generar si no hay corpus")
+    parser.add_argument("--size", type=int, default=1_500_000, help="Tamaño aproximado de cada página sintética")
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if not args.corpus:
+            generate_corpus(directory, args.pages, args.size)
+        pages = load_corpus(args.corpus or directory)
+    if not pages:
+        parser.error("El corpus no contiene ficheros .html")
+    total_mb = sum(map(len, pages)) / 2 ** 20
+    print(f"Corpus: {len(pages)} páginas, {total_mb:.1f} MB, {args.repeat} pasadas")
+
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    print(f"  {'extractor':<14} {'páginas/s':>10} {'pico Python':>12} {'pico RSS':>10}  coincidencias")
+    for name in [extractor.name for extractor in EXTRACTORS] + ["cadena"]:
+        process = context.Process(target=measure, args=(name, pages, args.repeat, queue))
+        process.start()
+        name, rate, python_peak, rss_peak, matches = queue.get()
+        process.join()
+        print(f"  {name:<14} {rate:>10.1f} {python_peak:>9.1f} MB {rss_peak:>7.1f} MB  {matches}/{len(pages)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# bulk.py
+"""
+Importación y exportación en bloque de los productos de un usuario.
+
+Uso:
+    python bulk.py import --chat-id 123456 productos.csv
+    python bulk.py export --chat-id 123456 [--output historial.csv]
+
+La importación acepta CSV (columna "url" o la primera columna), JSONL (clave "url")
+o texto con una URL por línea.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import re
+import sys
+
+from logger import config_logger
+from utils import get_product_key, simplify_amazon_url
+
+logger = config_logger()
+
+# Límites de una importación desde el bot: URLs por mensaje y tamaño del documento
+IMPORT_MAX_URLS = int(os.getenv("IMPORT_MAX_URLS", 1000))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", 1024 * 1024))
+
+EXPORT_COLUMNS = ("url", "name", "valid_from", "last_seen_at", "amount", "currency", "status")
+
+URL_REGEX = re.compile(r"https?://\S+")
+
+
+def _lines_urls(text: str) -> list:
+    urls = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        match = URL_REGEX.search(line)
+        urls.append(match.group(0).rstrip(",;\"'") if match else line)
+    return urls
+
+
+def _csv_urls(text: str) -> list:
+    rows = list(csv.reader(io.StringIO(text)))
+    if not rows:
+        return []
+    header = [column.strip().lower() for column in rows[0]]
+    if "url" in header:
+        column = header.index("url")
+        rows = rows[1:]
+    else:
+        column = 0
+    return [row[column].strip() for row in rows if len(row) > column and row[column].strip()]
+
+
+def _jsonl_urls(text: str) -> list:
+    urls = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            urls.append(line)
+            continue
+        urls.append(record.get("url", "") if isinstance(record, dict) else str(record))
+    return urls
+
+
+def parse_import(text: str, filename: str = "") -> tuple:
+    """
+    Extrae, valida y normaliza las URLs de una importación.
+
+    Args:
+        text (str): Contenido del fichero o del mensaje.
+        filename (str): Nombre del fichero, para distinguir CSV y JSONL del texto plano.
+
+    Returns:
+        tuple: (URLs canónicas sin duplicados, entradas no válidas).
+    """
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension == ".csv":
+        entries = _csv_urls(text)
+    elif extension in (".jsonl", ".ndjson"):
+        entries = _jsonl_urls(text)
+    else:
+        entries = _lines_urls(text)
+
+    urls, invalid = {}, []
+    for entry in entries:
+        if get_product_key(entry):
+            urls.setdefault(simplify_amazon_url(entry), None)
+        else:
+            invalid.append(entry)
+    return list(urls), invalid
+
+
+def import_products(chat_id: int, urls: list):
+    """
+    Añade en bloque las URLs a los productos de un usuario (ver add_products_bulk).
+
+    Args:
+        chat_id (int): ID del chat de Telegram.
+        urls (list): URLs canónicas, como las devuelve parse_import.
+
+    Returns:
+        int: Productos añadidos, o None si falla la base de datos.
+    """
+    # Import diferido: el análisis de las URLs no necesita DATABASE_URL
+    from database import add_products_bulk
+
+    return add_products_bulk(chat_id, urls)
+
+
+def write_export(chat_id: int, out) -> int:
+    """
+    Escribe en CSV los productos de un usuario con todo su historial de precios, fila
+    a fila a medida que llegan de la base de datos.
+
+    Args:
+        chat_id (int): ID del chat de Telegram.
+        out: Fichero de texto abierto con newline="".
+
+    Returns:
+        int: Filas escritas, o None si falla la base de datos.
+    """
+    from database import export_price_history
+
+    writer = csv.writer(out)
+    writer.writerow(EXPORT_COLUMNS)
+    return export_price_history(chat_id, lambda row: writer.writerow(
+        [row["url"], row["name"] or "",
+         row["valid_from"].isoformat() if row["valid_from"] else "",
+         row["last_seen_at"].isoformat() if row["last_seen_at"] else "",
+         row["amount"] if row["amount"] is not None else "", row["currency"] or "", row["status"] or ""]
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importación y exportación en bloque de productos")
+    commands = parser.add_subparsers(dest="command", required=True)
+    importer = commands.add_parser("import", help="Añadir a un usuario las URLs de un fichero CSV, JSONL o de texto")
+    importer.add_argument("--chat-id", type=int, required=True, help="Chat de Telegram del usuario")
+    importer.add_argument("path", help="Fichero con las URLs")
+    exporter = commands.add_parser("export", help="Exportar en CSV los productos y el historial de un usuario")
+    exporter.add_argument("--chat-id", type=int, required=True, help="Chat de Telegram del usuario")
+    exporter.add_argument("--output", help="Fichero de salida (por defecto, la salida estándar)")
+    args = parser.parse_args()
+
+    from database import init_db
+    init_db()
+    if args.command == "import":
+        with open(args.path, encoding="utf-8-sig") as file:
+            urls, invalid = parse_import(file.read(), args.path)
+        for entry in invalid:
+            logger.warning(f"Entrada no válida: {entry}")
+        added = import_products(args.chat_id, urls)
+        if added is None:
+            sys.exit("No se pudo completar la importación")
+        logger.info(f"{added} productos añadidos, {len(urls) - added} ya en seguimiento, {len(invalid)} no válidos")
+    elif args.command == "export":
+        if args.output:
+            with open(args.output, "w", encoding="utf-8", newline="") as out:
+                rows = write_export(args.chat_id, out)
+        else:
+            rows = write_export(args.chat_id, sys.stdout)
+        if rows is None:
+            sys.exit("No se pudo completar la exportación")
+
+
+if __name__ == "__main__":
+    main()
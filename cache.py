@@ -0,0 +1,98 @@
+# cache.py
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class CoalescingCache:
+    """
+    Caché LRU en memoria, con caducidad opcional y segura entre hilos.
+
+    Las peticiones simultáneas de una clave que no está en caché se agrupan en
+    get_or_load: solo una calcula el valor y el resto espera su resultado (o su
+    excepción). Es la base de la caché de scraping y de la de gráficas.
+    """
+
+    def __init__(self, max_size: int, ttl: float = None, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._entries = OrderedDict()  # clave -> (caduca_en, valor)
+        self._inflight = {}  # clave -> Future del cálculo en curso
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _get_fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key):
+        """Devuelve el valor en caché si sigue fresco, o None."""
+        with self._lock:
+            value = self._get_fresh(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Guarda un valor; si hay más de max_size, se descartan los menos usados recientemente."""
+        expires_at = float("inf") if self.ttl is None else self._clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """
+        Devuelve el valor en caché o lo calcula con loader(), agrupando las llamadas
+        concurrentes de la misma clave en un solo cálculo.
+
+        Args:
+            key: Clave del valor.
+            loader (callable): Función sin argumentos que calcula el valor.
+
+        Returns:
+            El valor de la clave.
+        """
+        with self._lock:
+            value = self._get_fresh(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = loader()
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
@@ -0,0 +1,101 @@
+# charts.py
+
+import io
+import os
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from cache import CoalescingCache
+from logger import config_logger
+from utils import CURRENCY_SYMBOLS
+
+logger = config_logger()
+
+# Gráficas renderizadas que se conservan en memoria (~50 KB cada una)
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 256))
+
+
+def render_price_history(history) -> bytes:
+    """
+    Dibuja la gráfica del historial de precios y la devuelve como PNG en memoria.
+
+    Usa la API orientada a objetos de matplotlib (una Figure con su propio canvas Agg)
+    en lugar de pyplot, sin estado global: se puede llamar desde varios hilos a la vez.
+
+    Args:
+        history (list): Puntos de get_price_series (timestamp, amount, low, high, currency)
+            o filas de get_price_history (sin low/high).
+
+    Returns:
+        bytes: Imagen PNG.
+    """
+    timestamps = [row["timestamp"] for row in history]
+    prices = [float(row["amount"]) for row in history]
+    currency = history[-1]["currency"] if history else None
+    symbol = CURRENCY_SYMBOLS.get(currency, currency or "€")
+
+    figure = Figure(figsize=(10, 6))
+    canvas = FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    # Con series reducidas, cada punto resume un tramo: su mínimo y máximo se muestran como banda
+    if any(row.get("low") is not None and row["low"] != row["high"] for row in history):
+        ax.fill_between(timestamps, [float(row["low"]) for row in history], [float(row["high"]) for row in history],
+                        alpha=0.2, step="post")
+    # Cada punto es el precio vigente hasta el siguiente: escalones, no rampas
+    ax.plot(timestamps, prices, drawstyle="steps-post", marker="o" if len(history) <= 60 else None)
+    ax.set_title("Historial de precios")
+    ax.set_xlabel("Fecha")
+    ax.set_ylabel(f"Precio ({symbol})")
+    ax.grid()
+    ax.tick_params(axis="x", labelrotation=45)
+    figure.tight_layout()
+
+    buffer = io.BytesIO()
+    canvas.print_png(buffer)
+    return buffer.getvalue()
+
+
+class ChartCache(CoalescingCache):
+    """
+    Caché LRU de gráficas renderizadas, segura entre hilos.
+
+    La clave incluye la última comprobación del producto, que cambia con cada escritura
+    del historial, así que una entrada nunca queda obsoleta: cuando llega un precio la
+    clave cambia y la gráfica antigua acaba saliendo por LRU. Las peticiones simultáneas
+    de la misma gráfica comparten un único renderizado.
+    """
+
+    def __init__(self, max_size: int = CHART_CACHE_SIZE):
+        super().__init__(max_size)
+
+    @staticmethod
+    def key_for(product_id, history, start=None, end=None, points=None):
+        """
+        Clave de una serie: (producto, última comprobación, rango y puntos pedidos a
+        get_price_series). Con el rango por defecto la serie termina en la última
+        comprobación, así que no cambia hasta que se registra un precio.
+        """
+        return product_id, history[-1]["checked_at"], start, end, points
+
+    def get_or_render(self, product_id, history, start=None, end=None, points=None) -> bytes:
+        """
+        Devuelve la gráfica de un historial, renderizándola solo si no está en caché.
+
+        Args:
+            product_id (int): ID del producto.
+            history (list): Puntos de get_price_series.
+            start, end, points: Argumentos con los que se pidió la serie.
+
+        Returns:
+            bytes: Imagen PNG.
+        """
+        def render():
+            png = render_price_history(history)
+            logger.info(f"Gráfica renderizada para el producto {product_id} ({len(png) / 1024:.0f} KB)")
+            return png
+
+        return self.get_or_load(self.key_for(product_id, history, start, end, points), render)
+
+
+chart_cache = ChartCache()
@@ -1,22 +1,28 @@
-import matplotlib
-matplotlib.use('Agg') 
 from telegram import Update
 from telegram.ext import ContextTypes
-from utils import is_valid_amazon_url, is_valid_index, escape_markdown_v2
+from utils import is_valid_amazon_url, is_valid_index, escape_markdown_v2, describe_price
 from price_tracker import get_price
 from price_tracker import get_product_info
-from database import add_user, add_product, get_products, remove_product, get_price_history
-import matplotlib.pyplot as plt
-import os
-import time
+from database import add_user, add_product, get_products, remove_product, get_price_series, transaction
+from executors import run_blocking
+from charts import chart_cache
+from bulk import IMPORT_MAX_BYTES, IMPORT_MAX_URLS, import_products, parse_import, write_export
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from utils import user_states
+from state_store import state_store
+import io
 import logging
+import tempfile
 from telegram.error import TelegramError
 from logger import config_logger
 
 logger = config_logger()
 
+def _track_product(user_id, url, info):
+    """Registra el usuario y el producto en una sola transacción."""
+    with transaction():
+        add_user(user_id)
+        return add_product(user_id, url, info.name, info.amount, info.currency, info.status)
+
 # Función para el comando /help
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     help_text = (
@@ -27,6 +33,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/checkprice <URL>  Consultar el precio actual de un producto\n"
         "/remove <número>  Eliminar un producto monitoreado por su número en /list\n"
         "/history <URL> Ver el historial de precios de un producto\n"
+        "/import  Añadir varias URLs a la vez (una por línea, o un fichero CSV/JSONL)\n"
+        "/export  Descargar tus productos y su historial de precios en CSV\n"
         "/help  Mostrar este mensaje de ayuda\n"
     )
     await update.message.reply_text(escape_markdown_v2(help_text), parse_mode="MarkdownV2")
@@ -43,11 +51,10 @@ async def add_url(update, context):
         return
 
     user_id = update.message.chat_id
-    product_name, product_price = get_product_info(url)
-    add_user(user_id)
-    add_product(user_id, url, product_name, product_price)
+    info = await run_blocking("scrape", get_product_info, url)
+    await run_blocking("db", _track_product, user_id, url, info)
 
-    message = f"✅ Producto añadido: {product_name}  {product_price}"
+    message = f"✅ Producto añadido: {info.name}  {info.price}"
     await update.message.reply_text(escape_markdown_v2(message), parse_mode="MarkdownV2")
 
 # Función para el comando /list
@@ -55,8 +62,8 @@ async def list_urls(update, context):
     user_id = (
         update.callback_query.message.chat_id if update.callback_query else update.message.chat_id
     )
-    products = get_products(user_id)
-    logger.info(f"Productos de {user_id}: {products}")
+    products = await run_blocking("db", get_products, user_id)
+    logger.info(f"Productos de {user_id}: {len(products or [])}")
 
 
     if not products:
@@ -72,7 +79,7 @@ async def list_urls(update, context):
     for index, product in enumerate(products, start=1):
         escaped_name = escape_markdown_v2(product["name"] or "Nombre no disponible")
         escaped_url = escape_markdown_v2(product["url"] or "URL no disponible")
-        escaped_price = escape_markdown_v2(product["price"] or "Precio no disponible")
+        escaped_price = escape_markdown_v2(describe_price(product["last_price"], product["currency"], product["availability"]))
         message += f"{index} {escaped_name} {escaped_price}\n"
 
     
@@ -88,7 +95,7 @@ async def check_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     url = context.args[0]
     await update.message.reply_text(escape_markdown_v2("Extrayendo precio, por favor espera..."), parse_mode="MarkdownV2")
 
-    price = get_price(url)
+    price = await run_blocking("scrape", get_price, url)
     message = f"El precio del producto es: {price}"
     await update.message.reply_text(escape_markdown_v2(message), parse_mode="MarkdownV2")
 
@@ -101,7 +108,7 @@ async def remove_url(update, context):
     user_id = update.message.chat_id
     try:
         product_index = context.args[0]
-        products = get_products(user_id)
+        products = await run_blocking("db", get_products, user_id)
 
         if not is_valid_index(product_index, len(products)):
             await update.message.reply_text(escape_markdown_v2("⚠️ El número proporcionado no es válido. Usa /list para ver tus productos."), parse_mode="MarkdownV2")
@@ -110,7 +117,7 @@ async def remove_url(update, context):
         product_index = int(product_index) - 1  # Ajustar para índice 0
         url_to_remove = products[product_index]['url']  # Acceder correctamente
 
-        remove_product(user_id, url_to_remove)
+        await run_blocking("db", remove_product, user_id, url_to_remove)
 
         message = f"✅ El producto '{products[product_index]['name']}' ha sido eliminado del seguimiento."
 
@@ -128,29 +135,79 @@ async def show_history(update, context):
     url = context.args[0]
     user_id = update.message.chat_id
 
-    history = get_price_history(user_id, url)
+    # Serie reducida a unos cientos de puntos, sea cual sea la antigüedad del producto
+    history = await run_blocking("db", get_price_series, user_id, url)
     if not history:
         await update.message.reply_text(escape_markdown_v2("⚠️ No se encontró historial de precios para este producto."), parse_mode="MarkdownV2")
         return
 
-    timestamps, prices = zip(*history)
-    prices = [float(price.replace(",", ".").replace(" €", "")) for price in prices]
+    # La gráfica se renderiza en memoria y solo si el historial ha cambiado desde la última vez
+    png = await run_blocking("render", chart_cache.get_or_render, history[0]["product_id"], history)
+    await update.message.reply_photo(photo=png)
 
-    plt.figure(figsize=(10, 6))
-    plt.plot(timestamps, prices, marker="o")
-    plt.title("Historial de precios")
-    plt.xlabel("Fecha")
-    plt.ylabel("Precio (€)")
-    plt.grid()
-    plt.xticks(rotation=45)
 
-    file_path = f"history_{user_id}_{int(time.time())}.png"
-    plt.tight_layout()
-    plt.savefig(file_path)
-    plt.close()
+# Función para el comando /import (texto con una URL por línea, o un documento con /import
+# en el pie o como respuesta a él)
+async def import_urls(update, context):
+    message = update.message
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    if document:
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            await message.reply_text(escape_markdown_v2(f"⚠️ El fichero es demasiado grande (máximo {IMPORT_MAX_BYTES // 1024} KB)."), parse_mode="MarkdownV2")
+            return
+        file = await document.get_file()
+        text = bytes(await file.download_as_bytearray()).decode("utf-8-sig", errors="replace")
+        filename = document.file_name or ""
+    else:
+        parts = (message.text or message.caption or "").split(maxsplit=1)
+        text = parts[1] if len(parts) > 1 else ""
+        filename = ""
+
+    urls, invalid = parse_import(text, filename)
+    if not urls:
+        await message.reply_text(escape_markdown_v2("⚠️ No se encontraron URLs válidas de Amazon. Envía /import seguido de una URL por línea, o un fichero CSV/JSONL con /import en el pie."), parse_mode="MarkdownV2")
+        return
+    if len(urls) > IMPORT_MAX_URLS:
+        await message.reply_text(escape_markdown_v2(f"⚠️ Demasiadas URLs ({len(urls)}). El máximo por importación es {IMPORT_MAX_URLS}."), parse_mode="MarkdownV2")
+        return
 
-    await update.message.reply_photo(photo=open(file_path, "rb"))
-    os.remove(file_path)
+    # Sin descargas aquí: los productos nuevos entran en la cola de los workers
+    added = await run_blocking("db", import_products, message.chat_id, urls)
+    if added is None:
+        await message.reply_text(escape_markdown_v2("⚠️ Ocurrió un error. Inténtalo de nuevo más tarde."), parse_mode="MarkdownV2")
+        return
+    summary = f"✅ {added} productos añadidos"
+    if len(urls) > added:
+        summary += f", {len(urls) - added} ya estaban en seguimiento"
+    if invalid:
+        summary += f", {len(invalid)} líneas no válidas"
+    summary += ". Los precios aparecerán en /list tras la próxima comprobación."
+    await message.reply_text(escape_markdown_v2(summary), parse_mode="MarkdownV2")
+
+
+def _export_csv(user_id):
+    """Escribe la exportación en un fichero temporal que pasa a disco si crece; devuelve (fichero, filas)."""
+    file = tempfile.SpooledTemporaryFile(max_size=IMPORT_MAX_BYTES)
+    out = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    rows = write_export(user_id, out)
+    out.flush()
+    out.detach()
+    file.seek(0)
+    return file, rows
+
+
+# Función para el comando /export
+async def export_history(update, context):
+    user_id = update.message.chat_id
+    file, rows = await run_blocking("db", _export_csv, user_id)
+    with file:
+        if rows is None:
+            await update.message.reply_text(escape_markdown_v2("⚠️ Ocurrió un error. Inténtalo de nuevo más tarde."), parse_mode="MarkdownV2")
+            return
+        if rows == 0:
+            await update.message.reply_text(escape_markdown_v2("No tienes productos en seguimiento. Usa /add <URL> para añadir uno."), parse_mode="MarkdownV2")
+            return
+        await update.message.reply_document(document=file, filename="historial_precios.csv")
 
 
 async def button_handler(update, context):
@@ -162,10 +219,11 @@ async def button_handler(update, context):
     if data.startswith("product_"):
         product_index = int(data.split("_")[1]) - 1
         user_id = query.message.chat_id
-        products = get_products(user_id)
+        products = await run_blocking("db", get_products, user_id)
 
         if 0 <= product_index < len(products):
-            url, name, price = products[product_index]
+            url, name = products[product_index]["url"], products[product_index]["name"]
+            price = describe_price(products[product_index]["last_price"], products[product_index]["currency"], products[product_index]["availability"])
             await query.edit_message_text(
                 f"Producto seleccionado:\n\n"
                 f"\*Nombre:\* {name}\n"
@@ -202,18 +260,18 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     action = query.data
 
     if action == "add_product":
-        user_states[user_id] = {"state": "waiting_for_url"}
+        await state_store.aset(user_id, {"state": "waiting_for_url"})
         await query.edit_message_text(escape_markdown_v2("Por favor, envía la URL del producto que deseas añadir."), parse_mode="MarkdownV2")
     elif action == "list_products":
         await list_urls(update, context)  # Reutiliza la función existente
     elif action == "remove_product":
-        user_states[user_id] = {"state": "waiting_for_remove"}
+        await state_store.aset(user_id, {"state": "waiting_for_remove"})
         await query.edit_message_text(escape_markdown_v2("Por favor, envía el número del producto que deseas eliminar."), parse_mode="MarkdownV2")
     elif action == "check_price":
-        user_states[user_id] = {"state": "waiting_for_check"}
+        await state_store.aset(user_id, {"state": "waiting_for_check"})
         await query.edit_message_text(escape_markdown_v2("Por favor, envía la URL del producto para consultar el precio."), parse_mode="MarkdownV2")
     elif action == "price_history":
-        user_states[user_id] = {"state": "waiting_for_history"}
+        await state_store.aset(user_id, {"state": "waiting_for_history"})
         await query.edit_message_text(escape_markdown_v2("Por favor, envía la URL del producto para ver el historial de precios."), parse_mode="MarkdownV2")
     elif action == "help":
         await query.edit_message_text(
@@ -225,6 +283,8 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                 "/checkprice <URL>  Consultar el precio actual de un producto\n"
                 "/remove <número>  Eliminar un producto monitoreado por su número en /list\n"
                 "/history <URL>  Ver el historial de precios de un producto\n"
+                "/import  Añadir varias URLs a la vez (una por línea, o un fichero CSV/JSONL)\n"
+                "/export  Descargar tus productos y su historial de precios en CSV\n"
                 "/help  Mostrar este mensaje de ayuda\n"
             ),
             parse_mode="MarkdownV2"
@@ -240,43 +300,41 @@ async def handle_user_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.message.chat_id
     user_input = update.message.text
 
-    if user_id not in user_states or "state" not in user_states[user_id]:
+    # Se retira al leerlo: cada respuesta se procesa una sola vez aunque haya varias réplicas
+    user_state = await state_store.apop(user_id)
+    if not user_state or "state" not in user_state:
         await update.message.reply_text(escape_markdown_v2("Por favor, utiliza el menú para seleccionar una acción."), parse_mode="MarkdownV2")
         return
 
-    state = user_states[user_id]["state"]
+    state = user_state["state"]
 
     if state == "waiting_for_url":
         if is_valid_amazon_url(user_input):
-            product_name, product_price = get_product_info(user_input)
-            add_user(user_id)
-            add_product(user_id, user_input, product_name, product_price)
-            await update.message.reply_text(escape_markdown_v2(f"Producto añadido: {product_name}  {product_price}"), parse_mode="MarkdownV2")
+            info = await run_blocking("scrape", get_product_info, user_input)
+            await run_blocking("db", _track_product, user_id, user_input, info)
+            await update.message.reply_text(escape_markdown_v2(f"Producto añadido: {info.name}  {info.price}"), parse_mode="MarkdownV2")
         else:
             await update.message.reply_text(escape_markdown_v2("La URL proporcionada no es válida. Inténtalo de nuevo."), parse_mode="MarkdownV2")
-        user_states.pop(user_id)  # Limpia el estado del usuario
 
     elif state == "waiting_for_remove":
         try:
             product_index = int(user_input) - 1
-            products = get_products(user_id)
+            products = await run_blocking("db", get_products, user_id) or []
             if 0 <= product_index < len(products):
-                url_to_remove = products[product_index][0]
-                remove_product(user_id, url_to_remove)
-                await update.message.reply_text(escape_markdown_v2(f'El producto "{products[product_index][1]}" ha sido eliminado del seguimiento.'), parse_mode="MarkdownV2")
+                url_to_remove = products[product_index]["url"]
+                await run_blocking("db", remove_product, user_id, url_to_remove)
+                await update.message.reply_text(escape_markdown_v2(f'El producto "{products[product_index]["name"]}" ha sido eliminado del seguimiento.'), parse_mode="MarkdownV2")
             else:
                 await update.message.reply_text(escape_markdown_v2("El número proporcionado no es válido."), parse_mode="MarkdownV2")
         except ValueError:
             await update.message.reply_text(escape_markdown_v2("Por favor, proporciona un número válido."), parse_mode="MarkdownV2")
-        user_states.pop(user_id)  # Limpia el estado del usuario
 
     elif state == "waiting_for_check":
         if is_valid_amazon_url(user_input):
-            price = get_price(user_input)
+            price = await run_blocking("scrape", get_price, user_input)
             await update.message.reply_text(escape_markdown_v2(f'El precio del producto es: {price}'), parse_mode="MarkdownV2")
         else:
             await update.message.reply_text(escape_markdown_v2("La URL proporcionada no es válida. Inténtalo de nuevo."), parse_mode="MarkdownV2")
-        user_states.pop(user_id)
 
     elif state == "waiting_for_history":
         if is_valid_amazon_url(user_input):
@@ -285,7 +343,6 @@ async def handle_user_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await show_history(update, context)  # Reutiliza la función existente
         else:
             await update.message.reply_text(escape_markdown_v2("La URL proporcionada no es válida. Inténtalo de nuevo."), parse_mode="MarkdownV2")
-        user_states.pop(user_id)  # Limpia el estado del usuario
 
     else:
         await update.message.reply_text(escape_markdown_v2("Acción no reconocida. Por favor, utiliza el menú para empezar."), parse_mode="MarkdownV2")
@@ -1,7 +1,20 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import pool
+from psycopg2.extras import Json, RealDictCursor, execute_values
 from logger import config_logger
+from metrics import DB_ERRORS, DB_SECONDS, stage
+from migrations import (
+    HISTORY_PARTITIONS_AHEAD, MIGRATIONS_LOCK_ID, add_months, apply_migrations, create_history_partitions, month_start,
+)
+from utils import simplify_amazon_url
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from functools import wraps
 from urllib.parse import urlparse
 
 logger = config_logger()
@@ -20,75 +33,225 @@ DB_CONFIG = {
     "port": parsed_url.port or 5432,      # Asigna el puerto por defecto de PostgreSQL si no está especificado
 }
 
-def get_connection():
-    """
-    Obtiene una conexión a la base de datos PostgreSQL.
+# Configuración del pool de conexiones
+DB_POOL_ENABLED = os.getenv("DB_POOL_ENABLED", "1") != "0"
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # Segundos de espera por una conexión libre
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", 30))  # Segundos de inactividad antes de comprobar una conexión
 
-    Returns:
-        psycopg2.connection: Conexión a PostgreSQL.
-    """
+# Filas que trae cada viaje a la base de datos al recorrer resultados grandes con un cursor del servidor
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", 2000))
+
+# Suscripciones por página al recorrer el catálogo completo (get_all_products); cada
+# página es una consulta corta, así que el recorrido no mantiene una transacción abierta
+PRODUCT_SCAN_PAGE = int(os.getenv("PRODUCT_SCAN_PAGE", 10000))
+
+# Puntos por defecto de las series de precios para gráficas (get_price_series)
+SERIES_POINTS = int(os.getenv("SERIES_POINTS", 200))
+
+# Resúmenes del historial: (tabla, unidad de date_trunc, segundos por periodo)
+ROLLUPS = (
+    ("price_history_daily", "day", 86400),
+    ("price_history_hourly", "hour", 3600),
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used = {}  # id(conexión) -> instante del último uso
+
+# Conexión de la unidad de trabajo en curso (si la hay) en el contexto actual
+_current_conn = ContextVar("current_conn", default=None)
+
+def _connect():
     try:
-        conn = psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
-        return conn
+        return psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
     except psycopg2.Error as e:
         logger.error(f"Error al conectar a la base de datos: {e}")
         raise e
 
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, **DB_CONFIG, cursor_factory=RealDictCursor
+                )
+                logger.info(f"Pool de conexiones creado (min={DB_POOL_MIN}, max={DB_POOL_MAX}).")
+    return _pool
+
+def _is_healthy(conn):
+    """
+    Comprueba que una conexión del pool sigue viva. Solo se hace un SELECT 1 si
+    la conexión lleva inactiva más de DB_HEALTHCHECK_INTERVAL segundos.
+    """
+    if conn.closed:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < DB_HEALTHCHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error as e:
+        logger.warning(f"Conexión del pool descartada: {e}")
+        return False
+
+def _acquire():
+    if not DB_POOL_ENABLED:
+        return _connect()
+
+    # El semáforo acota las conexiones en uso y hace esperar en lugar de fallar cuando el pool está lleno
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise pool.PoolError(f"No hay conexiones libres tras esperar {DB_POOL_TIMEOUT} s")
+    try:
+        connection_pool = _get_pool()
+        for _ in range(DB_POOL_MAX + 1):
+            conn = connection_pool.getconn()
+            if _is_healthy(conn):
+                return conn
+            _last_used.pop(id(conn), None)
+            connection_pool.putconn(conn, close=True)
+        raise pool.PoolError("No se pudo obtener una conexión válida del pool")
+    except BaseException:
+        _pool_slots.release()
+        raise
+
+def _release(conn):
+    if not DB_POOL_ENABLED:
+        conn.close()
+        return
+    try:
+        if conn.closed:
+            _last_used.pop(id(conn), None)
+            _get_pool().putconn(conn, close=True)
+        else:
+            _last_used[id(conn)] = time.monotonic()
+            _get_pool().putconn(conn)
+    finally:
+        _pool_slots.release()
+
+def close_pool():
+    """
+    Cierra todas las conexiones del pool. La siguiente operación creará uno nuevo.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+@contextmanager
+def transaction():
+    """
+    Unidad de trabajo: ejecuta varias operaciones sobre una misma conexión y en
+    una misma transacción. Las funciones de este módulo llamadas dentro del bloque
+    reutilizan esa conexión; se hace commit al salir o rollback si hay una excepción.
+
+    Ejemplo:
+        with transaction():
+            last_price = get_last_price(product_id)
+            record_price_change(product_id, price)
+
+    Yields:
+        psycopg2.connection: Conexión de la transacción.
+    """
+    outer = _current_conn.get()
+    if outer is not None:
+        # Transacción anidada: se une a la exterior
+        yield outer
+        return
+
+    conn = _acquire()
+    token = _current_conn.set(conn)
+    try:
+        with conn:
+            yield conn
+    finally:
+        _current_conn.reset(token)
+        _release(conn)
+
+def get_connection():
+    """
+    Obtiene una conexión a la base de datos PostgreSQL del pool, como gestor de
+    contexto. Si hay una transacción en curso (ver transaction()) se reutiliza su
+    conexión; si no, se hace commit al salir del bloque.
+
+    Returns:
+        contextmanager: Gestor de contexto que devuelve una psycopg2.connection.
+    """
+    return transaction()
+
 def init_db():
     """
-    Inicializa las tablas necesarias en la base de datos.
+    Inicializa las tablas necesarias en la base de datos aplicando las migraciones pendientes.
     """
     try:
         with get_connection() as conn:
+            version = apply_migrations(conn)
             with conn.cursor() as cursor:
-                # Crear tabla de usuarios con chat_id como PRIMARY KEY
-                cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    chat_id BIGINT PRIMARY KEY
-                )
-                """)
-                
-                # Crear tabla de productos referenciando chat_id en lugar de user_id
-                cursor.execute("""
-                CREATE TABLE IF NOT EXISTS products (
-                    id SERIAL PRIMARY KEY,
-                    chat_id BIGINT REFERENCES users(chat_id) ON DELETE CASCADE,
-                    url TEXT NOT NULL,
-                    name TEXT,
-                    price TEXT
-                )
-                """)
-                
-                # Crear tabla de historial de precios
-                cursor.execute("""
-                CREATE TABLE IF NOT EXISTS price_history (
-                    id SERIAL PRIMARY KEY,
-                    product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    price TEXT
-                )
-                """)
-                
-                # Crear índices para optimizar las consultas
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_id ON price_history(product_id)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_id ON products(chat_id)")
-                
-                conn.commit()
-                logger.info("Tablas de la base de datos inicializadas correctamente.")
+                ensure_history_partitions(cursor)
+            logger.info(f"Tablas de la base de datos inicializadas correctamente (esquema v{version}).")
     except psycopg2.Error as e:
         logger.error(f"Error al inicializar la base de datos: {e}")
         raise e
 
 # Decorador para manejar errores de base de datos
 def handle_db_errors(func):
+    name = func.__name__
+
+    @wraps(func)
     def wrapper(*args, **kwargs):
+        started = time.perf_counter()
         try:
-            return func(*args, **kwargs)
+            with stage("db"):
+                return func(*args, **kwargs)
         except psycopg2.Error as e:
+            DB_ERRORS.inc(function=name)
             logger.error(f"Error en {func.__name__}: {e}")
+            # Dentro de una unidad de trabajo el error se propaga para revertirla entera
+            if _current_conn.get() is not None:
+                raise
             return None
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, function=name)
     return wrapper
 
+def _roll_up(cursor, observations):
+    """
+    Actualiza los resúmenes por hora y por día con observaciones de precio, dentro
+    de la transacción de quien las escribe.
+
+    Args:
+        cursor: Cursor de la transacción en curso.
+        observations (list): Tuplas (product_id, importe, moneda); las que no tienen importe se ignoran.
+    """
+    # Una fila por producto (la última) y en orden de ID, para que los workers bloqueen en el mismo orden
+    latest = {product_id: (product_id, amount, currency) for product_id, amount, currency in observations if amount is not None}
+    rows = [latest[product_id] for product_id in sorted(latest)]
+    if not rows:
+        return
+    upserts = ",\n".join(f"""
+    {unit}_rollup AS (
+        INSERT INTO {table} (product_id, bucket, currency, open, low, high, close)
+        SELECT product_id, date_trunc('{unit}', LOCALTIMESTAMP), currency, amount, amount, amount, amount
+        FROM obs
+        ON CONFLICT (product_id, bucket) DO UPDATE SET
+            currency = EXCLUDED.currency,
+            low = LEAST({table}.low, EXCLUDED.low),
+            high = GREATEST({table}.high, EXCLUDED.high),
+            close = EXCLUDED.close,
+            samples = {table}.samples + 1
+    )""" for table, unit, _ in ROLLUPS)
+    execute_values(cursor, f"""
+    WITH obs (product_id, amount, currency) AS (VALUES %s),{upserts}
+    SELECT 1
+    """, rows, template="(%s::INTEGER, %s::NUMERIC, %s::TEXT)", page_size=len(rows))
+
 @handle_db_errors
 def add_user(chat_id):
     """
@@ -103,7 +266,6 @@ def add_user(chat_id):
                 "INSERT INTO users (chat_id) VALUES (%s) ON CONFLICT DO NOTHING",
                 (chat_id,)
             )
-            conn.commit()
             logger.info(f"Usuario añadido o ya existente: {chat_id}")
 
 @handle_db_errors
@@ -121,7 +283,7 @@ def is_valid_url(url):
     return bool(parsed.netloc) and bool(parsed.scheme)
 
 @handle_db_errors
-def add_product(chat_id, url, name=None, price=None):
+def add_product(chat_id, url, name=None, amount=None, currency=None, status=None):
     """
     Añade un producto a la base de datos para un usuario específico.
 
@@ -129,29 +291,129 @@ def add_product(chat_id, url, name=None, price=None):
         chat_id (int): ID del chat de Telegram.
         url (str): URL del producto en Amazon.
         name (str, optional): Nombre del producto. Por defecto es None.
-        price (str, optional): Precio del producto. Por defecto es None.
+        amount (Decimal, optional): Precio del producto. Por defecto es None.
+        currency (str, optional): Código ISO de la moneda. Por defecto es None.
+        status (str, optional): Disponibilidad ("available", "unavailable" o "error"). Por defecto es None (sin comprobar).
+
+    Returns:
+        int: ID del producto. Si el usuario ya seguía esa URL, se devuelve el existente.
     """
     if not is_valid_url(url):
         logger.error(f"URL inválida: {url}")
         return
 
+    # Solo las observaciones reales del producto cuentan como precio conocido
+    observed = status in ("available", "unavailable")
     with get_connection() as conn:
         with conn.cursor() as cursor:
+            target_url = simplify_amazon_url(url)
             cursor.execute("""
-            INSERT INTO products (chat_id, url, name, price)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-            """, (chat_id, url, name, price))
-            product_id = cursor.fetchone()["id"]
+            INSERT INTO products (chat_id, url, target_url, name, last_price, currency, availability,
+                                  last_checked_at, price_since)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, CASE WHEN %s THEN CURRENT_TIMESTAMP END, CASE WHEN %s THEN CURRENT_TIMESTAMP END)
+            ON CONFLICT (chat_id, url) DO UPDATE SET name = COALESCE(EXCLUDED.name, products.name)
+            RETURNING id, (xmax = 0) AS inserted
+            """, (chat_id, url, target_url, name, amount, currency, status if observed else None, observed, observed))
+            result = cursor.fetchone()
+            product_id = result["id"]
+            if not result["inserted"]:
+                logger.info(f"El producto ya estaba en seguimiento: ID {product_id}, URL {url}")
+                return product_id
             logger.info(f"Producto añadido: ID {product_id}, URL {url}")
 
-            if price:
+            # Los workers lo descargarán en su próxima ronda si nadie más lo seguía
+            cursor.execute("INSERT INTO scrape_targets (url) VALUES (%s) ON CONFLICT DO NOTHING", (target_url,))
+
+            if observed:
                 cursor.execute("""
-                INSERT INTO price_history (product_id, price)
-                VALUES (%s, %s)
-                """, (product_id, price))
-            conn.commit()
-            logger.info(f"Historial de precio registrado para producto ID {product_id}")
+                INSERT INTO price_history (product_id, amount, currency, status)
+                VALUES (%s, %s, %s, %s)
+                """, (product_id, amount, currency, status))
+                _roll_up(cursor, [(product_id, amount, currency)])
+                logger.info(f"Historial de precio registrado para producto ID {product_id}")
+            return product_id
+
+@handle_db_errors
+def add_products_bulk(chat_id, urls):
+    """
+    Añade en bloque productos a un usuario, en una sola transacción y sin descargarlos:
+    los que nadie seguía quedan en scrape_targets para que los workers los descarguen
+    en su próxima ronda, y el nombre se completa con la primera descarga.
+
+    Args:
+        chat_id (int): ID del chat de Telegram.
+        urls (list): URLs ya validadas y normalizadas.
+
+    Returns:
+        int: Número de productos añadidos (los que el usuario ya seguía no cuentan).
+    """
+    rows = [(chat_id, url, simplify_amazon_url(url)) for url in dict.fromkeys(urls) if is_valid_url(url)]
+    if not rows:
+        return 0
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO users (chat_id) VALUES (%s) ON CONFLICT DO NOTHING", (chat_id,))
+            inserted = execute_values(cursor, """
+            INSERT INTO products (chat_id, url, target_url) VALUES %s
+            ON CONFLICT (chat_id, url) DO NOTHING
+            RETURNING target_url
+            """, rows, page_size=1000, fetch=True)
+            targets = sorted({row["target_url"] for row in inserted})
+            if targets:
+                execute_values(cursor, "INSERT INTO scrape_targets (url) VALUES %s ON CONFLICT DO NOTHING",
+                               [(url,) for url in targets], page_size=1000)
+            logger.info(f"Importación de {chat_id}: {len(inserted)} productos añadidos de {len(rows)}")
+            return len(inserted)
+
+@handle_db_errors
+def set_product_names(names):
+    """
+    Completa el nombre de los productos añadidos sin nombre (importaciones en bloque).
+
+    Args:
+        names (list): Tuplas (product_id, nombre).
+    """
+    if not names:
+        return
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            execute_values(cursor, """
+            UPDATE products p SET name = v.name
+            FROM (VALUES %s) AS v (id, name)
+            WHERE p.id = v.id AND p.name IS NULL
+            """, names, template="(%s::INTEGER, %s::TEXT)", page_size=1000)
+
+@handle_db_errors
+def export_price_history(chat_id, write_row):
+    """
+    Recorre los productos de un usuario con todo su historial de precios, sin cargarlo
+    en memoria: un cursor del servidor trae DB_FETCH_SIZE filas en cada viaje.
+
+    Args:
+        chat_id (int): ID del chat de Telegram.
+        write_row (callable): Se llama con cada fila (url, name, valid_from, last_seen_at,
+            amount, currency, status); los productos sin historial tienen una fila sin precio.
+
+    Returns:
+        int: Número de filas exportadas.
+    """
+    count = 0
+    with get_connection() as conn:
+        with conn.cursor(name="export_price_history") as cursor:
+            cursor.itersize = DB_FETCH_SIZE
+            cursor.execute("""
+            SELECT p.url, p.name, h.valid_from, COALESCE(h.last_seen_at, h.valid_from) AS last_seen_at,
+                   h.amount, h.currency, h.status
+            FROM products p
+            LEFT JOIN price_history h ON h.product_id = p.id
+            WHERE p.chat_id = %s
+            ORDER BY p.id, h.valid_from
+            """, (chat_id,))
+            for row in cursor:
+                write_row(row)
+                count += 1
+    logger.info(f"Exportación de {chat_id}: {count} filas")
+    return count
 
 @handle_db_errors
 def get_products(chat_id):
@@ -162,15 +424,15 @@ def get_products(chat_id):
         chat_id (int): ID del chat de Telegram.
 
     Returns:
-        list: Lista de productos con sus datos (URL, nombre, precio).
+        list: Lista de productos con sus datos (URL, nombre, último precio, moneda y disponibilidad).
     """
     with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("""
-            SELECT url, name, price FROM products WHERE chat_id = %s
+            SELECT url, name, last_price, currency, availability FROM products WHERE chat_id = %s
             """, (chat_id,))
             products = cursor.fetchall()
-            logger.info(f"Productos obtenidos para chat_id {chat_id}: {products}")
+            logger.info(f"Productos obtenidos para chat_id {chat_id}: {len(products)}")
             return products
 
 @handle_db_errors
@@ -188,20 +450,22 @@ def remove_product(chat_id, url):
             DELETE FROM products WHERE chat_id = %s AND url = %s
             """, (chat_id, url))
             deleted_rows = cursor.rowcount
-            conn.commit()
             if deleted_rows > 0:
                 logger.info(f"Producto eliminado: chat_id {chat_id}, URL {url}")
             else:
                 logger.warning(f"No se encontró el producto para eliminar: chat_id {chat_id}, URL {url}")
 
 @handle_db_errors
-def record_price_change(product_id, price):
+def record_price_change(product_id, amount, currency=None, status="available"):
     """
-    Registra un cambio de precio para un producto específico.
+    Registra un cambio de precio para un producto específico (abre un nuevo intervalo
+    en el historial) y actualiza su último precio.
 
     Args:
         product_id (int): ID del producto.
-        price (str): Nuevo precio del producto.
+        amount (Decimal): Nuevo precio del producto, o None si no está disponible.
+        currency (str, optional): Código ISO de la moneda.
+        status (str, optional): "available" o "unavailable". Por defecto es "available".
     """
     if not isinstance(product_id, int):
         logger.error(f"ID de producto inválido: {product_id}")
@@ -210,12 +474,318 @@ def record_price_change(product_id, price):
     with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("""
-            INSERT INTO price_history (product_id, price)
-            VALUES (%s, %s)
-            """, (product_id, price))
-            conn.commit()
+            INSERT INTO price_history (product_id, amount, currency, status)
+            VALUES (%s, %s, %s, %s)
+            """, (product_id, amount, currency, status))
+            cursor.execute("""
+            UPDATE products
+            SET last_price = %s, currency = %s, availability = %s,
+                last_checked_at = CURRENT_TIMESTAMP, price_since = CURRENT_TIMESTAMP
+            WHERE id = %s
+            """, (amount, currency, status, product_id))
+            _roll_up(cursor, [(product_id, amount, currency)])
             logger.info(f"Historial de precio actualizado para producto ID {product_id}")
 
+@handle_db_errors
+def record_price_observations(observations):
+    """
+    Registra en bloque las observaciones de precio de un ciclo de actualización.
+
+    El historial guarda intervalos de precio constante: una observación que cambia el
+    importe o la disponibilidad respecto al último precio abre un intervalo nuevo, y
+    una que no lo cambia solo alarga el intervalo abierto (last_seen_at). Así el
+    historial crece con los cambios de precio y no con las comprobaciones, y se
+    distingue un producto estable de uno que no se ha comprobado. Todas actualizan el
+    último precio y la fecha de comprobación desnormalizados en products y los
+    resúmenes por hora y día.
+
+    Args:
+        observations (list): Lista de tuplas (product_id, importe, moneda, disponibilidad).
+
+    Returns:
+        int: Observaciones registradas, o None si falla la base de datos.
+    """
+    if not observations:
+        return 0
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            # Todas las partes de la sentencia ven products antes de la actualización final
+            execute_values(cursor, """
+            WITH obs (product_id, amount, currency, status) AS (VALUES %s),
+            compared AS (
+                SELECT o.*, p.price_since,
+                       p.last_checked_at IS NULL
+                       OR p.price_since IS NULL
+                       OR p.last_price IS DISTINCT FROM o.amount
+                       OR p.availability IS DISTINCT FROM o.status AS changed
+                FROM obs o
+                JOIN products p ON p.id = o.product_id
+            ),
+            opened AS (
+                INSERT INTO price_history (product_id, amount, currency, status, valid_from, last_seen_at)
+                SELECT product_id, amount, currency, status, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+                FROM compared
+                WHERE changed
+            ),
+            extended AS (
+                UPDATE price_history h SET last_seen_at = CURRENT_TIMESTAMP
+                FROM compared c
+                WHERE NOT c.changed AND h.product_id = c.product_id AND h.valid_from = c.price_since
+            )
+            UPDATE products p
+            SET last_price = c.amount, currency = c.currency, availability = c.status,
+                last_checked_at = CURRENT_TIMESTAMP,
+                price_since = CASE WHEN c.changed THEN CURRENT_TIMESTAMP ELSE p.price_since END
+            FROM compared c
+            WHERE p.id = c.product_id
+            """, observations, template="(%s::INTEGER, %s::NUMERIC, %s::TEXT, %s::TEXT)", page_size=1000)
+            _roll_up(cursor, [(product_id, amount, currency) for product_id, amount, currency, _ in observations])
+            logger.info(f"Precios actualizados para {len(observations)} productos")
+            return len(observations)
+
+@handle_db_errors
+def get_product_id_bounds():
+    """
+    Devuelve el menor y el mayor ID de producto, para recorrer la tabla por tramos.
+
+    Returns:
+        tuple: (mínimo, máximo), o (None, None) si no hay productos.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT MIN(id) AS first_id, MAX(id) AS last_id FROM products")
+            bounds = cursor.fetchone()
+            return bounds["first_id"], bounds["last_id"]
+
+@handle_db_errors
+def compact_price_history(first_id, last_id):
+    """
+    Reescribe el historial de un tramo de productos como intervalos de precio: las
+    filas seguidas con el mismo importe y disponibilidad se funden en la primera, cuyo
+    last_seen_at pasa a ser la última vez que se vio ese precio. El intervalo abierto
+    de cada producto se alarga hasta su última comprobación.
+
+    Args:
+        first_id (int): Primer ID de producto del tramo.
+        last_id (int): Último ID de producto del tramo (incluido).
+
+    Returns:
+        int: Filas eliminadas.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            WITH ordered AS (
+                SELECT id, product_id, valid_from, COALESCE(last_seen_at, valid_from) AS seen,
+                       (amount, status) IS DISTINCT FROM (LAG(amount) OVER w, LAG(status) OVER w) AS starts
+                FROM price_history
+                WHERE product_id BETWEEN %(first)s AND %(last)s
+                WINDOW w AS (PARTITION BY product_id ORDER BY valid_from, id)
+            ),
+            runs AS (
+                SELECT id, product_id, valid_from, seen,
+                       COUNT(*) FILTER (WHERE starts) OVER (PARTITION BY product_id ORDER BY valid_from, id) AS run
+                FROM ordered
+            ),
+            spans AS (
+                SELECT product_id, run, (array_agg(id ORDER BY valid_from, id))[1] AS keep_id,
+                       MIN(valid_from) AS keep_from, MAX(seen) AS last_seen_at
+                FROM runs
+                GROUP BY product_id, run
+            ),
+            extended AS (
+                UPDATE price_history h SET last_seen_at = s.last_seen_at
+                FROM spans s
+                WHERE h.id = s.keep_id AND h.valid_from = s.keep_from
+                  AND h.last_seen_at IS DISTINCT FROM s.last_seen_at
+            )
+            DELETE FROM price_history h
+            USING runs r
+            JOIN spans s ON s.product_id = r.product_id AND s.run = r.run
+            WHERE h.id = r.id AND h.valid_from = r.valid_from AND r.id <> s.keep_id
+            """, {"first": first_id, "last": last_id})
+            deleted = cursor.rowcount
+            # El intervalo abierto es el último que queda; se alarga hasta la última comprobación
+            cursor.execute("""
+            UPDATE products p SET price_since = h.valid_from
+            FROM (
+                SELECT DISTINCT ON (product_id) product_id, valid_from
+                FROM price_history
+                WHERE product_id BETWEEN %(first)s AND %(last)s
+                ORDER BY product_id, valid_from DESC
+            ) h
+            WHERE p.id = h.product_id AND p.price_since IS DISTINCT FROM h.valid_from
+            """, {"first": first_id, "last": last_id})
+            cursor.execute("""
+            UPDATE price_history h SET last_seen_at = p.last_checked_at
+            FROM products p
+            WHERE p.id BETWEEN %(first)s AND %(last)s
+              AND h.product_id = p.id AND h.valid_from = p.price_since
+              AND p.last_checked_at > COALESCE(h.last_seen_at, h.valid_from)
+            """, {"first": first_id, "last": last_id})
+            logger.info(f"Historial compactado para productos {first_id}-{last_id}: {deleted} filas eliminadas")
+            return deleted
+
+def ensure_history_partitions(cursor, months_ahead=HISTORY_PARTITIONS_AHEAD):
+    """
+    Crea las particiones de price_history del mes en curso y de los `months_ahead` siguientes.
+    Se llama al arrancar (init_db), desde la tarea de retención y periódicamente desde
+    los workers (refresh_history_partitions).
+
+    Returns:
+        list: Nombres de las particiones creadas.
+    """
+    cursor.execute("SELECT LOCALTIMESTAMP AS now")
+    current = month_start(cursor.fetchone()["now"])
+    return create_history_partitions(cursor, current, add_months(current, months_ahead))
+
+@handle_db_errors
+def refresh_history_partitions():
+    """
+    Crea las particiones de price_history que falten, en su propia transacción, para que
+    un proceso que lleva meses en marcha no acabe escribiendo en la partición por defecto.
+    Si otro proceso está migrando o creando particiones en ese momento, no hace nada.
+
+    Returns:
+        list: Nombres de las particiones creadas.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (MIGRATIONS_LOCK_ID,))
+            if not cursor.fetchone()["locked"]:
+                return []
+            return ensure_history_partitions(cursor)
+
+def _history_partitions(cursor):
+    """
+    Devuelve las particiones mensuales de price_history, de la más antigua a la más reciente.
+
+    Returns:
+        list: Tuplas (nombre, primer día del mes).
+    """
+    cursor.execute("""
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'price_history'::regclass
+    """)
+    partitions = []
+    for row in cursor.fetchall():
+        match = re.fullmatch(r"price_history_p(\d{4})(\d{2})", row["relname"])
+        if match:
+            partitions.append((row["relname"], date(int(match[1]), int(match[2]), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+def _roll_up_partition(cursor, partition):
+    """
+    Rellena los resúmenes por hora y día con los intervalos de una partición, solo en
+    los periodos que aún no tienen resumen (los ya escritos por _roll_up se respetan).
+    Cada intervalo cuenta en el periodo en que empieza.
+    """
+    for table, unit, _ in ROLLUPS:
+        cursor.execute(f"""
+        INSERT INTO {table} (product_id, bucket, currency, open, low, high, close, samples)
+        SELECT h.product_id, date_trunc('{unit}', h.valid_from),
+               (array_agg(h.currency ORDER BY h.valid_from DESC))[1],
+               (array_agg(h.amount ORDER BY h.valid_from))[1],
+               MIN(h.amount), MAX(h.amount),
+               (array_agg(h.amount ORDER BY h.valid_from DESC))[1],
+               COUNT(*)
+        FROM {partition} h
+        JOIN products p ON p.id = h.product_id
+        WHERE h.amount IS NOT NULL
+        GROUP BY h.product_id, date_trunc('{unit}', h.valid_from)
+        ON CONFLICT (product_id, bucket) DO NOTHING
+        """)
+
+def _carry_open_intervals(cursor, partition, horizon):
+    """
+    Copia al horizonte de retención los intervalos abiertos (el precio vigente de cada
+    producto) que empiezan en una partición a punto de eliminarse, para que un producto
+    con el mismo precio desde hace años no pierda su precio actual.
+
+    Returns:
+        int: Intervalos trasladados.
+    """
+    cursor.execute(f"""
+    WITH open_intervals AS (
+        SELECT h.product_id, h.last_seen_at, h.amount, h.currency, h.status
+        FROM {partition} h
+        JOIN products p ON p.id = h.product_id AND p.price_since = h.valid_from
+    ),
+    moved AS (
+        INSERT INTO price_history (product_id, valid_from, last_seen_at, amount, currency, status)
+        SELECT product_id, %(horizon)s, GREATEST(last_seen_at, %(horizon)s), amount, currency, status
+        FROM open_intervals
+    )
+    UPDATE products p SET price_since = %(horizon)s
+    FROM open_intervals o
+    WHERE p.id = o.product_id
+    """, {"horizon": horizon})
+    return cursor.rowcount
+
+@handle_db_errors
+def apply_history_retention(months, drop=False, roll_up=True):
+    """
+    Elimina del historial detallado los meses anteriores a la ventana de retención.
+
+    Cada partición caducada se resume primero en price_history_hourly/daily (si
+    `roll_up`), su intervalo abierto se traslada al inicio de la ventana y después se
+    desengancha de price_history (DETACH PARTITION) o se borra. Desenganchada, la tabla
+    sigue existiendo para archivarla (pg_dump) antes de borrarla a mano. Cada partición
+    se procesa en su propia transacción. También se eliminan las filas caducadas que
+    hubieran ido a parar a la partición por defecto.
+
+    Args:
+        months (int): Meses completos de historial detallado que se conservan, además del actual.
+        drop (bool): Borrar las particiones en lugar de solo desengancharlas.
+        roll_up (bool): Resumir las particiones antes de eliminarlas.
+
+    Returns:
+        list: Nombres de las particiones eliminadas del historial.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            ensure_history_partitions(cursor)
+            cursor.execute("SELECT LOCALTIMESTAMP AS now")
+            horizon = add_months(month_start(cursor.fetchone()["now"]), -months)
+            create_history_partitions(cursor, horizon, horizon)
+            expired = [name for name, month in _history_partitions(cursor) if add_months(month, 1) <= horizon]
+
+    removed = []
+    for partition in expired:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                if roll_up:
+                    _roll_up_partition(cursor, partition)
+                carried = _carry_open_intervals(cursor, partition, horizon)
+                cursor.execute(f"ALTER TABLE price_history DETACH PARTITION {partition}")
+                if drop:
+                    cursor.execute(f"DROP TABLE {partition}")
+                logger.info(
+                    f"Partición {partition} {'borrada' if drop else 'desenganchada'} del historial "
+                    f"({carried} intervalos abiertos trasladados a {horizon})"
+                )
+                removed.append(partition)
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM price_history_default WHERE valid_from < %s) AS stale
+            """, (horizon,))
+            if cursor.fetchone()["stale"]:
+                cursor.execute("""
+                CREATE TEMP TABLE price_history_stale ON COMMIT DROP AS
+                SELECT * FROM price_history_default WHERE valid_from < %s
+                """, (horizon,))
+                if roll_up:
+                    _roll_up_partition(cursor, "price_history_stale")
+                _carry_open_intervals(cursor, "price_history_stale", horizon)
+                cursor.execute("DELETE FROM price_history_default WHERE valid_from < %s", (horizon,))
+                logger.info(f"Eliminadas {cursor.rowcount} filas caducadas de price_history_default")
+    return removed
+
 @handle_db_errors
 def get_price_history(chat_id, url):
     """
@@ -226,21 +796,130 @@ def get_price_history(chat_id, url):
         url (str): URL del producto.
 
     Returns:
-        list: Lista de historial de precios con fecha y precio.
+        list: Intervalos de precio con ID del producto, fecha de inicio (timestamp), última
+        comprobación con ese precio (last_seen_at), importe y moneda. Los periodos sin
+        precio disponible se omiten.
     """
     with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("""
-            SELECT ph.timestamp, ph.price
+            SELECT ph.product_id, ph.valid_from AS timestamp, COALESCE(ph.last_seen_at, ph.valid_from) AS last_seen_at,
+                   ph.amount, ph.currency
             FROM price_history ph
             JOIN products p ON ph.product_id = p.id
-            WHERE p.chat_id = %s AND p.url = %s
-            ORDER BY ph.timestamp ASC
+            WHERE p.chat_id = %s AND p.url = %s AND ph.amount IS NOT NULL
+            ORDER BY ph.valid_from ASC
             """, (chat_id, url))
             history = cursor.fetchall()
-            logger.info(f"Historial de precios obtenido para chat_id {chat_id}, URL {url}: {history}")
+            logger.info(f"Historial de precios obtenido para chat_id {chat_id}, URL {url}: {len(history)} intervalos")
             return history
 
+def _series_source(span_seconds, points):
+    """
+    Elige de dónde leer una serie: el resumen más grueso cuyo periodo no supera el
+    ancho de cada punto, o el historial sin resumir para rangos cortos. Así el número
+    de filas leídas depende del rango y de los puntos pedidos, no de la antigüedad del producto.
+
+    Returns:
+        tuple: (tabla, unidad de date_trunc), o (None, None) para el historial sin resumir.
+    """
+    seconds_per_point = span_seconds / max(points, 1)
+    for table, unit, period in ROLLUPS:
+        if seconds_per_point >= period:
+            return table, unit
+    return None, None
+
+@handle_db_errors
+def get_price_series(chat_id, url, start=None, end=None, points=SERIES_POINTS):
+    """
+    Obtiene la serie de precios de un producto reducida a unos `points` puntos, para
+    gráficas y estadísticas.
+
+    El rango se divide en `points` tramos iguales y de cada uno se devuelve el mínimo,
+    el máximo y el último precio (min/max bucketing): a diferencia de un muestreo,
+    conserva las bajadas puntuales, que es lo que interesa ver. Los tramos se calculan
+    en PostgreSQL sobre los resúmenes por día u hora según el ancho de cada tramo.
+
+    En rangos cortos se lee price_history, que guarda un intervalo por precio: se toman
+    los intervalos que se solapan con el rango (también el vigente en `start`), recortados
+    a él. Con cualquier fuente, el último precio se prolonga con un punto final hasta la
+    última vez que se vio dentro del rango, en lugar de terminar en el último cambio.
+
+    Args:
+        chat_id (int): ID del chat de Telegram.
+        url (str): URL del producto.
+        start (datetime, optional): Inicio del rango. Por defecto, el primer precio registrado.
+        end (datetime, optional): Fin del rango. Por defecto, la última comprobación: así la
+            serie solo cambia cuando se registra un precio (ver ChartCache).
+        points (int): Número de tramos.
+
+    Returns:
+        list: Puntos con product_id, timestamp (inicio del tramo con datos), amount (último precio),
+        low, high, currency y checked_at (última comprobación del producto, igual en todos), en
+        orden cronológico. Lista vacía si no hay precios en el rango.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            SELECT p.id, LOCALTIMESTAMP AS now, COALESCE(p.last_checked_at, p.price_since) AS checked_at,
+                   (SELECT MIN(valid_from) FROM price_history WHERE product_id = p.id) AS first_at
+            FROM products p
+            WHERE p.chat_id = %s AND p.url = %s
+            """, (chat_id, url))
+            product = cursor.fetchone()
+            if product is None or product["first_at"] is None:
+                return []
+            start = start or product["first_at"]
+            end = end or product["checked_at"] or product["now"]
+            table, unit = _series_source((end - start).total_seconds(), points)
+            if table is None:
+                source = """
+                SELECT GREATEST(valid_from, %(start)s) AS ts, COALESCE(last_seen_at, valid_from) AS seen,
+                       amount AS low, amount AS high, amount AS close, currency
+                FROM price_history
+                WHERE product_id = %(product_id)s AND valid_from <= %(end)s
+                  AND COALESCE(last_seen_at, valid_from) >= %(start)s AND amount IS NOT NULL
+                """
+            else:
+                source = f"""
+                SELECT bucket AS ts, bucket + INTERVAL '1 {unit}' AS seen, low, high, close, currency
+                FROM {table}
+                WHERE product_id = %(product_id)s AND bucket BETWEEN date_trunc('{unit}', %(start)s::TIMESTAMP) AND %(end)s
+                """
+            cursor.execute(f"""
+            WITH src AS ({source}),
+            bucketed AS (
+                SELECT width_bucket(EXTRACT(EPOCH FROM ts),
+                                    EXTRACT(EPOCH FROM date_trunc(COALESCE(%(unit)s, 'second'), %(start)s::TIMESTAMP)),
+                                    EXTRACT(EPOCH FROM %(end)s::TIMESTAMP) + 1, %(points)s) AS n,
+                       ts, seen, low, high, close, currency
+                FROM src
+            ),
+            series AS (
+                SELECT n, MIN(ts) AS ts, LEAST(MAX(seen), %(end)s) AS seen, MIN(low) AS low, MAX(high) AS high,
+                       (array_agg(close ORDER BY ts DESC))[1] AS amount,
+                       (array_agg(currency ORDER BY ts DESC))[1] AS currency
+                FROM bucketed
+                GROUP BY n
+            ),
+            last_seen AS (
+                -- El último precio se mantiene hasta la última vez que se vio
+                SELECT n + 1 AS n, seen AS ts, seen, amount AS low, amount AS high, amount, currency
+                FROM (SELECT * FROM series ORDER BY n DESC LIMIT 1) last_point
+                WHERE seen > ts
+            )
+            SELECT %(product_id)s AS product_id, %(checked_at)s AS checked_at, ts AS timestamp, low, high, amount, currency
+            FROM (SELECT * FROM series UNION ALL SELECT * FROM last_seen) points
+            ORDER BY n
+            """, {"product_id": product["id"], "checked_at": product["checked_at"], "start": start, "end": end,
+                  "points": points, "unit": unit})
+            series = cursor.fetchall()
+            logger.info(
+                f"Serie de precios para chat_id {chat_id}, URL {url}: {len(series)} puntos "
+                f"desde {table or 'price_history'}"
+            )
+            return series
+
 @handle_db_errors
 def get_last_price(product_id):
     """
@@ -250,7 +929,7 @@ def get_last_price(product_id):
         product_id (int): ID del producto.
 
     Returns:
-        str: Último precio registrado, o None si no existe.
+        dict: Último precio (last_price, currency, availability), o None si nunca se ha comprobado.
     """
     if not isinstance(product_id, int):
         logger.error(f"ID de producto inválido: {product_id}")
@@ -259,37 +938,336 @@ def get_last_price(product_id):
     with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("""
-            SELECT price
-            FROM price_history
-            WHERE product_id = %s
-            ORDER BY timestamp DESC
-            LIMIT 1
+            SELECT last_price, currency, availability
+            FROM products
+            WHERE id = %s AND last_checked_at IS NOT NULL
             """, (product_id,))
             result = cursor.fetchone()
             if result:
-                logger.info(f"Último precio para producto ID {product_id}: {result['price']}")
-                return result["price"]
+                logger.info(f"Último precio para producto ID {product_id}: {result['last_price']}")
+                return result
             else:
                 logger.warning(f"No se encontró historial de precios para producto ID {product_id}")
                 return None
 
 @handle_db_errors
-def get_all_products():
+def get_last_prices(product_ids):
     """
-    Obtiene todos los productos de la base de datos.
+    Obtiene el último precio registrado de un conjunto de productos en una sola consulta.
+
+    Args:
+        product_ids (list): IDs de los productos.
 
     Returns:
-        list: Lista de productos con ID, chat_id, URL y nombre.
+        dict: product_id -> último precio (last_price, currency, availability). Los productos nunca comprobados no aparecen.
     """
+    if not product_ids:
+        return {}
+
     with get_connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("""
-            SELECT id, chat_id, url, name FROM products
-            """)
+            SELECT id, last_price, currency, availability
+            FROM products
+            WHERE id = ANY(%s) AND last_checked_at IS NOT NULL
+            """, (list(product_ids),))
+            last_prices = {row["id"]: row for row in cursor.fetchall()}
+            logger.debug(f"Últimos precios obtenidos para {len(last_prices)} de {len(product_ids)} productos")
+            return last_prices
+
+@handle_db_errors
+def get_user_state(chat_id):
+    """
+    Obtiene el estado de la conversación de un chat si no ha caducado.
+
+    Args:
+        chat_id (int): ID del chat de Telegram.
+
+    Returns:
+        dict: Estado guardado, o None si no hay ninguno vigente.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT state FROM user_states WHERE chat_id = %s AND expires_at > LOCALTIMESTAMP",
+                (chat_id,)
+            )
+            row = cursor.fetchone()
+            return row["state"] if row else None
+
+@handle_db_errors
+def set_user_state(chat_id, state, ttl):
+    """
+    Guarda (o reemplaza) el estado de la conversación de un chat.
+
+    Args:
+        chat_id (int): ID del chat de Telegram.
+        state (dict): Estado serializable a JSON.
+        ttl (float): Segundos hasta que caduca.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            INSERT INTO user_states (chat_id, state, expires_at)
+            VALUES (%s, %s, LOCALTIMESTAMP + %s * INTERVAL '1 second')
+            ON CONFLICT (chat_id) DO UPDATE SET state = EXCLUDED.state, expires_at = EXCLUDED.expires_at
+            """, (chat_id, Json(state), ttl))
+
+@handle_db_errors
+def pop_user_state(chat_id):
+    """
+    Elimina el estado de la conversación de un chat y lo devuelve, de forma atómica:
+    si dos réplicas reciben el mismo mensaje, solo una obtiene el estado.
+
+    Args:
+        chat_id (int): ID del chat de Telegram.
+
+    Returns:
+        dict: Estado que había, o None si no había ninguno vigente.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            DELETE FROM user_states WHERE chat_id = %s
+            RETURNING state, expires_at > LOCALTIMESTAMP AS fresh
+            """, (chat_id,))
+            row = cursor.fetchone()
+            return row["state"] if row and row["fresh"] else None
+
+@handle_db_errors
+def purge_user_states():
+    """
+    Borra los estados de conversación caducados.
+
+    Returns:
+        int: Número de estados borrados.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM user_states WHERE expires_at <= LOCALTIMESTAMP")
+            logger.info(f"Estados de conversación caducados borrados: {cursor.rowcount}")
+            return cursor.rowcount
+
+class ProductRow:
+    """
+    Suscripción del recorrido del catálogo. Con __slots__ ocupa bastante menos que un
+    dict por fila y sigue admitiendo row["id"], como las filas de RealDictCursor.
+    """
+    __slots__ = ("id", "chat_id", "url", "name", "target_url")
+
+    def __init__(self, id, chat_id, url, name, target_url):
+        self.id = id
+        self.chat_id = chat_id
+        self.url = url
+        self.name = name
+        self.target_url = target_url
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __repr__(self):
+        return f"ProductRow(id={self.id}, chat_id={self.chat_id}, url={self.url!r})"
+
+@handle_db_errors
+def get_products_page(after=None, limit=PRODUCT_SCAN_PAGE):
+    """
+    Obtiene una página del catálogo ordenada por (target_url, id).
+
+    Las filas llegan de un cursor del servidor DB_FETCH_SIZE en cada viaje y se
+    guardan como ProductRow, sin pasar por una lista de dicts.
+
+    Args:
+        after (tuple, optional): (target_url, id) de la última fila de la página anterior.
+        limit (int): Filas por página.
+
+    Returns:
+        list: Lista de ProductRow.
+    """
+    with get_connection() as conn:
+        with conn.cursor(name="get_products_page") as cursor:
+            cursor.itersize = DB_FETCH_SIZE
+            if after is None:
+                cursor.execute("""
+                SELECT id, chat_id, url, name, target_url FROM products
+                ORDER BY target_url, id
+                LIMIT %s
+                """, (limit,))
+            else:
+                cursor.execute("""
+                SELECT id, chat_id, url, name, target_url FROM products
+                WHERE (target_url, id) > (%s, %s)
+                ORDER BY target_url, id
+                LIMIT %s
+                """, (*after, limit))
+            return [ProductRow(**row) for row in cursor]
+
+def get_all_products(page_size=PRODUCT_SCAN_PAGE):
+    """
+    Recorre todos los productos de la base de datos, página a página.
+
+    Es un generador: quien lo consume empieza a trabajar con la primera página y la
+    memoria no crece con el tamaño del catálogo. Las suscripciones a un mismo producto
+    (misma target_url) llegan seguidas. Si falla una consulta, el error queda registrado
+    y el recorrido termina.
+
+    Args:
+        page_size (int): Filas por consulta.
+
+    Yields:
+        ProductRow: ID, chat_id, URL, nombre y URL canónica de cada suscripción.
+    """
+    after = None
+    total = 0
+    while True:
+        page = get_products_page(after, page_size)
+        if page is None:
+            logger.error(f"Recorrido del catálogo interrumpido tras {total} productos")
+            return
+        yield from page
+        total += len(page)
+        if len(page) < page_size:
+            break
+        after = (page[-1].target_url, page[-1].id)
+    logger.info(f"Todos los productos recorridos: {total}")
+
+@handle_db_errors
+def claim_scrape_targets(owner, limit, lease_seconds, min_interval, fill_budget, budget_rate, budget_capacity):
+    """
+    Reserva para un worker los productos que toca descargar.
+
+    Las filas se bloquean con FOR UPDATE SKIP LOCKED, de modo que varios workers
+    (procesos o máquinas) pueden pedir trabajo a la vez sin recibir el mismo producto.
+    Cada producto reservado queda con un lease: si el worker no lo completa antes de
+    que expire (se ha caído, por ejemplo), otro worker puede volver a reservarlo.
+
+    El número de productos está limitado por el presupuesto global de descargas
+    (fila única de fetch_budget, un token bucket que se rellena a budget_rate por segundo).
+
+    Args:
+        owner (str): Identificador del worker.
+        limit (int): Número máximo de productos a reservar.
+        lease_seconds (float): Duración del lease.
+        min_interval (float): Segundos mínimos entre dos descargas de un producto (con fill_budget).
+        fill_budget (bool): Adelantar productos aún no vencidos si sobra presupuesto.
+        budget_rate (float): Descargas por segundo del presupuesto global.
+        budget_capacity (float): Descargas acumulables como máximo en el presupuesto.
+
+    Returns:
+        list: Filas de scrape_targets reservadas, con db_now (instante de la base de datos en segundos epoch).
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            WITH budget AS (
+                SELECT LEAST(%(capacity)s, tokens + EXTRACT(EPOCH FROM now() - updated_at) * %(rate)s) AS available
+                FROM fetch_budget
+                WHERE id = 1
+                FOR UPDATE
+            ),
+            ready AS (
+                SELECT url FROM scrape_targets
+                WHERE (lease_expires_at IS NULL OR lease_expires_at < now())
+                  AND (next_due_at <= now()
+                       OR (%(fill)s AND (taken_at IS NULL OR taken_at <= now() - make_interval(secs => %(min_interval)s))))
+                ORDER BY next_due_at
+                LIMIT (SELECT GREATEST(LEAST(%(limit)s, floor(available)), 0)::INTEGER FROM budget)
+                FOR UPDATE SKIP LOCKED
+            ),
+            spent AS (
+                UPDATE fetch_budget
+                SET tokens = (SELECT available FROM budget) - (SELECT COUNT(*) FROM ready), updated_at = now()
+                WHERE id = 1
+            )
+            UPDATE scrape_targets t
+            SET lease_owner = %(owner)s,
+                lease_expires_at = now() + make_interval(secs => %(lease)s),
+                taken_at = now()
+            FROM ready
+            WHERE t.url = ready.url
+            RETURNING t.*, EXTRACT(EPOCH FROM now())::DOUBLE PRECISION AS db_now
+            """, {
+                "owner": owner, "limit": limit, "lease": lease_seconds, "min_interval": min_interval,
+                "fill": fill_budget, "rate": budget_rate, "capacity": budget_capacity,
+            })
+            targets = cursor.fetchall()
+            logger.info(f"Worker {owner}: {len(targets)} productos reservados")
+            return targets
+
+@handle_db_errors
+def get_target_subscribers(urls):
+    """
+    Obtiene las suscripciones de un conjunto de productos a descargar.
+
+    Args:
+        urls (list): URLs canónicas (scrape_targets.url).
+
+    Returns:
+        list: Productos con ID, chat_id, URL, nombre y URL canónica.
+    """
+    if not urls:
+        return []
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            SELECT id, chat_id, url, name, target_url FROM products WHERE target_url = ANY(%s)
+            """, (list(urls),))
             products = cursor.fetchall()
-            logger.info(f"Todos los productos obtenidos: {products}")
+            logger.info(f"Suscripciones obtenidas para {len(urls)} productos: {len(products)}")
             return products
 
+@handle_db_errors
+def complete_scrape_targets(owner, updates, orphans=()):
+    """
+    Libera los productos reservados por un worker con su nueva planificación.
+
+    Solo se actualizan las filas cuyo lease sigue siendo de este worker: si expiró y
+    otro worker lo reservó, la planificación de ese otro worker prevalece.
+
+    Args:
+        owner (str): Identificador del worker.
+        updates (list): Tuplas (url, próxima comprobación en segundos epoch, cambios,
+            horas observadas, último cambio, última comprobación, último importe,
+            última disponibilidad, intervalo, fallos seguidos).
+        orphans (list): URLs reservadas que ya no tienen suscriptores; se eliminan.
+    """
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            if updates:
+                completed = execute_values(cursor, """
+                UPDATE scrape_targets t SET
+                    next_due_at = to_timestamp(u.next_due_at),
+                    changes = u.changes,
+                    observed_hours = u.observed_hours,
+                    last_change_at = u.last_change_at,
+                    last_checked_at = u.last_checked_at,
+                    last_amount = u.last_amount,
+                    last_status = u.last_status,
+                    refresh_interval = u.refresh_interval,
+                    failures = u.failures,
+                    lease_owner = NULL,
+                    lease_expires_at = NULL
+                FROM (VALUES %s) AS u (owner, url, next_due_at, changes, observed_hours, last_change_at,
+                                       last_checked_at, last_amount, last_status, refresh_interval, failures)
+                WHERE t.url = u.url AND t.lease_owner = u.owner
+                RETURNING t.url
+                """, [(owner, *update) for update in updates],
+                    template="(%s, %s, %s::DOUBLE PRECISION, %s::DOUBLE PRECISION, %s::DOUBLE PRECISION, "
+                             "%s::DOUBLE PRECISION, %s::DOUBLE PRECISION, %s::NUMERIC, %s::TEXT, "
+                             "%s::DOUBLE PRECISION, %s::INTEGER)",
+                    page_size=1000, fetch=True)
+                if len(completed) < len(updates):
+                    logger.warning(f"Worker {owner}: {len(updates) - len(completed)} leases expirados antes de completarse")
+            if orphans:
+                cursor.execute("""
+                DELETE FROM scrape_targets t
+                WHERE t.url = ANY(%s) AND NOT EXISTS (SELECT 1 FROM products p WHERE p.target_url = t.url)
+                """, (list(orphans),))
+            logger.info(f"Worker {owner}: {len(updates)} productos replanificados, {len(orphans)} sin suscriptores")
+
 @handle_db_errors
 def get_product_id(chat_id, url):
     """
@@ -0,0 +1,58 @@
+# executors.py
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from logger import config_logger
+from metrics import HANDLER_SECONDS
+
+logger = config_logger()
+
+# Hilos por tipo de trabajo bloqueante. Cada tipo tiene su propio límite para que,
+# por ejemplo, una avalancha de /add no deje sin hilos a las consultas a la base de datos.
+EXECUTOR_LIMITS = {
+    "scrape": int(os.getenv("SCRAPE_WORKERS", 8)),   # Descargas de Amazon (red + reintentos)
+    "db": int(os.getenv("DB_WORKERS", 10)),           # Consultas psycopg2; no tiene sentido superar DB_POOL_MAX
+    "render": int(os.getenv("RENDER_WORKERS", min(os.cpu_count() or 1, 4))),  # Gráficas (charts.py, sin estado global)
+}
+
+_executors = {}
+
+
+def get_executor(kind: str) -> ThreadPoolExecutor:
+    """
+    Devuelve el ejecutor acotado para un tipo de trabajo ("scrape", "db" o "render").
+    """
+    executor = _executors.get(kind)
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=EXECUTOR_LIMITS[kind], thread_name_prefix=kind)
+        _executors[kind] = executor
+    return executor
+
+
+async def run_blocking(kind: str, func, *args, **kwargs):
+    """
+    Ejecuta una función bloqueante en el ejecutor de su tipo sin bloquear el event loop.
+
+    Args:
+        kind (str): Tipo de trabajo: "scrape", "db" o "render".
+        func (callable): Función bloqueante.
+
+    Returns:
+        El valor devuelto por la función.
+    """
+    loop = asyncio.get_running_loop()
+    # La duración incluye la espera por un hilo libre: es la que nota el usuario
+    with HANDLER_SECONDS.time(kind=kind):
+        return await loop.run_in_executor(get_executor(kind), partial(func, *args, **kwargs))
+
+
+def shutdown_executors(wait: bool = True):
+    """
+    Detiene todos los ejecutores.
+    """
+    for executor in _executors.values():
+        executor.shutdown(wait=wait)
+    _executors.clear()
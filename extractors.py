@@ -0,0 +1,347 @@
+# extractors.py
+
+import re
+from collections import namedtuple
+from urllib.parse import urlparse
+
+import lxml.html
+from bs4 import BeautifulSoup
+from lxml import etree
+
+from logger import config_logger
+from utils import currency_from_symbol, parse_amount, parse_price_text
+
+logger = config_logger()
+
+ProductFields = namedtuple("ProductFields", ["title", "amount", "currency"])
+ProductFields.__doc__ = "Campos extraídos de una página de producto; los que no aparecen son None."
+
+EMPTY_FIELDS = ProductFields(None, None, None)
+
+# Contenedores del precio principal en las distintas plantillas de Amazon. El precio
+# completo está en un span.a-offscreen (texto para lectores de pantalla).
+CORE_PRICE_CONTAINERS = (
+    "corePrice_feature_div",
+    "corePriceDisplay_desktop_feature_div",
+    "corePrice_desktop",
+    "apex_desktop",
+)
+# Plantilla antigua: el precio completo en un span con id propio
+PRICEBLOCK_IDS = (
+    "priceblock_ourprice",
+    "priceblock_dealprice",
+    "priceblock_saleprice",
+)
+
+
+def _class_test(name: str) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+def _clean(text: str) -> str:
+    return " ".join(text.split()) if text else ""
+
+
+class LxmlExtractor:
+    """
+    Extractor rápido: parser HTML de lxml y una expresión XPath precompilada que
+    recoge todos los elementos candidatos (título, bloques de precio y spans a-price*),
+    sin construir el árbol de BeautifulSoup. Recorrer el árbol de una página de 1-2 MB
+    es lo que cuesta, así que se recorre lo mínimo y los candidatos se clasifican
+    después en Python.
+    """
+    name = "lxml"
+
+    # El filtro [@id] descarta enseguida la gran mayoría de elementos, que no tienen id;
+    # con todas las condiciones en un único predicado la consulta es cuatro veces más lenta
+    CANDIDATES = etree.XPath(
+        "//*[@id][" + " or ".join(
+            f"@id='{element_id}'" for element_id in ("productTitle",) + CORE_PRICE_CONTAINERS + PRICEBLOCK_IDS
+        ) + "] | //span[contains(@class, 'a-price')]"
+    )
+    OFFSCREEN = etree.XPath(f".//span[{_class_test('a-offscreen')}]")
+
+    def extract(self, html) -> ProductFields:
+        try:
+            root = lxml.html.fromstring(html)
+        except (etree.ParserError, ValueError) as e:
+            logger.warning(f"lxml no pudo procesar la página: {e}")
+            return EMPTY_FIELDS
+        return self.extract_tree(root)
+
+    def extract_tree(self, root) -> ProductFields:
+        """Extrae los campos de un árbol lxml ya construido (completo o parcial)."""
+        title = None
+        containers, priceblocks, offscreen_parents = [], [], []
+        whole = fraction = symbol = None
+        for element in self.CANDIDATES(root):
+            element_id = element.get("id")
+            classes = (element.get("class") or "").split()
+            if element_id == "productTitle":
+                title = title or _clean(element.text_content())
+            elif element_id in CORE_PRICE_CONTAINERS:
+                containers.append(element)
+            elif element_id in PRICEBLOCK_IDS:
+                priceblocks.append(element)
+            if "a-price" in classes:
+                offscreen_parents.append(element)
+            elif "a-price-whole" in classes and whole is None:
+                whole = element.text_content()
+            elif "a-price-fraction" in classes and fraction is None:
+                fraction = element.text_content()
+            elif "a-price-symbol" in classes and symbol is None:
+                symbol = element.text_content()
+
+        # Mismo orden de preferencia que SoupExtractor
+        full_prices = [span for container in containers for span in self.OFFSCREEN(container)] + priceblocks
+        for element in full_prices:
+            amount, currency = parse_price_text(element.text_content())
+            if amount is not None:
+                return ProductFields(title or None, amount, currency)
+
+        amount = parse_amount(whole, fraction) if whole is not None and fraction is not None else None
+        if amount is not None:
+            return ProductFields(title or None, amount, currency_from_symbol(symbol or ""))
+
+        for parent in offscreen_parents:
+            for element in parent.iterchildren("span"):
+                if "a-offscreen" in (element.get("class") or "").split():
+                    amount, currency = parse_price_text(element.text_content())
+                    if amount is not None:
+                        return ProductFields(title or None, amount, currency)
+
+        return ProductFields(title or None, None, None)
+
+
+class SoupExtractor:
+    """
+    Extractor de respaldo con BeautifulSoup: más lento, pero tolera HTML que el
+    extractor rápido no interpreta bien.
+    """
+    name = "beautifulsoup"
+
+    CORE_PRICE = ", ".join(f"#{container} span.a-offscreen" for container in CORE_PRICE_CONTAINERS)
+    PRICEBLOCK = ", ".join(f"span#{block}" for block in PRICEBLOCK_IDS)
+
+    def extract(self, html) -> ProductFields:
+        soup = BeautifulSoup(html, "lxml")
+
+        title_element = soup.find("span", id="productTitle")
+        title = _clean(title_element.get_text()) if title_element else None
+
+        for selector in (self.CORE_PRICE, self.PRICEBLOCK):
+            for element in soup.select(selector):
+                amount, currency = parse_price_text(element.get_text())
+                if amount is not None:
+                    return ProductFields(title or None, amount, currency)
+
+        whole = soup.select_one("span.a-price-whole")
+        fraction = soup.select_one("span.a-price-fraction")
+        amount = parse_amount(whole.get_text(), fraction.get_text()) if whole and fraction else None
+        if amount is not None:
+            symbol = soup.select_one("span.a-price-symbol")
+            return ProductFields(title or None, amount, currency_from_symbol(symbol.get_text() if symbol else ""))
+
+        for element in soup.select("span.a-price > span.a-offscreen"):
+            amount, currency = parse_price_text(element.get_text())
+            if amount is not None:
+                return ProductFields(title or None, amount, currency)
+
+        return ProductFields(title or None, None, None)
+
+
+class IncrementalExtractor:
+    """
+    Extractor para descargas por bloques: alimenta un parser incremental de lxml y
+    avisa en cuanto ha visto el título y un precio completo (bloque corePrice/apex o
+    priceblock), para poder cortar la descarga sin leer el resto de la página.
+
+    Si la página termina sin haberlos encontrado (plantillas solo con a-price-whole,
+    productos no disponibles...), close() aplica la misma extracción que la
+    descarga completa sobre el árbol ya construido.
+    """
+
+    def __init__(self, encoding: str = None):
+        self._parser = etree.HTMLPullParser(events=("end",), tag=("span", "div"), encoding=encoding)
+        # Elementos de lxml.html (con text_content), como los de lxml.html.fromstring
+        self._parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+        self._chunks = []
+        self._title = None
+        self._price = None
+        self.done = False
+        self.bytes_read = 0
+
+    def feed(self, chunk: bytes) -> bool:
+        """
+        Procesa un bloque del cuerpo de la respuesta.
+
+        Returns:
+            bool: True si ya se tienen título y precio y se puede cortar la descarga.
+        """
+        self._chunks.append(chunk)
+        self.bytes_read += len(chunk)
+        self._parser.feed(chunk)
+        for _, element in self._parser.read_events():
+            element_id = element.get("id")
+            if element_id == "productTitle":
+                self._title = self._title or _clean(element.text_content()) or None
+                continue
+            if self._price is not None:
+                continue
+            if element_id in CORE_PRICE_CONTAINERS:
+                candidates = LxmlExtractor.OFFSCREEN(element)
+            elif element_id in PRICEBLOCK_IDS:
+                candidates = [element]
+            else:
+                continue
+            for candidate in candidates:
+                amount, currency = parse_price_text(candidate.text_content())
+                if amount is not None:
+                    self._price = (amount, currency)
+                    break
+        self.done = bool(self._title and self._price)
+        return self.done
+
+    def close(self) -> ProductFields:
+        """Termina el parseo y devuelve los campos encontrados."""
+        try:
+            root = self._parser.close()
+        except etree.XMLSyntaxError:
+            root = None
+        if self.done:
+            return ProductFields(self._title, *self._price)
+
+        fields = LxmlExtractor().extract_tree(root) if root is not None else EMPTY_FIELDS
+        if fields.title:
+            return fields
+        # Página no reconocida: el resto de la cadena con el HTML completo
+        fallback = [extractor for extractor in EXTRACTORS if not isinstance(extractor, LxmlExtractor)]
+        return extract_product(b"".join(self._chunks), extractors=fallback)
+
+
+# Cadena de extractores, del más rápido al más tolerante
+EXTRACTORS = [LxmlExtractor(), SoupExtractor()]
+
+
+def register_extractor(extractor, position: int = None):
+    """
+    Añade un extractor a la cadena. Debe tener un atributo `name` y un método
+    `extract(html)` que devuelva ProductFields.
+
+    Args:
+        extractor: Extractor a añadir.
+        position (int): Posición en la cadena; por defecto, antes del respaldo con BeautifulSoup.
+    """
+    EXTRACTORS.insert(len(EXTRACTORS) - 1 if position is None else position, extractor)
+
+
+def extract_product(html, extractors=None) -> ProductFields:
+    """
+    Extrae título y precio probando la cadena de extractores hasta que uno reconoce
+    la página (encuentra el título). Una página con título y sin precio es un producto
+    no disponible: los siguientes extractores buscan lo mismo y no se prueban.
+
+    Args:
+        html (str | bytes): HTML de la página del producto.
+        extractors (list): Cadena a usar; por defecto EXTRACTORS.
+
+    Returns:
+        ProductFields: Título, importe y moneda (None los que no se encuentren).
+    """
+    title, amount, currency = None, None, None
+    for extractor in extractors or EXTRACTORS:
+        fields = extractor.extract(html)
+        title = title or fields.title
+        if amount is None and fields.amount is not None:
+            amount, currency = fields.amount, fields.currency
+        if title:
+            break
+        logger.debug(f"El extractor {extractor.name} no reconoció la página, se prueba el siguiente")
+    return ProductFields(title, amount, currency)
+
+
+# Clasificación de las respuestas de Amazon antes de parsearlas
+RESPONSE_OK = "ok"
+RESPONSE_CAPTCHA = "captcha"            # Robot check: formulario de captcha con HTTP 200
+RESPONSE_DOG = "dog"                    # Página de error con perros (normalmente 503): bloqueo blando
+RESPONSE_UNAVAILABLE = "unavailable"    # El producto no existe (404/410)
+RESPONSE_GEO_REDIRECT = "geo_redirect"  # Redirección a otro marketplace o fuera de la ficha del producto
+# Respuestas que indican que Amazon está bloqueando la petición, no algo del producto
+BLOCKED_RESPONSES = (RESPONSE_CAPTCHA, RESPONSE_DOG, RESPONSE_GEO_REDIRECT)
+
+CLASSIFY_HEAD_BYTES = 65536  # Las páginas de bloqueo son pequeñas: basta con el principio
+CAPTCHA_MARKERS = (
+    b"/errors/validateCaptcha",
+    b'id="captchacharacters"',
+    b"<title>Robot Check</title>",
+    b"api-services-support@amazon.com",
+)
+DOG_MARKERS = (
+    b"Dogs of Amazon",
+    b"ref=cs_503_link",
+    b"ref=cs_503_logo",
+    b"Sorry! Something went wrong!",
+    b"Lo sentimos. Se ha producido un error",
+)
+ASIN_IN_PATH = re.compile(r"/(?:dp|gp/product|gp/aw/d)/([A-Z0-9]{10})", re.IGNORECASE)
+
+
+def _host(url: str) -> str:
+    host = (urlparse(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def classify_page(head) -> str:
+    """
+    Detecta por su contenido las páginas de captcha y de error (perros) de Amazon.
+
+    Args:
+        head (bytes | str): Principio del cuerpo de la respuesta.
+
+    Returns:
+        str: RESPONSE_CAPTCHA, RESPONSE_DOG o RESPONSE_OK.
+    """
+    if isinstance(head, str):
+        head = head[:CLASSIFY_HEAD_BYTES].encode("utf-8", "replace")
+    head = head[:CLASSIFY_HEAD_BYTES]
+    # Una ficha de producto real puede mencionar cualquier cosa más abajo; la de bloqueo no tiene título
+    if b'id="productTitle"' in head:
+        return RESPONSE_OK
+    if any(marker in head for marker in CAPTCHA_MARKERS):
+        return RESPONSE_CAPTCHA
+    if any(marker in head for marker in DOG_MARKERS):
+        return RESPONSE_DOG
+    return RESPONSE_OK
+
+
+def classify_response(requested_url: str, final_url: str, status: int, head=b"") -> str:
+    """
+    Clasifica una respuesta de Amazon antes de parsearla: bloqueo (captcha, perros,
+    redirección a otro marketplace), producto inexistente o respuesta válida.
+
+    Args:
+        requested_url (str): URL solicitada.
+        final_url (str): URL final tras las redirecciones.
+        status (int): Código HTTP.
+        head (bytes | str): Principio del cuerpo, si ya se ha leído.
+
+    Returns:
+        str: Una de las constantes RESPONSE_*.
+    """
+    if status in (404, 410):
+        return RESPONSE_UNAVAILABLE
+    if final_url and final_url != requested_url:
+        if _host(final_url) != _host(requested_url):
+            return RESPONSE_GEO_REDIRECT
+        requested_asin = ASIN_IN_PATH.search(urlparse(requested_url).path)
+        final_asin = ASIN_IN_PATH.search(urlparse(final_url).path)
+        # Redirigir a otro ASIN (variante) es normal; a una página sin producto, no
+        if requested_asin and not final_asin:
+            return RESPONSE_GEO_REDIRECT
+    if head:
+        kind = classify_page(head)
+        if kind != RESPONSE_OK:
+            return kind
+    if status == 503 and head:
+        return RESPONSE_DOG
+    return RESPONSE_OK
@@ -7,4 +7,25 @@ def config_logger():
     level=logging.INFO
     )
     logger = logging.getLogger(__name__)
-    return logger
\ No newline at end of file
+    return logger
+
+def summarize(items, key=None, limit: int = 3) -> str:
+    """
+    Resumen corto de una colección para los logs: cuántos elementos tiene y los
+    primeros (o su `key`), en lugar de volcarla entera.
+
+    Args:
+        items: Lista de filas, resultados...
+        key (callable, optional): Qué mostrar de cada elemento (p. ej. su ID).
+        limit (int): Elementos que se muestran como ejemplo.
+
+    Returns:
+        str: p. ej. "120 (1, 2, 3, …)".
+    """
+    if items is None:
+        return "None"
+    count = len(items)
+    if count == 0:
+        return "0"
+    shown = [key(item) if key else item for item in list(items[:limit])]
+    return f"{count} ({', '.join(map(str, shown))}{', …' if count > limit else ''})"
@@ -0,0 +1,94 @@
+# maintenance.py
+"""
+Tareas de mantenimiento de la base de datos, para ejecutar a mano o desde cron.
+
+Uso:
+    python maintenance.py compact-history [--batch 1000]
+    python maintenance.py retention [--months 24] [--drop] [--no-rollup]
+    python maintenance.py purge-states
+"""
+import argparse
+import os
+
+from database import apply_history_retention, compact_price_history, get_product_id_bounds, init_db, purge_user_states
+from logger import config_logger
+
+logger = config_logger()
+
+# Productos por transacción al compactar: acota los bloqueos y el tamaño de cada transacción
+COMPACT_BATCH_SIZE = 1000
+
+# Meses completos de historial detallado que se conservan (los anteriores quedan solo en los resúmenes)
+HISTORY_RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", 24))
+# "detach" deja las particiones caducadas como tablas sueltas para archivarlas; "drop" las borra
+HISTORY_RETENTION_MODE = os.getenv("HISTORY_RETENTION_MODE", "detach")
+
+
+def compact_history(batch_size: int = COMPACT_BATCH_SIZE) -> int:
+    """
+    Reescribe todo el historial como intervalos de precio (ver compact_price_history),
+    por tramos de productos, cada uno en su propia transacción.
+
+    Args:
+        batch_size (int): Productos por tramo.
+
+    Returns:
+        int: Filas eliminadas en total.
+    """
+    first_id, last_id = get_product_id_bounds() or (None, None)
+    if first_id is None:
+        logger.info("No hay productos cuyo historial compactar")
+        return 0
+    deleted = 0
+    for start in range(first_id, last_id + 1, batch_size):
+        result = compact_price_history(start, min(start + batch_size - 1, last_id))
+        if result is None:
+            logger.error(f"Se interrumpe la compactación en el tramo que empieza en el producto {start}")
+            break
+        deleted += result
+    logger.info(f"Compactación del historial terminada: {deleted} filas eliminadas")
+    return deleted
+
+
+def apply_retention(months: int = HISTORY_RETENTION_MONTHS, drop: bool = HISTORY_RETENTION_MODE == "drop",
+                    roll_up: bool = True) -> list:
+    """
+    Aplica la política de retención del historial (ver apply_history_retention) y
+    crea las particiones de los próximos meses.
+
+    Returns:
+        list: Particiones eliminadas del historial.
+    """
+    removed = apply_history_retention(months, drop=drop, roll_up=roll_up)
+    if removed is None:
+        logger.error("No se pudo aplicar la retención del historial")
+        return []
+    logger.info(f"Retención del historial aplicada ({months} meses): {len(removed)} particiones eliminadas")
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tareas de mantenimiento de la base de datos")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compact = commands.add_parser("compact-history", help="Reescribir el historial como intervalos de precio")
+    compact.add_argument("--batch", type=int, default=COMPACT_BATCH_SIZE, help="Productos por transacción")
+    retention = commands.add_parser("retention", help="Eliminar del historial los meses fuera de la ventana de retención")
+    retention.add_argument("--months", type=int, default=HISTORY_RETENTION_MONTHS, help="Meses de historial que se conservan")
+    retention.add_argument("--drop", action="store_true", default=HISTORY_RETENTION_MODE == "drop",
+                           help="Borrar las particiones caducadas en lugar de desengancharlas")
+    retention.add_argument("--no-rollup", dest="roll_up", action="store_false",
+                           help="No resumir las particiones antes de eliminarlas")
+    commands.add_parser("purge-states", help="Borrar los estados de conversación caducados")
+    args = parser.parse_args()
+
+    init_db()
+    if args.command == "compact-history":
+        compact_history(args.batch)
+    elif args.command == "retention":
+        apply_retention(args.months, drop=args.drop, roll_up=args.roll_up)
+    elif args.command == "purge-states":
+        purge_user_states()
+
+
+if __name__ == "__main__":
+    main()
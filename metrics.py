@@ -0,0 +1,379 @@
+# metrics.py
+"""
+Métricas del tracker en formato de texto de Prometheus, sin dependencias externas.
+
+Los contadores e histogramas de las etapas calientes (descarga, proxies, parseo,
+base de datos, notificaciones y ciclo) se definen aquí y se actualizan desde cada
+módulo. start_metrics_server() los sirve en /metrics desde un hilo propio.
+
+Con PROFILE_STAGES (p. ej. "parse,db") se activa un profiler por muestreo: un
+hilo toma cada PROFILE_INTERVAL segundos la pila de los hilos que están dentro de
+una de esas etapas (ver stage()) y acumula pilas colapsadas por etapa, que se
+descargan en /debug/profile?stage=parse (formato de flamegraph.pl / speedscope).
+"""
+import bisect
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from logger import config_logger
+
+logger = config_logger()
+
+# Puerto del endpoint de métricas (0 lo desactiva); solo escucha en local salvo que se indique otra cosa
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Etapas que muestrea el profiler (vacío = desactivado) y segundos entre muestras
+PROFILE_STAGES = {stage.strip() for stage in os.getenv("PROFILE_STAGES", "").split(",") if stage.strip()}
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.01))
+PROFILE_MAX_DEPTH = 64
+
+# Límites de los histogramas de duración, en segundos
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labels}, no {tuple(labels)}")
+        return tuple(labels[name] for name in self.labels)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples()]
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    """Contador que solo crece."""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in values]
+
+
+class Gauge(Counter):
+    """Valor que sube y baja (colas, elementos en memoria...)."""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Histograma de duraciones con límites fijos, acumulativo como en Prometheus."""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Mide la duración del bloque."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[2] if entry else 0
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(entry[0]), entry[1], entry[2])) for key, entry in self._values.items())
+        samples = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", _format_labels(self.labels, key, [("le", _format_value(bound))]), cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.labels, key), total))
+            samples.append((f"{self.name}_count", _format_labels(self.labels, key), count))
+        return samples
+
+
+# Métricas del tracker
+
+FETCH_SECONDS = Histogram(
+    "tracker_fetch_seconds", "Duración de la descarga de un producto, con todos sus reintentos",
+    ["marketplace", "outcome"],
+)
+FETCH_ATTEMPTS = Counter(
+    "tracker_fetch_attempts_total", "Intentos de descarga por marketplace y resultado", ["marketplace", "outcome"],
+)
+PROXY_REQUESTS = Counter(
+    "tracker_proxy_requests_total", "Peticiones por proxy y resultado (ok, código HTTP o tipo de error)", ["proxy", "outcome"],
+)
+PROXY_SECONDS = Histogram("tracker_proxy_request_seconds", "Duración de cada petición por proxy", ["proxy"])
+PARSE_SECONDS = Histogram("tracker_parse_seconds", "Tiempo de extracción del título y el precio de una página", ["mode"])
+DB_SECONDS = Histogram("tracker_db_seconds", "Duración de las funciones de database.py", ["function"])
+DB_ERRORS = Counter("tracker_db_errors_total", "Errores de base de datos por función", ["function"])
+NOTIFY_SECONDS = Histogram("tracker_notify_seconds", "Duración de cada envío a la Bot API", ["outcome"])
+NOTIFICATIONS = Counter("tracker_notifications_total", "Notificaciones por resultado", ["outcome"])
+NOTIFY_PENDING = Gauge("tracker_notifications_pending", "Mensajes en la cola de notificaciones")
+CYCLE_SECONDS = Histogram("tracker_cycle_seconds", "Duración de un ciclo de check_prices", ["kind"])
+CYCLE_PRODUCTS = Counter("tracker_cycle_products_total", "Suscripciones y descargas procesadas por los ciclos", ["kind"])
+SCHEDULE_LAG = Histogram(
+    "tracker_schedule_lag_seconds", "Retraso de cada descarga respecto a su hora planificada", (),
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600),
+)
+CIRCUIT_STATE = Gauge(
+    "tracker_circuit_state", "Cortacircuitos por bloqueos: 0 cerrado, 1 semiabierto (sondeando), 2 abierto", ["scope", "key"],
+)
+HANDLER_SECONDS = Histogram("tracker_handler_seconds", "Duración del trabajo bloqueante de los handlers", ["kind"])
+
+_started_at = time.time()
+
+
+def _process_metrics() -> list:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    lines = [
+        "# HELP process_cpu_seconds_total Tiempo de CPU del proceso (usuario + sistema)",
+        "# TYPE process_cpu_seconds_total counter",
+        f"process_cpu_seconds_total {usage.ru_utime + usage.ru_stime!r}",
+        "# HELP process_start_time_seconds Instante de arranque del proceso (epoch)",
+        "# TYPE process_start_time_seconds gauge",
+        f"process_start_time_seconds {_started_at!r}",
+    ]
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        lines += [
+            "# HELP process_resident_memory_bytes Memoria residente del proceso",
+            "# TYPE process_resident_memory_bytes gauge",
+            f"process_resident_memory_bytes {rss}",
+        ]
+    except (OSError, ValueError):
+        pass
+    return lines
+
+
+def render() -> str:
+    """Todas las métricas registradas en formato de texto de Prometheus."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    lines += _process_metrics()
+    return "\n".join(lines) + "\n"
+
+
+# Profiler por muestreo
+
+class StageProfiler:
+    """
+    Profiler por muestreo de etapas: cada hilo declara la etapa en la que está
+    (enter/exit, anidables) y un hilo muestreador guarda su pila a intervalos fijos.
+    En el event loop las corrutinas se intercalan, así que la etapa de una muestra del
+    hilo del loop es la última abierta en él: la atribución es aproximada.
+    """
+
+    def __init__(self, stages, interval: float = PROFILE_INTERVAL):
+        self.stages = set(stages)
+        self.interval = interval
+        self._active = {}  # id de hilo -> pila de etapas abiertas
+        self._samples = {}  # etapa -> Counter de pilas colapsadas
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def enter(self, stage: str) -> bool:
+        if stage not in self.stages:
+            return False
+        self._active.setdefault(threading.get_ident(), []).append(stage)
+        return True
+
+    def exit(self):
+        stack = self._active.get(threading.get_ident())
+        if stack:
+            stack.pop()
+            if not stack:
+                self._active.pop(threading.get_ident(), None)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stage-profiler", daemon=True)
+            self._thread.start()
+            logger.info(f"Profiler por muestreo activo para {sorted(self.stages)} cada {self.interval * 1000:.0f} ms")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Toma una muestra de la pila de cada hilo que está dentro de una etapa perfilada."""
+        frames = sys._current_frames()
+        for thread_id, stack in list(self._active.items()):
+            frame = frames.get(thread_id)
+            if frame is None or not stack:
+                continue
+            names = []
+            while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            collapsed = ";".join(reversed(names))
+            with self._lock:
+                self._samples.setdefault(stack[-1], _Tally())[collapsed] += 1
+
+    def collapsed(self, stage: str) -> str:
+        """Pilas colapsadas de una etapa ("pila n" por línea), de la más a la menos frecuente."""
+        with self._lock:
+            samples = self._samples.get(stage, _Tally()).most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {stage: sum(samples.values()) for stage, samples in self._samples.items()}
+
+
+profiler = StageProfiler(PROFILE_STAGES) if PROFILE_STAGES else None
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Marca un bloque como parte de una etapa para el profiler por muestreo. Sin
+    PROFILE_STAGES no hace nada más que comprobar una variable.
+    """
+    if profiler is None or not profiler.enter(name):
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.exit()
+
+
+# Endpoint HTTP
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            return self._reply(200, render(), "text/plain; version=0.0.4; charset=utf-8")
+        if url.path == "/debug/profile" and profiler is not None:
+            stage_name = parse_qs(url.query).get("stage", [None])[0]
+            if stage_name is None:
+                body = "".join(f"{name} {count}\n" for name, count in sorted(profiler.summary().items()))
+            else:
+                body = profiler.collapsed(stage_name)
+            return self._reply(200, body, "text/plain; charset=utf-8")
+        self._reply(404, "Not Found\n", "text/plain; charset=utf-8")
+
+    def _reply(self, status, text, content_type):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """
+    Sirve /metrics (y /debug/profile si el profiler está activo) en un hilo propio.
+
+    Args:
+        port (int): Puerto; 0 desactiva el endpoint.
+        host (str): Dirección en la que escuchar.
+
+    Returns:
+        ThreadingHTTPServer: El servidor, o None si está desactivado o el puerto está ocupado.
+    """
+    if profiler is not None:
+        profiler.start()
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"No se pudo abrir el endpoint de métricas en {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Métricas disponibles en http://{host}:{port}/metrics")
+    return server
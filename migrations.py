@@ -0,0 +1,459 @@
+# migrations.py
+
+import os
+from datetime import date
+
+from psycopg2.extras import execute_values
+
+from logger import config_logger
+from utils import simplify_amazon_url
+
+logger = config_logger()
+
+# Clave del advisory lock que serializa las migraciones entre procesos
+MIGRATIONS_LOCK_ID = 7262001
+
+# Particiones mensuales de price_history que se crean por adelantado
+HISTORY_PARTITIONS_AHEAD = int(os.getenv("HISTORY_PARTITIONS_AHEAD", 3))
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute("""
+    SELECT 1 FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    return cursor.fetchone() is not None
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def history_partition_name(month: date) -> str:
+    return f"price_history_p{month:%Y%m}"
+
+
+def create_history_partitions(cursor, first_month, last_month) -> list:
+    """
+    Crea (si no existen) las particiones mensuales de price_history entre dos meses, ambos incluidos.
+
+    Si la partición por defecto ya tiene filas de un mes (porque su partición no se
+    creó a tiempo), PostgreSQL no deja crearla: la partición por defecto se desengancha,
+    se crea la del mes, se le trasladan esas filas y se vuelve a enganchar, todo dentro
+    de la transacción de quien llama.
+
+    Returns:
+        list: Nombres de las particiones creadas.
+    """
+    created = []
+    month = month_start(first_month)
+    while month <= month_start(last_month):
+        name = history_partition_name(month)
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (name,))
+        if not cursor.fetchone()["present"]:
+            bounds = (month, add_months(month, 1))
+            cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM price_history_default WHERE valid_from >= %s AND valid_from < %s) AS stranded",
+                bounds
+            )
+            stranded = cursor.fetchone()["stranded"]
+            if stranded:
+                cursor.execute("ALTER TABLE price_history DETACH PARTITION price_history_default")
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF price_history FOR VALUES FROM (%s) TO (%s)", bounds)
+            if stranded:
+                cursor.execute(f"""
+                WITH moved AS (
+                    DELETE FROM price_history_default
+                    WHERE valid_from >= %s AND valid_from < %s
+                    RETURNING id, product_id, valid_from, last_seen_at, amount, currency, status
+                )
+                INSERT INTO {name} (id, product_id, valid_from, last_seen_at, amount, currency, status)
+                SELECT id, product_id, valid_from, last_seen_at, amount, currency, status FROM moved
+                """, bounds)
+                logger.warning(f"{cursor.rowcount} filas de price_history_default trasladadas a {name}")
+                cursor.execute("ALTER TABLE price_history ATTACH PARTITION price_history_default DEFAULT")
+            created.append(name)
+        month = add_months(month, 1)
+    if created:
+        logger.info(f"Particiones de price_history creadas: {', '.join(created)}")
+    return created
+
+
+def _initial_schema(cursor):
+    """
+    Esquema original de la aplicación. Usa IF NOT EXISTS para que las bases de datos
+    creadas antes de existir las migraciones pasen por aquí sin cambios.
+    """
+    # Crear tabla de usuarios con chat_id como PRIMARY KEY
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        chat_id BIGINT PRIMARY KEY
+    )
+    """)
+
+    # Crear tabla de productos referenciando chat_id en lugar de user_id
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS products (
+        id SERIAL PRIMARY KEY,
+        chat_id BIGINT REFERENCES users(chat_id) ON DELETE CASCADE,
+        url TEXT NOT NULL,
+        name TEXT,
+        price TEXT
+    )
+    """)
+
+    # Crear tabla de historial de precios
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS price_history (
+        id SERIAL PRIMARY KEY,
+        product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        price TEXT
+    )
+    """)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_id ON price_history(product_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_id ON products(chat_id)")
+
+
+def _numeric_prices(cursor):
+    """
+    Migra los precios en TEXT ("1.234,56 €") a importe NUMERIC, moneda y disponibilidad,
+    y rellena el último precio desnormalizado de products.
+    """
+    for column, definition in (
+        ("last_price", "NUMERIC(12, 2)"),
+        ("currency", "TEXT"),
+        ("availability", "TEXT"),
+        ("last_checked_at", "TIMESTAMP"),
+    ):
+        cursor.execute(f"ALTER TABLE products ADD COLUMN IF NOT EXISTS {column} {definition}")
+    for column, definition in (
+        ("amount", "NUMERIC(12, 2)"),
+        ("currency", "TEXT"),
+        ("status", "TEXT NOT NULL DEFAULT 'available'"),
+    ):
+        cursor.execute(f"ALTER TABLE price_history ADD COLUMN IF NOT EXISTS {column} {definition}")
+
+    if not _column_exists(cursor, "price_history", "price"):
+        return
+
+    # Los precios válidos tienen la forma "1.234,56 €"; el resto eran mensajes de error guardados como precio
+    cursor.execute(r"""
+    UPDATE price_history SET
+        amount = CASE WHEN price ~ '^[0-9.]+,[0-9]+ €$'
+                      THEN replace(replace(replace(price, ' €', ''), '.', ''), ',', '.')::NUMERIC END,
+        currency = CASE WHEN price ~ '^[0-9.]+,[0-9]+ €$' THEN 'EUR' END,
+        status = CASE WHEN price ~ '^[0-9.]+,[0-9]+ €$' THEN 'available'
+                      WHEN price = 'Precio no disponible' THEN 'unavailable'
+                      ELSE 'error' END
+    """)
+    # Los errores nunca fueron observaciones reales del producto
+    cursor.execute("DELETE FROM price_history WHERE status = 'error'")
+    cursor.execute("""
+    UPDATE products p SET
+        last_price = h.amount,
+        currency = h.currency,
+        availability = h.status,
+        last_checked_at = h.timestamp
+    FROM (
+        SELECT DISTINCT ON (product_id) product_id, amount, currency, status, timestamp
+        FROM price_history
+        ORDER BY product_id, timestamp DESC
+    ) h
+    WHERE h.product_id = p.id
+    """)
+    cursor.execute("ALTER TABLE price_history DROP COLUMN price")
+    cursor.execute("ALTER TABLE products DROP COLUMN IF EXISTS price")
+
+
+def _query_indexes(cursor):
+    """
+    Índices para las consultas frecuentes de database.py y unicidad de (chat_id, url).
+    """
+    # Fusionar productos duplicados antes de crear el índice único: el historial pasa al más antiguo
+    cursor.execute("""
+    WITH duplicates AS (
+        SELECT id, MIN(id) OVER (PARTITION BY chat_id, url) AS keep_id
+        FROM products
+    )
+    UPDATE price_history ph SET product_id = d.keep_id
+    FROM duplicates d
+    WHERE ph.product_id = d.id AND d.id <> d.keep_id
+    """)
+    cursor.execute("""
+    DELETE FROM products p
+    USING products older
+    WHERE p.chat_id = older.chat_id AND p.url = older.url AND p.id > older.id
+    """)
+    if cursor.rowcount:
+        logger.warning(f"Eliminados {cursor.rowcount} productos duplicados por (chat_id, url)")
+
+    # get_products, get_product_id, remove_product, get_price_history
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_chat_url ON products(chat_id, url)")
+    # Historial ordenado por producto: get_price_history y el borrado en cascada
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_history_product_ts ON price_history(product_id, timestamp DESC)")
+    # Ambos quedan cubiertos por la primera columna de los índices compuestos
+    cursor.execute("DROP INDEX IF EXISTS idx_chat_id")
+    cursor.execute("DROP INDEX IF EXISTS idx_product_id")
+
+
+def _scrape_targets(cursor):
+    """
+    Cola de descargas compartida por los workers: una fila por URL canónica con su
+    planificación (próxima comprobación, volatilidad estimada) y el lease del worker
+    que la está descargando. products.target_url enlaza cada suscripción con su fila.
+    """
+    cursor.execute("ALTER TABLE products ADD COLUMN IF NOT EXISTS target_url TEXT")
+    cursor.execute("SELECT id, url FROM products WHERE target_url IS NULL")
+    rows = [(row["id"], simplify_amazon_url(row["url"])) for row in cursor.fetchall()]
+    execute_values(cursor, """
+    UPDATE products p SET target_url = v.target_url
+    FROM (VALUES %s) AS v (id, target_url)
+    WHERE p.id = v.id
+    """, rows, page_size=1000)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS scrape_targets (
+        url TEXT PRIMARY KEY,
+        next_due_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        lease_owner TEXT,
+        lease_expires_at TIMESTAMPTZ,
+        taken_at TIMESTAMPTZ,
+        changes DOUBLE PRECISION NOT NULL DEFAULT 0,
+        observed_hours DOUBLE PRECISION NOT NULL DEFAULT 0,
+        last_change_at DOUBLE PRECISION,
+        last_checked_at DOUBLE PRECISION,
+        last_amount NUMERIC(12, 2),
+        last_status TEXT,
+        refresh_interval DOUBLE PRECISION,
+        failures INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    # Volatilidad inicial a partir de los cambios registrados en los últimos 30 días
+    cursor.execute("""
+    INSERT INTO scrape_targets (url, changes, observed_hours, last_change_at)
+    SELECT p.target_url,
+           COALESCE(MAX(h.changes), 0),
+           CASE WHEN MAX(h.changes) IS NOT NULL THEN 30 * 24 ELSE 0 END,
+           MAX(h.last_change_at) FILTER (WHERE h.changes > 0)
+    FROM products p
+    LEFT JOIN (
+        SELECT product_id, COUNT(*) - 1 AS changes,
+               EXTRACT(EPOCH FROM MAX(timestamp)::TIMESTAMPTZ)::DOUBLE PRECISION AS last_change_at
+        FROM price_history
+        WHERE timestamp > CURRENT_TIMESTAMP - INTERVAL '30 days'
+        GROUP BY product_id
+    ) h ON h.product_id = p.id
+    GROUP BY p.target_url
+    ON CONFLICT (url) DO NOTHING
+    """)
+    # claim_scrape_targets: productos vencidos por orden de vencimiento
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_scrape_targets_due ON scrape_targets(next_due_at)")
+    # get_target_subscribers y limpieza de URLs sin suscriptores
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_target ON products(target_url)")
+
+    # Presupuesto global de descargas por minuto, compartido por todos los workers
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS fetch_budget (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        tokens DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """)
+    # Empieza lleno: claim_scrape_targets lo limita a la capacidad configurada
+    cursor.execute("INSERT INTO fetch_budget (id, tokens) VALUES (1, 'Infinity') ON CONFLICT DO NOTHING")
+
+
+def _history_rollups(cursor):
+    """
+    Resúmenes por hora y por día del historial (apertura, mínimo, máximo, cierre y
+    número de observaciones), mantenidos por database.py al escribir cada observación.
+    Se rellenan con el historial existente.
+    """
+    for table, unit in (("price_history_hourly", "hour"), ("price_history_daily", "day")):
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            bucket TIMESTAMP NOT NULL,
+            currency TEXT,
+            open NUMERIC(12, 2) NOT NULL,
+            low NUMERIC(12, 2) NOT NULL,
+            high NUMERIC(12, 2) NOT NULL,
+            close NUMERIC(12, 2) NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (product_id, bucket)
+        )
+        """)
+        cursor.execute(f"""
+        INSERT INTO {table} (product_id, bucket, currency, open, low, high, close, samples)
+        SELECT product_id, date_trunc('{unit}', timestamp),
+               (array_agg(currency ORDER BY timestamp DESC))[1],
+               (array_agg(amount ORDER BY timestamp))[1],
+               MIN(amount), MAX(amount),
+               (array_agg(amount ORDER BY timestamp DESC))[1],
+               COUNT(*)
+        FROM price_history
+        WHERE amount IS NOT NULL
+        GROUP BY product_id, date_trunc('{unit}', timestamp)
+        ON CONFLICT (product_id, bucket) DO NOTHING
+        """)
+
+
+def _history_intervals(cursor):
+    """
+    El historial pasa a ser una sucesión de intervalos con el mismo precio: valid_from
+    (antes timestamp) es cuando se vio el precio por primera vez y last_seen_at la
+    última comprobación que lo confirmó. products.price_since apunta al intervalo
+    abierto de cada producto. Las filas antiguas quedan con last_seen_at nulo (igual a
+    valid_from) hasta que `python maintenance.py compact-history` las compacte.
+    """
+    if _column_exists(cursor, "price_history", "timestamp"):
+        cursor.execute("ALTER TABLE price_history RENAME COLUMN timestamp TO valid_from")
+    cursor.execute("ALTER TABLE price_history ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP")
+    cursor.execute("ALTER TABLE price_history ALTER COLUMN last_seen_at SET DEFAULT CURRENT_TIMESTAMP")
+    cursor.execute("ALTER TABLE products ADD COLUMN IF NOT EXISTS price_since TIMESTAMP")
+    cursor.execute("""
+    UPDATE products p SET price_since = h.valid_from
+    FROM (
+        SELECT DISTINCT ON (product_id) product_id, valid_from
+        FROM price_history
+        ORDER BY product_id, valid_from DESC
+    ) h
+    WHERE h.product_id = p.id
+    """)
+
+
+def _partitioned_history(cursor):
+    """
+    price_history pasa a estar particionada por meses de valid_from. Así las
+    inserciones y el vacuum trabajan sobre la partición del mes en curso, y la
+    retención (maintenance.py retention) elimina meses enteros sin DELETE. El historial deja
+    de tener clave foránea con borrado en cascada: eliminar un producto ya no borra
+    su historial fila a fila, y las filas huérfanas desaparecen con su partición.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('price_history')")
+    if cursor.fetchone()["relkind"] == "p":
+        return
+    cursor.execute("ALTER TABLE price_history RENAME TO price_history_unpartitioned")
+    cursor.execute("ALTER INDEX IF EXISTS idx_price_history_product_ts RENAME TO idx_price_history_unpartitioned_product_ts")
+    cursor.execute("""
+    CREATE TABLE price_history (
+        id BIGSERIAL,
+        product_id INTEGER NOT NULL,
+        valid_from TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        amount NUMERIC(12, 2),
+        currency TEXT,
+        status TEXT NOT NULL DEFAULT 'available',
+        PRIMARY KEY (id, valid_from)
+    ) PARTITION BY RANGE (valid_from)
+    """)
+    cursor.execute("CREATE INDEX idx_price_history_product_ts ON price_history(product_id, valid_from DESC)")
+    # Red de seguridad para filas fuera de las particiones creadas; normalmente vacía
+    cursor.execute("CREATE TABLE price_history_default PARTITION OF price_history DEFAULT")
+
+    cursor.execute("SELECT MIN(valid_from) AS first_at, LOCALTIMESTAMP AS now FROM price_history_unpartitioned")
+    bounds = cursor.fetchone()
+    create_history_partitions(cursor, bounds["first_at"] or bounds["now"], add_months(month_start(bounds["now"]), HISTORY_PARTITIONS_AHEAD))
+    cursor.execute("""
+    INSERT INTO price_history (id, product_id, valid_from, last_seen_at, amount, currency, status)
+    SELECT id, product_id, COALESCE(valid_from, CURRENT_TIMESTAMP), last_seen_at, amount, currency, status
+    FROM price_history_unpartitioned
+    WHERE product_id IS NOT NULL
+    """)
+    cursor.execute("SELECT setval(pg_get_serial_sequence('price_history', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM price_history")
+    cursor.execute("DROP TABLE price_history_unpartitioned")
+
+
+
+def _user_states(cursor):
+    """
+    Estado de las conversaciones del menú (qué espera el bot de cada chat), para que
+    sobreviva a los reinicios y lo compartan varias réplicas del bot. Cada entrada
+    caduca en expires_at; las caducadas se ignoran y `maintenance.py purge-states` las borra.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS user_states (
+        chat_id BIGINT PRIMARY KEY,
+        state JSONB NOT NULL,
+        expires_at TIMESTAMP NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_states_expires ON user_states(expires_at)")
+
+
+def _products_scan_index(cursor):
+    """
+    El recorrido del catálogo (get_all_products) va por páginas ordenadas por
+    (target_url, id): las suscripciones a un mismo producto llegan seguidas y cada
+    página continúa donde acabó la anterior con un Index Scan. target_url pasa a ser
+    obligatorio para que ninguna fila quede fuera del recorrido.
+    """
+    cursor.execute("SELECT id, url FROM products WHERE target_url IS NULL")
+    rows = [(row["id"], simplify_amazon_url(row["url"])) for row in cursor.fetchall()]
+    execute_values(cursor, """
+    UPDATE products p SET target_url = v.target_url
+    FROM (VALUES %s) AS v (id, target_url)
+    WHERE p.id = v.id
+    """, rows, page_size=1000)
+    cursor.execute("ALTER TABLE products ALTER COLUMN target_url SET NOT NULL")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_target_id ON products(target_url, id)")
+    # get_target_subscribers usa la primera columna del índice compuesto
+    cursor.execute("DROP INDEX IF EXISTS idx_products_target")
+
+# Migraciones en orden: (versión, descripción, función que recibe el cursor).
+# Nunca se modifica una migración ya publicada; los cambios van en una nueva versión.
+MIGRATIONS = [
+    (1, "Esquema inicial", _initial_schema),
+    (2, "Precios numéricos y último precio en products", _numeric_prices),
+    (3, "Índices compuestos y unicidad de (chat_id, url)", _query_indexes),
+    (4, "Cola de descargas compartida por los workers", _scrape_targets),
+    (5, "Resúmenes del historial por hora y por día", _history_rollups),
+    (6, "Historial como intervalos de precio (valid_from, last_seen_at)", _history_intervals),
+    (7, "price_history particionada por meses", _partitioned_history),
+    (8, "Estado de las conversaciones del bot", _user_states),
+    (9, "Recorrido del catálogo por (target_url, id)", _products_scan_index),
+]
+
+
+def apply_migrations(conn):
+    """
+    Aplica las migraciones pendientes sobre una conexión, dentro de su transacción.
+
+    Args:
+        conn (psycopg2.connection): Conexión a PostgreSQL.
+
+    Returns:
+        int: Versión del esquema tras aplicar las migraciones.
+    """
+    with conn.cursor() as cursor:
+        # Varios procesos pueden arrancar a la vez: solo uno migra, el resto espera
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        cursor.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations")
+        current_version = cursor.fetchone()["version"]
+
+        for version, description, migrate in MIGRATIONS:
+            if version <= current_version:
+                continue
+            logger.info(f"Aplicando migración {version}: {description}")
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            current_version = version
+
+    return current_version
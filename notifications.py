@@ -0,0 +1,237 @@
+# notifications.py
+
+import asyncio
+import os
+import time
+from collections import OrderedDict, namedtuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from logger import config_logger
+from metrics import NOTIFICATIONS, NOTIFY_PENDING, NOTIFY_SECONDS
+from ratelimit import TokenBucket
+from utils import escape_markdown_v2
+
+logger = config_logger()
+
+# Límites de la Bot API: ~30 mensajes/s en total, ~1/s por chat privado y 20/min por grupo
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", 30))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", 1))
+NOTIFY_GROUP_RATE = float(os.getenv("NOTIFY_GROUP_RATE", 20 / 60))
+# Envíos simultáneos: con ~100 ms por petición hacen falta varios para llegar al límite global
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", 8))
+# Intentos por mensaje ante errores de red o flood waits antes de descartarlo
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", 5))
+NOTIFY_RETRY_DELAY = 2.0   # Segundos antes del primer reintento por error de red; se duplica en cada uno
+MAX_MESSAGE_LENGTH = 4096  # Límite de Telegram por mensaje, ya escapado
+CHAT_BUCKETS_MAX = 10000   # Buckets por chat que se conservan (los más recientes)
+
+PriceChange = namedtuple("PriceChange", ["name", "current_price", "last_price"])
+PriceChange.__doc__ = "Cambio de precio de un producto, con los precios ya formateados para el usuario."
+
+Notification = namedtuple("Notification", ["chat_id", "text", "attempts"])
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """Segundos de espera de un RetryAfter (int en python-telegram-bot 21, timedelta en versiones posteriores)."""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+def format_change(change: PriceChange) -> str:
+    return (
+        f"{change.name}\n"
+        f"Nuevo precio: {change.current_price}\n"
+        f"Precio anterior: {change.last_price}"
+    )
+
+
+def build_messages(changes: list) -> list:
+    """
+    Construye los mensajes (ya escapados para MarkdownV2) que notifican los cambios de un chat.
+
+    Un único cambio conserva el mensaje de siempre; varios se agrupan en un resumen,
+    partido en tantos mensajes como haga falta para no superar el límite de Telegram.
+
+    Args:
+        changes (list): Lista de PriceChange del mismo chat.
+
+    Returns:
+        list: Textos a enviar.
+    """
+    if len(changes) == 1:
+        return [escape_markdown_v2("El precio del producto ha cambiado:\n" + format_change(changes[0]))]
+
+    messages = []
+    current = escape_markdown_v2(f"Han cambiado los precios de {len(changes)} productos:")
+    for change in changes:
+        block = escape_markdown_v2(format_change(change))
+        if len(current) + 2 + len(block) > MAX_MESSAGE_LENGTH:
+            messages.append(current)
+            current = block
+        else:
+            current += "\n\n" + block
+    messages.append(current)
+    return messages
+
+
+class NotificationDispatcher:
+    """
+    Cola de notificaciones con su propio consumidor.
+
+    Los cambios de precio se acumulan por chat durante un ciclo (add) y al terminarlo
+    (flush) cada chat recibe un único mensaje con todos sus cambios. Los mensajes se
+    encolan sin esperar: unas pocas tareas los envían respetando un token bucket global
+    y uno por chat, de modo que la descarga de precios nunca espera a Telegram. Un
+    chat sin tokens no bloquea a los demás: su mensaje vuelve a la cola cuando le toque.
+    Ante un RetryAfter (flood wait) se pausan los envíos el tiempo indicado y se reintenta,
+    como mucho max_attempts veces por mensaje, igual que ante un error de red.
+    """
+
+    def __init__(self, bot, global_rate: float = NOTIFY_GLOBAL_RATE, chat_rate: float = NOTIFY_CHAT_RATE,
+                 group_rate: float = NOTIFY_GROUP_RATE, concurrency: int = NOTIFY_CONCURRENCY,
+                 max_attempts: int = NOTIFY_MAX_ATTEMPTS, retry_delay: float = NOTIFY_RETRY_DELAY):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._global = TokenBucket(global_rate, max(global_rate, 1.0))
+        self._chats = OrderedDict()  # chat_id -> TokenBucket, del menos al más reciente
+        self._changes = {}           # chat_id -> [PriceChange] del ciclo en curso
+        self._loop = None
+        self._queue = None
+        self._senders = []
+        self._unfinished = 0
+        self._idle = None
+        self.stats = {"sent": 0, "digests": 0, "retries": 0, "flood_waits": 0, "dropped": 0}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Los grupos y canales tienen id negativo y un límite más estricto
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, 1.0)
+            if len(self._chats) > CHAT_BUCKETS_MAX:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _ensure_started(self):
+        """Arranca las tareas de envío en el event loop actual (una vez por loop)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._unfinished = 0
+        self._senders = [loop.create_task(self._sender()) for _ in range(self.concurrency)]
+
+    def add(self, chat_id: int, change: PriceChange):
+        """Registra un cambio de precio para notificarlo en el próximo flush."""
+        self._changes.setdefault(chat_id, []).append(change)
+
+    def flush(self):
+        """
+        Encola un mensaje por chat con los cambios acumulados desde el último flush.
+        No espera al envío.
+        """
+        self._ensure_started()
+        changes, self._changes = self._changes, {}
+        for chat_id, chat_changes in changes.items():
+            if len(chat_changes) > 1:
+                self.stats["digests"] += 1
+            for text in build_messages(chat_changes):
+                self._put(Notification(chat_id, text, 0))
+        if changes:
+            logger.info(f"Notificaciones encoladas para {len(changes)} chats ({self._unfinished} pendientes)")
+
+    def _put(self, notification):
+        self._unfinished += 1
+        NOTIFY_PENDING.set(self._unfinished)
+        self._idle.clear()
+        self._queue.put_nowait(notification)
+
+    def _done(self):
+        self._unfinished -= 1
+        NOTIFY_PENDING.set(self._unfinished)
+        if self._unfinished == 0:
+            self._idle.set()
+
+    def _requeue(self, notification, delay: float):
+        """Devuelve un mensaje a la cola pasados `delay` segundos, sin ocupar una tarea de envío."""
+        self._loop.call_later(delay, self._queue.put_nowait, notification)
+
+    async def join(self):
+        """Espera a que se hayan enviado (o descartado) todos los mensajes encolados."""
+        if self._idle is not None:
+            await self._idle.wait()
+
+    @property
+    def pending(self) -> int:
+        return self._unfinished
+
+    async def _sender(self):
+        while True:
+            notification = await self._queue.get()
+            wait = self._chat_bucket(notification.chat_id).reserve()
+            if wait > 0:
+                self._requeue(notification, wait)
+                continue
+            await self._global.acquire_async()
+            await self._send(notification)
+
+    async def _send(self, notification):
+        started = time.perf_counter()
+        outcome = await self._deliver(notification)
+        NOTIFY_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+        NOTIFICATIONS.inc(outcome=outcome)
+
+    async def _deliver(self, notification) -> str:
+        """Envía un mensaje y gestiona su error; devuelve el resultado para las métricas."""
+        chat_id, text, attempts = notification
+        attempts += 1
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, parse_mode="MarkdownV2")
+        except RetryAfter as e:
+            # Flood wait: Telegram indica cuánto esperar; se frena todo el envío, no solo este chat
+            seconds = _retry_after_seconds(e)
+            self.stats["flood_waits"] += 1
+            logger.warning(f"Telegram pide esperar {seconds:.0f} s antes de seguir enviando notificaciones")
+            self._global.pause(seconds)
+            self._chat_bucket(chat_id).pause(seconds)
+            if attempts < self.max_attempts:
+                self._requeue(notification._replace(attempts=attempts), seconds)
+                return "flood_wait"
+            logger.error(f"Se descarta la notificación al chat {chat_id} tras {attempts} esperas por flood")
+            self.stats["dropped"] += 1
+            self._done()
+            return "dropped"
+        except (Forbidden, BadRequest) as e:
+            # El usuario ha bloqueado el bot, el chat no existe...: reintentar no sirve
+            logger.error(f"No se pudo notificar al chat {chat_id}: {e}")
+            self.stats["dropped"] += 1
+            self._done()
+            return "dropped"
+        except (TimedOut, NetworkError) as e:
+            if attempts < self.max_attempts:
+                self.stats["retries"] += 1
+                logger.warning(f"Error de red al notificar al chat {chat_id} (intento {attempts}): {e}")
+                self._requeue(notification._replace(attempts=attempts), self.retry_delay * 2 ** (attempts - 1))
+                return "retry"
+            logger.error(f"Se descarta la notificación al chat {chat_id} tras {attempts} intentos: {e}")
+            self.stats["dropped"] += 1
+            self._done()
+            return "dropped"
+        except Exception as e:
+            logger.error(f"Error al notificar al chat {chat_id}: {e}")
+            self.stats["dropped"] += 1
+            self._done()
+            return "dropped"
+        self.stats["sent"] += 1
+        self._done()
+        return "sent"
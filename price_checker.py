@@ -1,11 +1,16 @@
 import asyncio
-from price_tracker import get_product_info
+from itertools import groupby
+from price_tracker import STREAM_STATS, AsyncSession, ScrapeCache, async_get_product_info, product_cache
 from telegram import Bot
 from dotenv import load_dotenv
 import os
-from database import record_price_change, get_product_id, get_last_price, get_all_products
-from asyncio import Semaphore
-from utils import escape_markdown_v2
+from database import record_price_observations, get_last_prices, get_all_products, set_product_names
+from notifications import NotificationDispatcher, PriceChange
+from utils import get_product_key, simplify_amazon_url, describe_price
+from logger import config_logger
+from metrics import CYCLE_PRODUCTS, CYCLE_SECONDS
+
+logger = config_logger()
 
 # Cargar variables de entorno
 load_dotenv()
@@ -16,40 +21,265 @@ TOKEN = os.getenv("TOKEN")
 if not TOKEN:
     raise ValueError("El token no está configurado en el archivo .env")
 
+# Número máximo de descargas simultáneas por ciclo
+CHECK_CONCURRENCY = int(os.getenv("CHECK_CONCURRENCY", 5))
+
+# Suscripciones que se leen del catálogo de una vez; sus últimos precios se cargan en una sola consulta
+SCAN_BATCH_SIZE = int(os.getenv("SCAN_BATCH_SIZE", 1000))
+
+# Observaciones de precio acumuladas antes de escribirlas en bloque
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", 5000))
+
 # Crear instancia del bot
 bot = Bot(token=TOKEN)
+# Las notificaciones se envían desde su propia cola, sin frenar las descargas
+notifier = NotificationDispatcher(bot)
+
+_DONE = object()  # Marca de fin de la cola de resultados
+
+# Métricas del último ciclo completado
+CYCLE_STATS = {
+    "products": 0,      # Filas de products (suscripciones) revisadas
+    "fetches": 0,       # Descargas distintas realizadas
+    "dedup_ratio": 1.0, # Suscripciones atendidas por cada descarga
+    "saved_requests": 0,
+    "bytes_read": 0,    # Bytes descargados (con descarga por bloques)
+    "bytes_saved": 0,   # Bytes que la descarga por bloques no llegó a leer
+    "duration": 0.0,
+}
+
+def _group_key(product):
+    # Las URLs no reconocidas se agrupan por la URL literal
+    return get_product_key(product["url"]) or product["url"]
+
+def group_products(products):
+    """
+    Agrupa las suscripciones por producto de Amazon (marketplace + ASIN), de forma
+    que cada producto distinto se descargue una sola vez por ciclo.
+
+    Args:
+        products (list): Filas de get_all_products().
+
+    Returns:
+        list: Lista de tuplas (URL a descargar, lista de suscripciones).
+    """
+    groups = {}
+    for product in products:
+        key = _group_key(product)
+        if key not in groups:
+            groups[key] = (simplify_amazon_url(product["url"]), [])
+        groups[key][1].append(product)
+    return list(groups.values())
+
+def stream_groups(products):
+    """
+    Versión en streaming de group_products para un recorrido en el que las suscripciones
+    a un mismo producto llegan seguidas, como las de get_all_products().
+
+    Args:
+        products (iterable): Suscripciones ordenadas por producto.
+
+    Yields:
+        tuple: (URL a descargar, lista de suscripciones).
+    """
+    for _, subscribers in groupby(products, key=_group_key):
+        subscribers = list(subscribers)
+        yield simplify_amazon_url(subscribers[0]["url"]), subscribers
+
+def _take_groups(groups, size):
+    """Toma de un iterador de grupos los necesarios para reunir al menos `size` suscripciones."""
+    batch, taken = [], 0
+    for group in groups:
+        batch.append(group)
+        taken += len(group[1])
+        if taken >= size:
+            break
+    return batch
+
+async def _produce_groups(groups, pending, last_prices, counts):
+    """
+    Lee los grupos por lotes fuera del event loop, carga los últimos precios de cada
+    lote y lo pasa a la cola de pendientes. La cola está acotada: la lectura del
+    catálogo avanza al ritmo de las descargas.
+
+    Returns:
+        bool: False si no se pudieron cargar los últimos precios y el ciclo quedó a medias.
+    """
+    while True:
+        batch = await asyncio.to_thread(_take_groups, groups, SCAN_BATCH_SIZE)
+        if not batch:
+            return True
+        product_ids = [product["id"] for _, subscribers in batch for product in subscribers]
+        prices = await asyncio.to_thread(get_last_prices, product_ids)
+        if prices is None:
+            logger.error("No se pudieron cargar los últimos precios; se interrumpe el ciclo.")
+            return False
+        last_prices.update(prices)
+        counts["products"] += len(product_ids)
+        counts["fetches"] += len(batch)
+        for group in batch:
+            await pending.put(group)
+
+async def _fetch_worker(session, pending, results):
+    """
+    Toma productos de la cola de pendientes, descarga su información y
+    la pasa a la cola de resultados en cuanto está disponible.
+    """
+    while True:
+        item = await pending.get()
+        if item is _DONE:
+            return
+        url, subscribers = item
+        try:
+            info = await async_get_product_info(session, url)
+            # Los comandos interactivos leen de esta caché en lugar de volver a descargar
+            product_cache.put(ScrapeCache.key_for(url), info)
+            await results.put((url, subscribers, info))
+        except Exception as e:
+            logger.error(f"Error al descargar {url}: {e}")
+
+async def _save_batch(observations, names, changes) -> bool:
+    """
+    Escribe un lote de observaciones y, solo si se han guardado, pasa sus cambios de
+    precio al notificador. Si la escritura falla, products conserva el último precio
+    anterior y el cambio se volverá a detectar (y notificar) en la siguiente comprobación.
+
+    Returns:
+        bool: True si las observaciones se han guardado.
+    """
+    if await asyncio.to_thread(record_price_observations, observations) is None:
+        logger.error(f"No se pudieron guardar {len(observations)} observaciones; se descartan {len(changes)} notificaciones")
+        return False
+    if names:
+        await asyncio.to_thread(set_product_names, names)
+    for chat_id, change in changes:
+        notifier.add(chat_id, change)
+    return True
+
+async def _result_consumer(results, last_prices, on_result=None):
+    """
+    Consume los resultados a medida que llegan: compara con el último precio
+    conocido, acumula los cambios para notificarlos al final del ciclo y las
+    observaciones para escribirlas en bloque.
+
+    Args:
+        results (asyncio.Queue): Cola de resultados de las descargas.
+        last_prices (dict): product_id -> último precio registrado, cargado por lotes; cada
+            entrada se retira al procesarla.
+        on_result (callable): Se llama con (url, info) por cada descarga, también las fallidas.
+
+    Returns:
+        bool: True si se han guardado todas las observaciones del ciclo.
+    """
+    saved = True
+    observations = []
+    names = []  # Productos importados en bloque, que aún no tienen nombre
+    changes = []  # (chat_id, PriceChange) del lote en curso, pendientes de guardarse
+    while True:
+        item = await results.get()
+        if item is _DONE:
+            break
+        url, subscribers, info = item
+        if on_result is not None:
+            on_result(url, info)
+        # Un fallo de descarga no es una observación del producto: no se registra ni se notifica
+        if info.status == "error":
+            logger.warning(f"Se omite {len(subscribers)} suscripciones por error al obtener el producto: {info.name}")
+            continue
+
+        # Un mismo resultado se reparte entre todas las suscripciones al producto
+        for product in subscribers:
+            observations.append((product["id"], info.amount, info.currency, info.status))
+            if not product["name"]:
+                names.append((product["id"], info.name))
+            last = last_prices.pop(product["id"], None)
+            if last is None or (last["last_price"], last["availability"]) == (info.amount, info.status):
+                continue
+            last_price = describe_price(last["last_price"], last["currency"], last["availability"])
+            changes.append((product["chat_id"], PriceChange(info.name, info.price, last_price)))
+
+        if len(observations) >= HISTORY_BATCH_SIZE:
+            saved &= await _save_batch(observations, names, changes)
+            observations, names, changes = [], [], []
+
+    saved &= await _save_batch(observations, names, changes)
+    # Un mensaje por chat con todos sus cambios guardados del ciclo
+    notifier.flush()
+    return saved
+
+async def check_prices(products=None, concurrency: int = CHECK_CONCURRENCY, on_result=None):
+    """
+    Actualiza el precio de los productos en seguimiento (todos, por defecto).
+
+    Las descargas se ejecutan como un conjunto acotado de tareas asíncronas; los
+    resultados pasan a un consumidor que los compara mientras el resto de descargas
+    sigue en curso. Las notificaciones se agrupan por chat y se encolan al terminar
+    (ver notifications.py): su envío no retrasa el ciclo. El catálogo se recorre en
+    streaming (get_all_products) con los últimos precios cargados por lotes de
+    SCAN_BATCH_SIZE suscripciones, de modo que las descargas empiezan con el primer lote
+    y la memoria no depende del número de productos; las observaciones se escriben en bloque.
+
+    Args:
+        products (list): Productos a comprobar (filas de get_all_products); por defecto, todos.
+        concurrency (int): Número máximo de descargas simultáneas.
+        on_result (callable): Se llama con (url canónica, ProductInfo) por cada descarga.
+
+    Returns:
+        bool: True si los resultados del ciclo se han guardado; False si ha fallado la base
+            de datos y no se han registrado (ni notificado) todos.
+    """
+    if products is None:
+        groups = stream_groups(get_all_products())
+    else:
+        groups = iter(group_products(products))
+
+    # Colas acotadas: si las descargas o la base de datos van por detrás, quien va delante espera
+    pending = asyncio.Queue(maxsize=concurrency * 4)
+    results = asyncio.Queue(maxsize=concurrency * 2)
+    last_prices = {}
+    counts = {"products": 0, "fetches": 0}
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    stream_before = dict(STREAM_STATS)
+    async with AsyncSession() as session:
+        consumer = asyncio.create_task(_result_consumer(results, last_prices, on_result))
+        fetchers = [
+            asyncio.create_task(_fetch_worker(session, pending, results))
+            for _ in range(concurrency)
+        ]
+        produced = False
+        try:
+            produced = await _produce_groups(groups, pending, last_prices, counts)
+        finally:
+            for _ in fetchers:
+                await pending.put(_DONE)
+        await asyncio.gather(*fetchers)
+        await results.put(_DONE)
+        saved = await consumer
+    # Si el recorrido se interrumpió, el ciclo no ha guardado todos los productos
+    saved = saved and produced
+    if not counts["fetches"]:
+        return saved
+
+    products, fetches = counts["products"], counts["fetches"]
+    CYCLE_STATS.update(
+        products=products,
+        fetches=fetches,
+        dedup_ratio=products / fetches,
+        saved_requests=products - fetches,
+        bytes_read=STREAM_STATS["bytes_read"] - stream_before["bytes_read"],
+        bytes_saved=STREAM_STATS["bytes_saved"] - stream_before["bytes_saved"],
+        duration=loop.time() - started,
+    )
+    CYCLE_SECONDS.observe(CYCLE_STATS["duration"], kind="check_prices")
+    CYCLE_PRODUCTS.inc(products, kind="subscriptions")
+    CYCLE_PRODUCTS.inc(fetches, kind="fetches")
+    logger.info(
+        f"Ciclo de precios completado: {products} productos, {fetches} descargas "
+        f"(ratio {CYCLE_STATS['dedup_ratio']:.2f}, {CYCLE_STATS['saved_requests']} peticiones ahorradas, "
+        f"{CYCLE_STATS['bytes_read'] / 2 ** 20:.1f} MB leídos y {CYCLE_STATS['bytes_saved'] / 2 ** 20:.1f} MB ahorrados) "
+        f"en {CYCLE_STATS['duration']:.1f} s"
+    )
+    return saved
 
-semaphore = Semaphore(5)  # Límite de 5 tareas concurrentes
-
-async def check_prices():
-    async with semaphore:
-        products = get_all_products()
-        for product in products:
-            try:
-                product_id, user_id, url, name = product
-                product_name, current_price = get_product_info(url)
-                last_price = get_last_price(product_id)
-
-                if last_price is None:
-                    record_price_change(product_id, current_price)
-                    continue
-
-                # Comparar precios y notificar al usuario si hay un cambio
-                if current_price != last_price:
-                    record_price_change(product_id, current_price)
-
-                    # Construir el mensaje y escaparlo
-                    message = (
-                        f"El precio del producto ha cambiado:\n"
-                        f"{product_name}\n"
-                        f"Nuevo precio: {current_price}\n"
-                        f"Precio anterior: {last_price}"
-                    )
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=escape_markdown_v2(message),
-                        parse_mode="MarkdownV2"
-                    )
-            except Exception as e:
-                # Mejor manejo de errores con logging
-                print(f"Error al procesar el producto '{name}' con ID {product_id}: {e}")
@@ -1,14 +1,26 @@
 # price_tracker.py
 
 import requests
-from bs4 import BeautifulSoup
+import httpx
+import asyncio
+import os
+import re
 import time
 import random
-from utils import simplify_amazon_url
+import threading
+from collections import namedtuple
+from urllib.parse import urlparse
+from cache import CoalescingCache
+from utils import simplify_amazon_url, get_product_key, describe_price
+from extractors import (  # Extracción rápida del título y el precio
+    BLOCKED_RESPONSES, CLASSIFY_HEAD_BYTES, IncrementalExtractor, ProductFields, RESPONSE_OK,
+    classify_page, classify_response, extract_product,
+)
 from logger import config_logger
-from proxies import PROXY_POOL  # Importa el iterador de proxies
+from metrics import FETCH_ATTEMPTS, FETCH_SECONDS, PARSE_SECONDS, PROXY_REQUESTS, PROXY_SECONDS, stage
+from proxies import proxy_manager  # Selección de proxies según su salud
+from ratelimit import domain_breaker, domain_limiter, proxy_breaker, proxy_limiter, retry_budget
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
 logger = config_logger()
 
@@ -33,123 +45,546 @@ USER_AGENTS = [
 ]
 
 MAX_RETRIES = 5
-RETRY_DELAY_RANGE = (5, 15)  # Tiempos de espera aleatorios entre 5 y 15 segundos
+RETRY_DELAY_RANGE = (5, 15)  # Tiempos de espera aleatorios entre 5 y 15 segundos (los Retry-After los impone el limitador)
 
-# Configurar la sesión con reintentos
+# Sesión HTTP sin reintentos propios: los reintentos los decide fetch_with_retries
+# con el presupuesto global, para no multiplicar las peticiones durante un bloqueo
 session = requests.Session()
-retry_strategy = Retry(
-    total=MAX_RETRIES,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=["HEAD", "GET", "OPTIONS"],
-    backoff_factor=1,  # Factor de espera exponencial
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
+adapter = HTTPAdapter(max_retries=0)
 session.mount("https://", adapter)
 session.mount("http://", adapter)
 
-def fetch_with_retries(url: str, headers: dict) -> str:
-    """Realiza una solicitud HTTP con reintentos en caso de error."""
-    for attempt in range(1, MAX_RETRIES + 1):
-        proxy_info = next(PROXY_POOL)
-        proxy_type = proxy_info["type"].lower()  # Convertir a minúsculas para compatibilidad
-        proxy_url = proxy_info["url"]
-
-        # Configurar proxies según tipo (solo HTTPS en este caso)
-        if proxy_type == "https":
-            proxies = {
-                "http": proxy_url,
-                "https": proxy_url,
-            }
+class BlockedResponse(Exception):
+    """Amazon ha respondido con un captcha, una página de error o una redirección en lugar del producto."""
+
+    def __init__(self, kind: str, url: str = None):
+        super().__init__(f"Respuesta bloqueada ({kind}): {url}" if url else f"Respuesta bloqueada ({kind})")
+        self.kind = kind
+
+def _check_page(head, url=None):
+    """Lanza BlockedResponse si el principio del cuerpo es una página de bloqueo."""
+    kind = classify_page(head)
+    if kind != RESPONSE_OK:
+        raise BlockedResponse(kind, url)
+
+def _breaker_key(proxy) -> str:
+    return proxy.url if proxy else "direct"
+
+def _proxy_label(proxy) -> str:
+    return f"{proxy.url} ({proxy.type.upper()})" if proxy else "sin proxy"
+
+_NO_ROUTE = object()  # Ningún proxy ni la conexión directa admiten peticiones ahora
+
+def _is_proxy_failure(error) -> bool:
+    """Un 404 indica que el producto no existe, no que el proxy falle."""
+    response = getattr(error, "response", None)
+    return response is None or response.status_code != 404
+
+def _outcome(error) -> str:
+    """Resultado de un intento fallido para las métricas: código HTTP o tipo de error."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        return f"http_{response.status_code}"
+    return type(error).__name__
+
+def _observe_attempt(domain: str, proxy, outcome: str, elapsed: float):
+    label = proxy.url if proxy else "direct"
+    PROXY_REQUESTS.inc(proxy=label, outcome=outcome)
+    PROXY_SECONDS.observe(elapsed, proxy=label)
+    FETCH_ATTEMPTS.inc(marketplace=domain, outcome=outcome)
+
+def _marketplace(url: str) -> str:
+    """Dominio del marketplace de una URL (amazon.es, amazon.com...), clave de su limitador."""
+    host = (urlparse(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+# Servidor al que se envían las peticiones en lugar del de la URL (p. ej. un servidor
+# de pruebas local); la ruta se conserva y el limitador sigue usando el marketplace original
+AMAZON_BASE_URL = os.getenv("AMAZON_BASE_URL")
+
+def _request_url(url: str) -> str:
+    """URL que se solicita realmente para un producto, según AMAZON_BASE_URL."""
+    if not AMAZON_BASE_URL:
+        return url
+    parsed = urlparse(url)
+    return AMAZON_BASE_URL.rstrip("/") + parsed._replace(scheme="", netloc="").geturl()
+
+# Descarga por bloques: la lectura se corta en cuanto aparecen el título y el precio,
+# sin pasar por el proxy el resto de la página (scripts, reseñas...). Con STREAM_FETCH=0
+# se descarga la página completa.
+STREAM_FETCH = os.getenv("STREAM_FETCH", "1").lower() not in ("0", "false", "no")
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 32768))
+
+# Bytes leídos y ahorrados por la descarga por bloques (el tráfico de los proxies se paga)
+STREAM_STATS = {"fetches": 0, "early_stops": 0, "bytes_read": 0, "bytes_saved": 0}
+_stream_lock = threading.Lock()
+_full_page_bytes = None  # Media de los bytes de una página completa, para estimar el ahorro sin Content-Length
+
+def _charset(content_type: str) -> str:
+    match = re.search(r"charset=([\w-]+)", content_type or "", re.IGNORECASE)
+    return match.group(1) if match else None
+
+def _record_stream(url: str, stopped_early: bool, wire_bytes: int, content_length: str):
+    """Acumula y registra los bytes leídos y ahorrados en una descarga por bloques."""
+    global _full_page_bytes
+    estimated = False
+    with _stream_lock:
+        if not stopped_early:
+            saved = 0
+            _full_page_bytes = wire_bytes if _full_page_bytes is None else 0.8 * _full_page_bytes + 0.2 * wire_bytes
+        elif content_length and content_length.isdigit():
+            saved = max(int(content_length) - wire_bytes, 0)
         else:
-            logger.warning(f"Tipo de proxy desconocido: {proxy_type}. Intentando sin proxy.")
-            proxies = {}
+            # Respuesta chunked: se estima con el tamaño medio de las páginas completas
+            saved = max(int(_full_page_bytes or 0) - wire_bytes, 0)
+            estimated = True
+        STREAM_STATS["fetches"] += 1
+        STREAM_STATS["early_stops"] += stopped_early
+        STREAM_STATS["bytes_read"] += wire_bytes
+        STREAM_STATS["bytes_saved"] += saved
+    logger.info(
+        f"Descarga de {url}: {wire_bytes / 1024:.0f} KB leídos, "
+        f"{saved / 1024:.0f} KB ahorrados{' (estimado)' if estimated else ''}"
+    )
+
+def _read_text(response) -> str:
+    _check_page(response.content[:CLASSIFY_HEAD_BYTES], response.url)
+    return response.text
+
+def _read_streamed(response) -> ProductFields:
+    """Lee el cuerpo por bloques y deja de leer en cuanto se tienen el título y el precio."""
+    try:
+        extractor = IncrementalExtractor(_charset(response.headers.get("Content-Type")))
+    except LookupError:
+        logger.warning("Codificación desconocida, se descarga la página completa")
+        return extract_product(response.content)
+    parse_seconds = 0.0
+    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+        if not extractor.bytes_read:
+            _check_page(chunk, response.url)
+        started = time.perf_counter()
+        with stage("parse"):
+            done = extractor.feed(chunk)
+        parse_seconds += time.perf_counter() - started
+        if done:
+            break
+    # urllib3 no cuenta los bytes de las respuestas chunked: entonces se usan los leídos
+    wire_bytes = response.raw.tell() or extractor.bytes_read
+    _record_stream(response.url, extractor.done, wire_bytes, response.headers.get("Content-Length"))
+    started = time.perf_counter()
+    with stage("parse"):
+        fields = extractor.close()
+    PARSE_SECONDS.observe(parse_seconds + time.perf_counter() - started, mode="stream")
+    return fields
+
+class _FetchAttempts:
+    """
+    Decisiones comunes de fetch_with_retries y async_fetch_with_retries: por qué ruta
+    va cada intento, cuándo se reintenta y cómo se registra cada resultado. Las dos
+    versiones solo aportan la espera y la petición.
+
+    Al iterar se obtiene (intento, proxy, espera previa en segundos). Si el circuito
+    del proxy elegido no deja pasar la petición, se prueba otro proxy o la conexión
+    directa dentro del mismo intento, sin gastar presupuesto de reintentos ni esperar.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.domain = _marketplace(url)
+        if not domain_breaker.allow(self.domain):
+            FETCH_SECONDS.observe(0, marketplace=self.domain, outcome="circuit_open")
+            raise BlockedResponse("circuit_open", url)
+        retry_budget.record_request()
+        self.started = time.monotonic()
+        self.last_error = None
+
+    @staticmethod
+    def _route(attempt: int):
+        """Proxy del intento (None = conexión directa), o _NO_ROUTE si todos los circuitos están abiertos."""
+        # El último intento se hace sin proxy
+        if attempt <= MAX_RETRIES:
+            refused = set()
+            while True:
+                proxy = proxy_manager.acquire(allow=lambda key: key not in refused and proxy_breaker.available(key))
+                if proxy is None:
+                    break
+                # available() no reserva el sondeo de un circuito semiabierto: otro hilo puede habérselo llevado
+                if proxy_breaker.allow(proxy.url):
+                    return proxy
+                refused.add(proxy.url)
+        return None if proxy_breaker.allow(_breaker_key(None)) else _NO_ROUTE
+
+    def __iter__(self):
+        for attempt in range(1, MAX_RETRIES + 2):
+            if attempt > 1 and not domain_breaker.available(self.domain):
+                logger.warning(f"Circuito de {self.domain} abierto, se abandona {self.url}")
+                return
+            proxy = self._route(attempt)
+            if proxy is _NO_ROUTE:
+                logger.warning(f"Circuitos de todos los proxies y de la conexión directa abiertos, se abandona {self.url}")
+                self.last_error = self.last_error or BlockedResponse("circuit_open", self.url)
+                return
+            delay = 0.0
+            if attempt > 1:
+                if not retry_budget.try_retry():
+                    logger.warning(f"Presupuesto de reintentos agotado, se abandona {self.url}")
+                    return
+                delay = random.uniform(*RETRY_DELAY_RANGE)
+                logger.info(f"Reintentando en {delay:.2f} segundos con otro proxy...")
+            yield attempt, proxy, delay
+
+    def succeeded(self, proxy, started: float):
+        elapsed = time.monotonic() - started
+        proxy_manager.report_success(proxy, elapsed)
+        proxy_breaker.record(_breaker_key(proxy), False)
+        domain_breaker.record(self.domain, False)
+        _observe_attempt(self.domain, proxy, "ok", elapsed)
+        FETCH_SECONDS.observe(time.monotonic() - self.started, marketplace=self.domain, outcome="ok")
 
+    def blocked(self, proxy, error: "BlockedResponse", started: float, attempt: int):
+        elapsed = time.monotonic() - started
+        logger.warning(f"Amazon ha bloqueado la petición con {_proxy_label(proxy)} (Intento {attempt}): {error.kind}")
+        _observe_attempt(self.domain, proxy, error.kind, elapsed)
+        proxy_manager.report_failure(proxy, error.kind, elapsed)
+        proxy_breaker.record(_breaker_key(proxy), True)
+        domain_breaker.record(self.domain, True)
+        self.last_error = error
+
+    def failed(self, proxy, error: Exception, started: float, attempt: int):
+        """Registra un error de red o HTTP; lo relanza si no es culpa del proxy (p. ej. un 404)."""
+        elapsed = time.monotonic() - started
+        logger.warning(f"{type(error).__name__} con {_proxy_label(proxy)} (Intento {attempt}): {error}")
+        _observe_attempt(self.domain, proxy, _outcome(error), elapsed)
+        if not _is_proxy_failure(error):
+            proxy_manager.report_success(proxy, elapsed)
+            FETCH_SECONDS.observe(time.monotonic() - self.started, marketplace=self.domain, outcome=_outcome(error))
+            raise error
+        proxy_manager.report_failure(proxy, error, elapsed)
+        self.last_error = error
+
+    def give_up(self):
+        FETCH_SECONDS.observe(time.monotonic() - self.started, marketplace=self.domain, outcome="error")
+        logger.error(f"No se pudo descargar {self.url}: {self.last_error}")
+        raise self.last_error
+
+def fetch_with_retries(url: str, headers: dict, reader=_read_text):
+    """
+    Realiza una solicitud HTTP con reintentos en caso de error.
+
+    Cada intento espera turno en el limitador del marketplace y en el del proxy; los
+    reintentos consumen el presupuesto global y, si se agota, se devuelve el último error.
+
+    Args:
+        url (str): URL a descargar.
+        headers (dict): Cabeceras de la petición.
+        reader (callable): Lee el cuerpo de la respuesta; por defecto devuelve el texto completo.
+
+    Returns:
+        Lo que devuelva `reader` (el HTML de la página por defecto).
+    """
+    attempts = _FetchAttempts(url)
+    domain = attempts.domain
+    for attempt, proxy, delay in attempts:
+        if delay:
+            time.sleep(delay)
+        proxies = proxy.requests_proxies if proxy else {}
+
+        domain_limiter.acquire(domain)
+        if proxy:
+            proxy_limiter.acquire(proxy.url)
+
+        started = time.monotonic()
         try:
             headers_with_agent = headers.copy()
             headers_with_agent["User-Agent"] = random.choice(USER_AGENTS)
             
-            if proxies:
-                logger.info(f"Intentando conectar a Amazon (Intento {attempt}) con proxy: {proxy_url} ({proxy_type.upper()})...")
-            else:
-                logger.info(f"Intentando conectar a Amazon (Intento {attempt}) sin proxy...")
+            logger.info(f"Intentando conectar a Amazon (Intento {attempt}) con proxy: {_proxy_label(proxy)}...")
 
             # Agregar logging para la URL
-            logger.debug(f"URL que se va a solicitar: {url}")
+            logger.debug("URL que se va a solicitar: %s", url)
 
-            response = session.get(url, headers=headers_with_agent, proxies=proxies, timeout=10)
-            response.raise_for_status()
+            with stage("fetch"):
+                with session.get(_request_url(url), headers=headers_with_agent, proxies=proxies, timeout=10, stream=True) as response:
+                    domain_limiter.observe(domain, response.status_code, response.headers.get("Retry-After"))
+                    # Las páginas de error de Amazon llegan con 503: se mira si es la de los perros
+                    head = response.content[:CLASSIFY_HEAD_BYTES] if response.status_code == 503 else b""
+                    kind = classify_response(_request_url(url), response.url, response.status_code, head)
+                    if kind in BLOCKED_RESPONSES:
+                        raise BlockedResponse(kind, url)
+                    response.raise_for_status()
+                    body = reader(response)
+            attempts.succeeded(proxy, started)
             logger.info("Conexión exitosa.")
-            return response.text
-        except requests.exceptions.ProxyError as e:
-            logger.warning(f"ProxyError con {proxy_url} ({proxy_type.upper()}) (Intento {attempt}): {e}")
-        except requests.exceptions.ConnectTimeout as e:
-            logger.warning(f"ConnectTimeout con {proxy_url} ({proxy_type.upper()}) (Intento {attempt}): {e}")
-        except requests.exceptions.ReadTimeout as e:
-            logger.warning(f"ReadTimeout con {proxy_url} ({proxy_type.upper()}) (Intento {attempt}): {e}")
-        except requests.exceptions.HTTPError as e:
-            logger.warning(f"HTTPError con {proxy_url} ({proxy_type.upper()}) (Intento {attempt}): {e}")
+            return body
+        except BlockedResponse as e:
+            attempts.blocked(proxy, e, started, attempt)
         except requests.exceptions.RequestException as e:
-            logger.warning(f"RequestException con {proxy_url} ({proxy_type.upper()}) (Intento {attempt}): {e}")
+            attempts.failed(proxy, e, started, attempt)
 
-        if attempt < MAX_RETRIES:
-            delay = random.uniform(*RETRY_DELAY_RANGE)
-            logger.info(f"Reintentando en {delay:.2f} segundos con otro proxy...")
-            time.sleep(delay)
-        else:
-            logger.error("Máximo número de intentos alcanzado con proxies. Intentando sin proxy...")
-            try:
-                headers_with_agent = headers.copy()
-                headers_with_agent["User-Agent"] = random.choice(USER_AGENTS)
-                logger.info(f"Intentando conectar a Amazon sin proxy (Intento final)...")
-                response = session.get(url, headers=headers_with_agent, timeout=10)
+    attempts.give_up()
+
+class AsyncSession:
+    """
+    Agrupa los clientes httpx asíncronos de un mismo event loop, uno por proxy,
+    para reutilizar las conexiones entre peticiones concurrentes.
+    """
+
+    def __init__(self, timeout: float = 10):
+        self.timeout = timeout
+        self._clients = {}
+
+    def client_for(self, proxy_url: str = None) -> httpx.AsyncClient:
+        """Devuelve (creándolo si es necesario) el cliente asociado a un proxy."""
+        client = self._clients.get(proxy_url)
+        if client is None:
+            client = httpx.AsyncClient(proxy=proxy_url, timeout=self.timeout, follow_redirects=True)
+            self._clients[proxy_url] = client
+        return client
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+async def _aread_text(response) -> str:
+    await response.aread()
+    _check_page(response.content[:CLASSIFY_HEAD_BYTES], str(response.url))
+    return response.text
+
+async def _aread_streamed(response) -> ProductFields:
+    """Versión asíncrona de _read_streamed."""
+    try:
+        extractor = IncrementalExtractor(_charset(response.headers.get("Content-Type")))
+    except LookupError:
+        logger.warning("Codificación desconocida, se descarga la página completa")
+        await response.aread()
+        return await asyncio.to_thread(extract_product, response.content)
+    # Cada bloque se parsea en el event loop: son pocos milisegundos y evita un salto de hilo por bloque
+    parse_seconds = 0.0
+    async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+        if not extractor.bytes_read:
+            _check_page(chunk, str(response.url))
+        started = time.perf_counter()
+        with stage("parse"):
+            done = extractor.feed(chunk)
+        parse_seconds += time.perf_counter() - started
+        if done:
+            break
+    _record_stream(str(response.url), extractor.done, response.num_bytes_downloaded, response.headers.get("Content-Length"))
+
+    def close():
+        started = time.perf_counter()
+        with stage("parse"):
+            fields = extractor.close()
+        PARSE_SECONDS.observe(parse_seconds + time.perf_counter() - started, mode="stream")
+        return fields
+    return await asyncio.to_thread(close)
+
+async def async_fetch_with_retries(session: AsyncSession, url: str, headers: dict, reader=_aread_text):
+    """Versión asíncrona de fetch_with_retries: no bloquea el event loop durante la descarga ni las esperas."""
+    attempts = _FetchAttempts(url)
+    domain = attempts.domain
+    for attempt, proxy, delay in attempts:
+        if delay:
+            await asyncio.sleep(delay)
+        proxy_url = proxy.url if proxy else None
+
+        await domain_limiter.acquire_async(domain)
+        if proxy:
+            await proxy_limiter.acquire_async(proxy_url)
+
+        started = time.monotonic()
+        try:
+            headers_with_agent = headers.copy()
+            headers_with_agent["User-Agent"] = random.choice(USER_AGENTS)
+            logger.debug("Solicitando %s (Intento %s) con proxy: %s", url, attempt, proxy_url)
+
+            async with session.client_for(proxy_url).stream("GET", _request_url(url), headers=headers_with_agent) as response:
+                domain_limiter.observe(domain, response.status_code, response.headers.get("Retry-After"))
+                head = b""
+                if response.status_code == 503:
+                    head = (await response.aread())[:CLASSIFY_HEAD_BYTES]
+                kind = classify_response(_request_url(url), str(response.url), response.status_code, head)
+                if kind in BLOCKED_RESPONSES:
+                    raise BlockedResponse(kind, url)
                 response.raise_for_status()
-                logger.info("Conexión exitosa sin proxy.")
-                return response.text
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error al conectar con Amazon sin proxy: {e}")
-                raise e
+                body = await reader(response)
+            attempts.succeeded(proxy, started)
+            return body
+        except BlockedResponse as e:
+            attempts.blocked(proxy, e, started, attempt)
+        except httpx.HTTPError as e:
+            attempts.failed(proxy, e, started, attempt)
+
+    attempts.give_up()
+
+class ProductInfo(namedtuple("ProductInfo", ["name", "amount", "currency", "status"])):
+    """
+    Resultado de extraer un producto de Amazon.
+
+    Attributes:
+        name (str): Nombre del producto.
+        amount (Decimal): Importe, o None si no hay precio.
+        currency (str): Código ISO de la moneda, o None si no hay precio.
+        status (str): "available", "unavailable" (página sin precio) o "error" (fallo al descargar o procesar).
+    """
+    __slots__ = ()
+
+    @property
+    def price(self) -> str:
+        """Precio formateado para mostrarlo al usuario."""
+        return describe_price(self.amount, self.currency, self.status)
+
+    @classmethod
+    def error(cls, message: str):
+        return cls(message, None, None, "error")
+
+def parse_product_page(html: str) -> ProductInfo:
+    """
+    Extrae el nombre y el precio del HTML de una página de producto de Amazon.
+
+    Args:
+        html (str): HTML de la página del producto.
+
+    Returns:
+        ProductInfo: Nombre, importe, moneda y disponibilidad del producto.
+    """
+    with PARSE_SECONDS.time(mode="full"), stage("parse"):
+        fields = extract_product(html)
+    return product_info_from_fields(fields)
+
+def product_info_from_fields(fields: ProductFields) -> ProductInfo:
+    """
+    Convierte los campos extraídos de una página en un ProductInfo.
+
+    Args:
+        fields (ProductFields): Título, importe y moneda extraídos.
+
+    Returns:
+        ProductInfo: Nombre, importe, moneda y disponibilidad del producto.
+    """
+    if not fields.title and fields.amount is None:
+        # Ni título ni precio: no es una ficha de producto (bloqueo no reconocido, página vacía...)
+        logger.warning("La página no contiene ni el título ni el precio del producto.")
+        return ProductInfo.error("Página de producto no reconocida")
+    if not fields.title:
+        logger.warning("No se encontró el elemento del título del producto.")
+    product_name = fields.title or "Nombre no disponible"
+
+    if fields.amount is None:
+        logger.warning("No se encontró el elemento del precio del producto.")
+        return ProductInfo(product_name, None, None, "unavailable")
+    return ProductInfo(product_name, fields.amount, fields.currency, "available")
+
+# Caché de resultados compartida por los comandos y el scheduler
+SCRAPE_CACHE_TTL = float(os.getenv("SCRAPE_CACHE_TTL", 120))  # Segundos que un resultado se considera fresco
+SCRAPE_CACHE_SIZE = int(os.getenv("SCRAPE_CACHE_SIZE", 10000))  # Número máximo de productos en caché
+
+class ScrapeCache(CoalescingCache):
+    """
+    Caché LRU con caducidad de los resultados de scraping, indexada por marketplace + ASIN.
 
-def get_product_info(url: str) -> tuple:
+    Las peticiones concurrentes de un producto que no está en caché se agrupan: solo
+    una descarga el producto y el resto espera su resultado. Es segura entre hilos, de
+    modo que la comparten los ejecutores de los comandos y el hilo del scheduler.
+    """
+
+    def __init__(self, ttl: float = SCRAPE_CACHE_TTL, max_size: int = SCRAPE_CACHE_SIZE, clock=time.monotonic):
+        super().__init__(max_size, ttl, clock)
+
+    @staticmethod
+    def key_for(url: str):
+        """Clave de caché de una URL: (marketplace, ASIN) o la URL canónica si no se reconoce."""
+        return get_product_key(url) or simplify_amazon_url(url)
+
+    def put(self, key, info):
+        """Guarda un resultado. Los errores de descarga no se guardan."""
+        if info.status == "error":
+            return
+        super().put(key, info)
+
+    def stats(self) -> dict:
+        """Contadores de aciertos, fallos y peticiones agrupadas."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+            }
+
+product_cache = ScrapeCache()
+
+def get_product_info(url: str, use_cache: bool = True) -> ProductInfo:
     """
     Extrae el nombre y el precio de un producto de Amazon.
 
     Args:
         url (str): URL de la página del producto.
+        use_cache (bool): Si es True, se devuelve el resultado en caché si está fresco y
+            las peticiones simultáneas del mismo producto comparten una única descarga.
 
     Returns:
-        tuple: (nombre del producto, precio del producto). Si no se encuentra, devuelve mensajes de error.
+        ProductInfo: Nombre, importe, moneda y disponibilidad. Si falla la descarga, el estado es "error".
     """
+    url = simplify_amazon_url(url)
+    if use_cache:
+        return product_cache.get_or_load(ScrapeCache.key_for(url), lambda: get_product_info(url, use_cache=False))
+
     try:
         logger.info("Obteniendo información del producto...")
-        html = fetch_with_retries(url, HEADERS)
-        logger.info("HTML obtenido exitosamente. Procesando datos...")
-        soup = BeautifulSoup(html, "lxml")
-
-        # Extraer nombre del producto
-        title_element = soup.find("span", id="productTitle")
-        if not title_element:
-            logger.warning("No se encontró el elemento del título del producto.")
-            product_name = "Nombre no disponible"
-        else:
-            product_name = title_element.text.strip() 
-
-        # Extraer precio del producto
-        whole_price = soup.select_one("span.a-price-whole")
-        fractional_price = soup.select_one("span.a-price-fraction")
-        if whole_price and fractional_price:
-            price = f"{whole_price.text.strip().replace(',', '')},{fractional_price.text.strip()} €"
+        if STREAM_FETCH:
+            info = product_info_from_fields(fetch_with_retries(url, HEADERS, reader=_read_streamed))
         else:
-            logger.warning("No se encontró el elemento del precio del producto.")
-            price = "Precio no disponible"
+            html = fetch_with_retries(url, HEADERS)
+            logger.info("HTML obtenido exitosamente. Procesando datos...")
+            info = parse_product_page(html)
 
-        logger.info(f"Producto encontrado: {product_name}, Precio: {price}")
-        return product_name, price
+        logger.info(f"Producto encontrado: {info.name}, Precio: {info.price}")
+        return info
+    except BlockedResponse as e:
+        # Sin precio ni historial: un captcha no es un cambio de precio
+        logger.error(f"Amazon ha bloqueado la petición: {e}")
+        return ProductInfo.error(f"Amazon ha bloqueado la petición ({e.kind})")
     except requests.exceptions.RequestException as e:
         logger.error(f"Error al conectar con Amazon: {e}")
-        return "Error al conectar con Amazon", str(e)
+        return ProductInfo.error("Error al conectar con Amazon")
     except Exception as e:
         logger.error(f"Error inesperado: {e}")
-        return "Error inesperado", str(e)
+        return ProductInfo.error("Error inesperado")
+
+async def async_get_product_info(session: AsyncSession, url: str) -> ProductInfo:
+    """
+    Versión asíncrona de get_product_info para el pipeline de actualización de precios.
+
+    Args:
+        session (AsyncSession): Sesión HTTP asíncrona compartida por el ciclo.
+        url (str): URL de la página del producto.
+
+    Returns:
+        ProductInfo: Nombre, importe, moneda y disponibilidad. Si falla la descarga, el estado es "error".
+    """
+    try:
+        if STREAM_FETCH:
+            return product_info_from_fields(await async_fetch_with_retries(session, url, HEADERS, reader=_aread_streamed))
+        html = await async_fetch_with_retries(session, url, HEADERS)
+        # El parseo es CPU puro: se hace fuera del event loop para no frenar las descargas en curso
+        return await asyncio.to_thread(parse_product_page, html)
+    except BlockedResponse as e:
+        logger.error(f"Amazon ha bloqueado la petición: {e}")
+        return ProductInfo.error(f"Amazon ha bloqueado la petición ({e.kind})")
+    except httpx.HTTPError as e:
+        logger.error(f"Error al conectar con Amazon: {e}")
+        return ProductInfo.error("Error al conectar con Amazon")
+    except Exception as e:
+        logger.error(f"Error inesperado: {e}")
+        return ProductInfo.error("Error inesperado")
 
 
 def get_price(url: str) -> str:
@@ -162,31 +597,7 @@ def get_price(url: str) -> str:
     Returns:
         str: El precio del producto como texto. Si no se encuentra, devuelve un mensaje de error.
     """
-    try:
-        url = simplify_amazon_url(url)
-        logger.info(f"URL simplificada: {url}")
-        logger.info("Obteniendo precio del producto...")
-        html = fetch_with_retries(url, HEADERS)
-        logger.info("HTML obtenido exitosamente. Procesando datos...")
-
-        soup = BeautifulSoup(html, "lxml")
-        
-        # Extraer la parte entera y fraccionaria del precio
-        whole_price = soup.select_one("span.a-price-whole")
-        fractional_price = soup.select_one("span.a-price-fraction")
-        
-        if whole_price and fractional_price:
-            price_whole = whole_price.text.strip().replace(",", "")
-            price_fraction = fractional_price.text.strip()
-            price = f"{price_whole},{price_fraction} €"
-            logger.info(f"Precio encontrado: {price}")
-            return price
-
-        logger.warning("No se encontró el precio en la página.")
+    info = get_product_info(url)
+    if info.status == "unavailable":
         return "No se pudo encontrar el precio en esta página."
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error al conectar con Amazon: {e}")
-        return f"Error al conectar con Amazon: {e}"
-    except Exception as e:
-        logger.error(f"Error inesperado: {e}")
-        return f"Error inesperado: {e}"
+    return info.price
@@ -1,6 +1,15 @@
 # proxies.py
 
-import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from logger import config_logger
+
+logger = config_logger()
 
 # Lista de proxies con su tipo y dirección
 PROXIES = [
@@ -14,5 +23,205 @@ PROXIES = [
     # Añade más proxies según disponibilidad
 ]
 
-# Crear un iterador cíclico de proxies
-PROXY_POOL = itertools.cycle(PROXIES)
+# Fichero opcional con la lista de proxies (JSON como PROXIES o una URL por línea); se recarga al cambiar
+PROXIES_FILE = os.getenv("PROXIES_FILE")
+
+SUPPORTED_SCHEMES = ("http", "https", "socks5", "socks5h", "socks4")
+
+EWMA_ALPHA = 0.3            # Peso de la última medida en la latencia media
+FAILURES_TO_QUARANTINE = 2  # Fallos seguidos antes de poner un proxy en cuarentena
+QUARANTINE_BASE = 30.0      # Segundos de la primera cuarentena; se duplica con cada fallo posterior
+QUARANTINE_MAX = 1800.0
+RELOAD_CHECK_INTERVAL = 5.0  # Segundos entre comprobaciones del fichero de proxies
+
+
+class ProxyState:
+    """
+    Estado de salud de un proxy: tasa de éxito, latencia media (EWMA) y errores recientes.
+    """
+    __slots__ = (
+        "url", "type", "successes", "failures", "latency_ewma",
+        "consecutive_failures", "quarantined_until", "recent_errors",
+    )
+
+    def __init__(self, url: str, proxy_type: str = None):
+        self.url = url
+        self.type = (proxy_type or url.split("://", 1)[0]).lower()
+        self.successes = 0
+        self.failures = 0
+        self.latency_ewma = None
+        self.consecutive_failures = 0
+        self.quarantined_until = 0.0
+        self.recent_errors = deque(maxlen=10)
+
+    @property
+    def success_rate(self) -> float:
+        # Suavizado de Laplace: un proxy nuevo empieza en 0.5 en lugar de 0 o 1
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def requests_proxies(self) -> dict:
+        """Diccionario de proxies para requests (los SOCKS necesitan PySocks)."""
+        return {"http": self.url, "https": self.url}
+
+    def __repr__(self):
+        return f"ProxyState({self.url!r}, rate={self.success_rate:.2f}, latency={self.latency_ewma})"
+
+
+def _parse_proxy_entries(entries):
+    states = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        url = entry["url"].strip()
+        state = ProxyState(url, entry.get("type"))
+        if state.type not in SUPPORTED_SCHEMES:
+            logger.warning(f"Tipo de proxy no soportado, se ignora: {url} ({state.type})")
+            continue
+        states.append(state)
+    return states
+
+
+def load_proxies_file(path: str) -> list:
+    """
+    Lee una lista de proxies de un fichero JSON (lista de {"type", "url"} o de URLs)
+    o de texto plano con una URL por línea.
+    """
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        return [line.strip() for line in content.splitlines() if line.strip() and not line.startswith("#")]
+
+
+class ProxyManager:
+    """
+    Selecciona proxies según su salud en lugar de rotarlos a ciegas.
+
+    Cada proxy acumula éxitos, fallos y una media exponencial de su latencia. La
+    elección es aleatoria ponderada por tasa de éxito y latencia, de forma que los
+    proxies rápidos y fiables reciben la mayor parte del tráfico sin dejar de
+    probar el resto. Tras varios fallos seguidos un proxy entra en cuarentena con
+    espera exponencial; al salir recibe tráfico de nuevo y, si vuelve a fallar, la
+    cuarentena se alarga.
+    """
+
+    def __init__(self, proxies, proxies_file: str = None, clock=time.monotonic, rng=None):
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._proxies = {}
+        self._proxies_file = proxies_file
+        self._file_mtime = None
+        self._next_reload_check = 0.0
+        self.reload(proxies)
+        if proxies_file:
+            self.reload_if_changed(force=True)
+
+    def reload(self, entries):
+        """
+        Sustituye la lista de proxies conservando las estadísticas de los que se mantienen.
+        """
+        states = _parse_proxy_entries(entries)
+        with self._lock:
+            self._proxies = {state.url: self._proxies.get(state.url, state) for state in states}
+        logger.info(f"Lista de proxies cargada: {len(states)} proxies")
+
+    def reload_if_changed(self, force: bool = False):
+        """
+        Recarga la lista desde el fichero de proxies si ha cambiado desde la última lectura.
+        """
+        if not self._proxies_file:
+            return
+        now = self._clock()
+        if not force and now < self._next_reload_check:
+            return
+        self._next_reload_check = now + RELOAD_CHECK_INTERVAL
+        try:
+            mtime = os.path.getmtime(self._proxies_file)
+            if mtime == self._file_mtime:
+                return
+            self.reload(load_proxies_file(self._proxies_file))
+            self._file_mtime = mtime
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"No se pudo recargar {self._proxies_file}: {e}")
+
+    def _weight(self, state, default_latency):
+        latency = state.latency_ewma if state.latency_ewma is not None else default_latency
+        return state.success_rate ** 2 / max(latency, 0.05)
+
+    def acquire(self, allow=None):
+        """
+        Elige un proxy disponible ponderando por salud.
+
+        Args:
+            allow (callable, optional): Filtro adicional por URL del proxy (p. ej. su cortacircuitos).
+
+        Returns:
+            ProxyState: Proxy elegido, o None si no hay ninguno disponible (conexión directa).
+        """
+        self.reload_if_changed()
+        now = self._clock()
+        with self._lock:
+            available = [
+                state for state in self._proxies.values()
+                if state.quarantined_until <= now and (allow is None or allow(state.url))
+            ]
+            if not available:
+                return None
+            measured = [state.latency_ewma for state in available if state.latency_ewma is not None]
+            default_latency = sum(measured) / len(measured) if measured else 1.0
+            weights = [self._weight(state, default_latency) for state in available]
+            return self._rng.choices(available, weights=weights, k=1)[0]
+
+    def report_success(self, state, latency: float):
+        """Registra una petición correcta a través del proxy y su latencia en segundos."""
+        if state is None:
+            return
+        with self._lock:
+            state.successes += 1
+            state.consecutive_failures = 0
+            state.quarantined_until = 0.0
+            if state.latency_ewma is None:
+                state.latency_ewma = latency
+            else:
+                state.latency_ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * state.latency_ewma
+
+    def report_failure(self, state, error, latency: float = None):
+        """Registra un fallo del proxy y lo pone en cuarentena si falla repetidamente."""
+        if state is None:
+            return
+        with self._lock:
+            state.failures += 1
+            state.consecutive_failures += 1
+            state.recent_errors.append((self._clock(), type(error).__name__ if isinstance(error, BaseException) else str(error)))
+            if latency is not None:
+                # Un timeout también cuenta como latencia: penaliza a los proxies lentos
+                state.latency_ewma = latency if state.latency_ewma is None else (
+                    EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * state.latency_ewma
+                )
+            if state.consecutive_failures >= FAILURES_TO_QUARANTINE:
+                backoff = min(QUARANTINE_BASE * 2 ** (state.consecutive_failures - FAILURES_TO_QUARANTINE), QUARANTINE_MAX)
+                state.quarantined_until = self._clock() + backoff
+                logger.warning(f"Proxy {state.url} en cuarentena durante {backoff:.0f} s tras {state.consecutive_failures} fallos")
+
+    def snapshot(self) -> list:
+        """Estado de todos los proxies, para logs y métricas."""
+        now = self._clock()
+        with self._lock:
+            return [
+                {
+                    "url": state.url,
+                    "type": state.type,
+                    "success_rate": state.success_rate,
+                    "latency_ewma": state.latency_ewma,
+                    "quarantined": state.quarantined_until > now,
+                    "recent_errors": [error for _, error in state.recent_errors],
+                }
+                for state in self._proxies.values()
+            ]
+
+
+# Gestor de proxies compartido por todo el proceso
+proxy_manager = ProxyManager(PROXIES, proxies_file=PROXIES_FILE)
@@ -0,0 +1,356 @@
+# ratelimit.py
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from logger import config_logger
+from metrics import CIRCUIT_STATE
+
+logger = config_logger()
+
+# Peticiones por segundo a cada marketplace (amazon.es, amazon.com...): inicial, mínimo y máximo
+DOMAIN_RATE = float(os.getenv("DOMAIN_RATE", 2.0))
+DOMAIN_RATE_MIN = float(os.getenv("DOMAIN_RATE_MIN", 0.1))
+DOMAIN_RATE_MAX = float(os.getenv("DOMAIN_RATE_MAX", 10.0))
+DOMAIN_BURST = float(os.getenv("DOMAIN_BURST", 5))
+# Peticiones por segundo a través de un mismo proxy
+PROXY_RATE = float(os.getenv("PROXY_RATE", 0.5))
+PROXY_BURST = float(os.getenv("PROXY_BURST", 2))
+# Reintentos permitidos por cada petición nueva, y mínimo de reintentos por segundo
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", 0.1))
+
+# Cortacircuitos ante bloqueos (captchas, páginas de error): fracción de respuestas
+# bloqueadas entre las últimas BREAKER_WINDOW que abre el circuito, mínimo de
+# respuestas para decidir, pausa inicial y máxima, y segundos entre sondeos
+BREAKER_THRESHOLD = float(os.getenv("BREAKER_THRESHOLD", 0.5))
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", 20))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", 5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 60))
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", 1800))
+BREAKER_PROBE_INTERVAL = float(os.getenv("BREAKER_PROBE_INTERVAL", 30))
+
+THROTTLE_STATUSES = (429, 503)
+RATE_DECREASE_FACTOR = 0.5  # Ante un 429 la tasa se reduce a la mitad...
+RATE_INCREASE_STEP = 0.05   # ...y se recupera poco a poco con cada respuesta correcta
+
+
+def parse_retry_after(value, now=None) -> float:
+    """
+    Interpreta la cabecera Retry-After (segundos o fecha HTTP).
+
+    Returns:
+        float: Segundos de espera, o None si la cabecera no existe o no es válida.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at - (now if now is not None else time.time()), 0.0)
+
+
+class TokenBucket:
+    """
+    Token bucket seguro entre hilos: `rate` tokens por segundo con ráfagas de hasta `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now <= self._updated:
+            return
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """
+        Intenta consumir tokens.
+
+        Returns:
+            float: 0 si se han consumido, o los segundos que hay que esperar antes de reintentar.
+        """
+        with self._lock:
+            now = self._clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def available_in(self, tokens: float = 1.0) -> float:
+        """Segundos hasta que haya tokens suficientes, sin consumirlos."""
+        with self._lock:
+            now = self._clock()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            return max(tokens - self._tokens, 0.0) / self.rate
+
+    def acquire(self, tokens: float = 1.0):
+        """Espera (bloqueando el hilo) hasta poder consumir tokens."""
+        while True:
+            wait = self.reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: float = 1.0):
+        """Espera sin bloquear el event loop hasta poder consumir tokens."""
+        while True:
+            wait = self.reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill(self._clock())
+            self.rate = rate
+
+    def pause(self, seconds: float):
+        """No entrega tokens durante los próximos segundos (p. ej. por un Retry-After)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            # Los tokens vuelven a acumularse a partir del final de la pausa
+            self._tokens = 0.0
+            self._updated = self._paused_until
+
+
+class RateLimiter:
+    """
+    Un token bucket por clave (marketplace o proxy) con control AIMD: la tasa se reduce
+    a la mitad con cada respuesta 429/503 y crece linealmente con las respuestas
+    correctas, buscando la tasa sostenida más alta que no provoca bloqueos.
+    """
+
+    def __init__(self, rate: float, burst: float, min_rate: float = None, max_rate: float = None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate if min_rate is not None else rate
+        self.max_rate = max_rate if max_rate is not None else rate
+        self._clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, key) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, clock=self._clock)
+                self._buckets[key] = bucket
+            return bucket
+
+    def acquire(self, key):
+        self.bucket(key).acquire()
+
+    async def acquire_async(self, key):
+        await self.bucket(key).acquire_async()
+
+    def observe(self, key, status_code: int, retry_after=None):
+        """
+        Ajusta la tasa de una clave según el código de respuesta y la cabecera Retry-After.
+        """
+        bucket = self.bucket(key)
+        if status_code in THROTTLE_STATUSES:
+            new_rate = max(self.min_rate, bucket.rate * RATE_DECREASE_FACTOR)
+            bucket.set_rate(new_rate)
+            delay = parse_retry_after(retry_after)
+            if delay is None:
+                delay = 1.0 / new_rate
+            bucket.pause(delay)
+            logger.warning(f"Respuesta {status_code} de {key}: tasa reducida a {new_rate:.2f} req/s, pausa de {delay:.1f} s")
+        elif status_code < 400:
+            bucket.set_rate(min(self.max_rate, bucket.rate + RATE_INCREASE_STEP))
+
+    def rates(self) -> dict:
+        """Tasa actual de cada clave."""
+        with self._lock:
+            return {key: bucket.rate for key, bucket in self._buckets.items()}
+
+
+class RetryBudget:
+    """
+    Presupuesto global de reintentos: cada petición nueva aporta `ratio` reintentos y
+    además se conceden `min_per_second` reintentos por segundo. Cuando falla mucho
+    tráfico a la vez (p. ej. una oleada de 429) los reintentos se agotan en lugar de
+    multiplicar la carga.
+    """
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND,
+                 max_balance: float = 100.0, clock=time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self._clock = clock
+        self._balance = 0.0
+        self._updated = clock()
+        self._lock = threading.Lock()
+        self.exhausted = 0
+
+    def _refill(self):
+        now = self._clock()
+        self._balance = min(self.max_balance, self._balance + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def record_request(self):
+        """Registra una petición nueva (no un reintento)."""
+        with self._lock:
+            self._refill()
+            self._balance = min(self.max_balance, self._balance + self.ratio)
+
+    def try_retry(self) -> bool:
+        """Consume un reintento del presupuesto si queda alguno."""
+        with self._lock:
+            self._refill()
+            if self._balance >= 1.0:
+                self._balance -= 1.0
+                return True
+            self.exhausted += 1
+            return False
+
+
+class CircuitBreaker:
+    """
+    Cortacircuitos por clave (proxy o marketplace) según la tasa de bloqueos.
+
+    Con el circuito cerrado todo pasa y se guarda si cada respuesta fue un bloqueo.
+    Cuando los bloqueos superan `threshold` entre las últimas `window` respuestas,
+    el circuito se abre y la clave deja de recibir tráfico durante `cooldown`
+    segundos. Pasado ese tiempo se deja pasar una sola petición de sondeo cada
+    `probe_interval` segundos (semiabierto): si no la bloquean se cierra, y si
+    la bloquean vuelve a abrirse con el doble de pausa, hasta `max_cooldown`.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, threshold: float = BREAKER_THRESHOLD, window: int = BREAKER_WINDOW,
+                 min_requests: int = BREAKER_MIN_REQUESTS, cooldown: float = BREAKER_COOLDOWN,
+                 max_cooldown: float = BREAKER_MAX_COOLDOWN, probe_interval: float = BREAKER_PROBE_INTERVAL,
+                 clock=time.monotonic, on_change=None):
+        self.name = name
+        self.threshold = threshold
+        self.window = window
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_interval = probe_interval
+        self._clock = clock
+        self._on_change = on_change
+        self._circuits = {}  # clave -> {"state", "outcomes", "retry_at", "cooldown"}
+        self._lock = threading.Lock()
+
+    def _circuit(self, key):
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = {
+                "state": self.CLOSED, "outcomes": deque(maxlen=self.window), "retry_at": 0.0, "cooldown": self.cooldown,
+            }
+        return circuit
+
+    def _set_state(self, key, circuit, state):
+        if circuit["state"] != state:
+            circuit["state"] = state
+            if self._on_change is not None:
+                self._on_change(self.name, key, state)
+
+    def available(self, key) -> bool:
+        """Si la clave puede recibir tráfico ahora (sin reservar el sondeo)."""
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit is None or circuit["state"] == self.CLOSED or self._clock() >= circuit["retry_at"]
+
+    def allow(self, key) -> bool:
+        """
+        Pide paso para una petición. Con el circuito abierto solo se concede un sondeo
+        cada probe_interval segundos.
+        """
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit["state"] == self.CLOSED:
+                return True
+            now = self._clock()
+            if now < circuit["retry_at"]:
+                return False
+            circuit["retry_at"] = now + self.probe_interval
+            self._set_state(key, circuit, self.HALF_OPEN)
+            return True
+
+    def record(self, key, blocked: bool):
+        """Registra el resultado de una petición a la clave."""
+        with self._lock:
+            circuit = self._circuit(key)
+            now = self._clock()
+            if circuit["state"] != self.CLOSED:
+                if blocked:
+                    circuit["cooldown"] = min(circuit["cooldown"] * 2, self.max_cooldown)
+                    circuit["retry_at"] = now + circuit["cooldown"]
+                    self._set_state(key, circuit, self.OPEN)
+                else:
+                    circuit["outcomes"].clear()
+                    circuit["cooldown"] = self.cooldown
+                    self._set_state(key, circuit, self.CLOSED)
+                    logger.info(f"Circuito de {self.name} {key} cerrado: el sondeo no ha sido bloqueado")
+                return
+
+            outcomes = circuit["outcomes"]
+            outcomes.append(blocked)
+            if len(outcomes) >= self.min_requests and sum(outcomes) / len(outcomes) >= self.threshold:
+                circuit["retry_at"] = now + circuit["cooldown"]
+                self._set_state(key, circuit, self.OPEN)
+                logger.warning(
+                    f"Circuito de {self.name} {key} abierto durante {circuit['cooldown']:.0f} s: "
+                    f"{sum(outcomes)} de {len(outcomes)} respuestas bloqueadas"
+                )
+
+    def state(self, key) -> str:
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit["state"] if circuit else self.CLOSED
+
+    def snapshot(self) -> dict:
+        """Estado y tasa de bloqueos de cada clave, para logs y métricas."""
+        with self._lock:
+            return {
+                key: {
+                    "state": circuit["state"],
+                    "block_rate": sum(circuit["outcomes"]) / len(circuit["outcomes"]) if circuit["outcomes"] else 0.0,
+                }
+                for key, circuit in self._circuits.items()
+            }
+
+
+# Limitadores compartidos por todo el proceso
+domain_limiter = RateLimiter(DOMAIN_RATE, DOMAIN_BURST, min_rate=DOMAIN_RATE_MIN, max_rate=DOMAIN_RATE_MAX)
+proxy_limiter = RateLimiter(PROXY_RATE, PROXY_BURST)
+retry_budget = RetryBudget()
+
+
+def _report_circuit(scope, key, state):
+    CIRCUIT_STATE.set({CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}[state],
+                      scope=scope, key=key)
+
+
+# Cortacircuitos por proxy (la conexión directa es la clave "direct") y por marketplace
+proxy_breaker = CircuitBreaker("proxy", on_change=_report_circuit)
+domain_breaker = CircuitBreaker("marketplace", min_requests=max(BREAKER_MIN_REQUESTS, 10), on_change=_report_circuit)
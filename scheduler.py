@@ -0,0 +1,142 @@
+# scheduler.py
+
+import math
+import os
+import random
+
+# Límites del intervalo entre comprobaciones de un mismo producto
+MIN_REFRESH_INTERVAL = float(os.getenv("MIN_REFRESH_INTERVAL", 60))        # 1 minuto
+MAX_REFRESH_INTERVAL = float(os.getenv("MAX_REFRESH_INTERVAL", 6 * 3600))  # 6 horas
+# Descargas permitidas por minuto entre todos los productos
+FETCH_BUDGET_PER_MINUTE = float(os.getenv("FETCH_BUDGET_PER_MINUTE", 120))
+# Si sobra presupuesto, adelantar los productos más próximos a vencer en lugar de dejarlo sin usar
+SCHEDULER_FILL_BUDGET = os.getenv("SCHEDULER_FILL_BUDGET", "1").lower() not in ("0", "false", "no")
+
+PRIOR_CHANGES = 0.25         # Se supone un cambio al día hasta tener datos del producto...
+PRIOR_HOURS = 6.0            # ...con el peso de 6 horas de observación
+HISTORY_HALF_LIFE = 72.0     # Horas en que las observaciones antiguas pierden la mitad de su peso
+CHECKS_PER_CHANGE = 4.0      # Comprobaciones que se quieren hacer en el tiempo medio entre cambios
+RECENT_CHANGE_WINDOW = 24 * 3600.0  # Los productos que han cambiado hace poco se comprueban más a menudo
+JITTER = 0.1                 # ±10 % para que los productos no se sincronicen
+
+
+class ProductSchedule:
+    """
+    Estado de planificación de un producto (todas las suscripciones a una misma URL canónica).
+
+    La próxima comprobación y el lease se guardan en scrape_targets; aquí solo está lo
+    que hace falta para estimar la volatilidad.
+    """
+    __slots__ = (
+        "url", "subscribers", "changes", "observed_hours", "last_change_at",
+        "last_checked_at", "last_result", "failures",
+    )
+
+    def __init__(self, url: str, subscribers: list):
+        self.url = url
+        self.subscribers = subscribers
+        self.changes = 0.0          # Cambios observados, con decaimiento
+        self.observed_hours = 0.0   # Horas observadas, con el mismo decaimiento
+        self.last_change_at = None
+        self.last_checked_at = None
+        self.last_result = None     # (importe, disponibilidad) de la última comprobación
+        self.failures = 0
+
+    @property
+    def change_rate(self) -> float:
+        """Cambios por hora estimados (media bayesiana con la estimación a priori)."""
+        return (self.changes + PRIOR_CHANGES) / (self.observed_hours + PRIOR_HOURS)
+
+
+def refresh_interval(entry, now: float, min_interval: float = MIN_REFRESH_INTERVAL,
+                     max_interval: float = MAX_REFRESH_INTERVAL) -> float:
+    """
+    Intervalo hasta la próxima comprobación de un producto.
+
+    Se busca comprobarlo CHECKS_PER_CHANGE veces en el tiempo medio entre cambios,
+    más a menudo cuantos más suscriptores tiene y si ha cambiado hace poco.
+    """
+    interval = 3600.0 / (entry.change_rate * CHECKS_PER_CHANGE)
+    interval /= 1.0 + math.log2(max(len(entry.subscribers), 1))
+    if entry.last_change_at is not None:
+        interval *= min(1.0, 0.25 + 0.75 * (now - entry.last_change_at) / RECENT_CHANGE_WINDOW)
+    return min(max(interval, min_interval), max_interval)
+
+
+def apply_result(entry, info, now: float, min_interval: float = MIN_REFRESH_INTERVAL,
+                 max_interval: float = MAX_REFRESH_INTERVAL) -> float:
+    """
+    Actualiza la volatilidad estimada de un producto con el resultado de una comprobación.
+
+    Args:
+        entry (ProductSchedule): Estado del producto; se modifica.
+        info (ProductInfo): Resultado de la descarga.
+        now (float): Instante de la comprobación, en segundos.
+
+    Returns:
+        float: Intervalo en segundos hasta la próxima comprobación.
+    """
+    if info.status == "error":
+        # Un fallo no dice nada de la volatilidad: se reintenta con espera creciente
+        entry.failures += 1
+        return min(min_interval * 2 ** entry.failures, max_interval)
+    entry.failures = 0
+
+    result = (info.amount, info.status)
+    changed = entry.last_result is not None and result != entry.last_result
+    if entry.last_checked_at is not None:
+        elapsed_hours = (now - entry.last_checked_at) / 3600.0
+        decay = 0.5 ** (elapsed_hours / HISTORY_HALF_LIFE)
+        entry.changes = entry.changes * decay + changed
+        entry.observed_hours = entry.observed_hours * decay + elapsed_hours
+    if changed:
+        entry.last_change_at = now
+    entry.last_result = result
+    entry.last_checked_at = now
+    return refresh_interval(entry, now, min_interval, max_interval)
+
+
+def jittered(interval: float, rng=random) -> float:
+    """Aplica al intervalo un ±JITTER aleatorio para que los productos no se sincronicen."""
+    return interval * rng.uniform(1 - JITTER, 1 + JITTER)
+
+
+def schedule_from_row(target, subscribers) -> ProductSchedule:
+    """
+    Reconstruye el estado de planificación de un producto a partir de su fila de
+    scrape_targets, tal como la devuelve claim_scrape_targets.
+    """
+    entry = ProductSchedule(target["url"], subscribers)
+    entry.changes = target["changes"]
+    entry.observed_hours = target["observed_hours"]
+    entry.last_change_at = target["last_change_at"]
+    entry.last_checked_at = target["last_checked_at"]
+    if target["last_status"] is not None:
+        entry.last_result = (target["last_amount"], target["last_status"])
+    entry.failures = target["failures"]
+    return entry
+
+
+def plan_next_check(target, subscribers, info, now: float, min_interval: float = MIN_REFRESH_INTERVAL,
+                    max_interval: float = MAX_REFRESH_INTERVAL, rng=random) -> tuple:
+    """
+    Replanifica un producto reservado con el resultado de su descarga.
+
+    Args:
+        target (dict): Fila de scrape_targets reservada.
+        subscribers (list): Suscripciones al producto.
+        info (ProductInfo): Resultado de la descarga.
+        now (float): Instante de la comprobación, en segundos epoch.
+
+    Returns:
+        tuple: (url, próxima comprobación, cambios, horas observadas, último cambio,
+            última comprobación, último importe, última disponibilidad, intervalo,
+            fallos seguidos), como la espera complete_scrape_targets.
+    """
+    entry = schedule_from_row(target, subscribers)
+    interval = apply_result(entry, info, now, min_interval, max_interval)
+    amount, status = entry.last_result or (None, None)
+    return (
+        entry.url, now + jittered(interval, rng), entry.changes, entry.observed_hours, entry.last_change_at,
+        entry.last_checked_at, amount, status, interval, entry.failures,
+    )
@@ -1,2 +1,7 @@
 #!/bin/bash
+# Workers de descarga (WORKER_PROCESSES, por defecto 1) y el bot de Telegram.
+# Los workers pueden ejecutarse también en otros hosts con `python worker.py`.
+for i in $(seq 1 "${WORKER_PROCESSES:-1}"); do
+    python worker.py &
+done
 python tracker.py
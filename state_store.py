@@ -0,0 +1,146 @@
+# state_store.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from executors import run_blocking
+from logger import config_logger
+
+logger = config_logger()
+
+# Dónde se guarda el estado de las conversaciones del menú: "memory" (por proceso,
+# se pierde al reiniciar) o "postgres" (sobrevive a los reinicios y se comparte entre réplicas)
+STATE_STORE = os.getenv("STATE_STORE", "memory").lower()
+STATE_TTL = float(os.getenv("STATE_TTL", 900))  # Segundos que el bot espera la respuesta de un usuario
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", 10000))  # Conversaciones abiertas en memoria
+
+
+class MemoryStateStore:
+    """
+    Estado de las conversaciones en memoria, indexado por chat_id.
+
+    Cada entrada caduca a los `ttl` segundos y, si hay más de `max_size`, se
+    descartan las menos usadas recientemente: los usuarios que abren el menú y no
+    terminan dejan de ocupar memoria. Es segura entre hilos.
+    """
+
+    def __init__(self, ttl: float = STATE_TTL, max_size: int = STATE_MAX_ENTRIES, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._entries = OrderedDict()  # chat_id -> (caduca_en, estado)
+        self._lock = threading.Lock()
+
+    def _get_fresh(self, chat_id):
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return None
+        expires_at, state = entry
+        if expires_at <= self._clock():
+            del self._entries[chat_id]
+            return None
+        return state
+
+    def get(self, chat_id):
+        """Devuelve el estado vigente de un chat, o None."""
+        with self._lock:
+            state = self._get_fresh(chat_id)
+            if state is not None:
+                self._entries.move_to_end(chat_id)
+            return state
+
+    def set(self, chat_id, state: dict):
+        """Guarda el estado de un chat; su caducidad empieza de nuevo."""
+        with self._lock:
+            self._entries[chat_id] = (self._clock() + self.ttl, state)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, chat_id):
+        """Elimina el estado de un chat y lo devuelve (None si no había uno vigente)."""
+        with self._lock:
+            state = self._get_fresh(chat_id)
+            self._entries.pop(chat_id, None)
+            return state
+
+    def purge(self) -> int:
+        """Borra las entradas caducadas y devuelve cuántas había."""
+        with self._lock:
+            now = self._clock()
+            expired = [chat_id for chat_id, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for chat_id in expired:
+                del self._entries[chat_id]
+            return len(expired)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    # Versiones para los handlers: en memoria no hace falta salir del event loop
+    async def aget(self, chat_id):
+        return self.get(chat_id)
+
+    async def aset(self, chat_id, state: dict):
+        self.set(chat_id, state)
+
+    async def apop(self, chat_id):
+        return self.pop(chat_id)
+
+
+class PostgresStateStore:
+    """
+    Estado de las conversaciones en la tabla user_states: sobrevive a los reinicios
+    y es el mismo para todas las réplicas del bot. La caducidad la aplica la consulta;
+    `maintenance.py purge-states` borra las filas caducadas.
+    """
+
+    def __init__(self, ttl: float = STATE_TTL):
+        # Import diferido: el almacén en memoria no necesita DATABASE_URL
+        import database
+
+        self.ttl = ttl
+        self._database = database
+
+    def get(self, chat_id):
+        return self._database.get_user_state(chat_id)
+
+    def set(self, chat_id, state: dict):
+        self._database.set_user_state(chat_id, state, self.ttl)
+
+    def pop(self, chat_id):
+        return self._database.pop_user_state(chat_id)
+
+    def purge(self) -> int:
+        return self._database.purge_user_states() or 0
+
+    async def aget(self, chat_id):
+        return await run_blocking("db", self.get, chat_id)
+
+    async def aset(self, chat_id, state: dict):
+        await run_blocking("db", self.set, chat_id, state)
+
+    async def apop(self, chat_id):
+        return await run_blocking("db", self.pop, chat_id)
+
+
+def create_state_store(kind: str = STATE_STORE):
+    """
+    Crea el almacén de estado configurado.
+
+    Args:
+        kind (str): "memory" o "postgres".
+
+    Returns:
+        MemoryStateStore | PostgresStateStore: Almacén de estado.
+    """
+    if kind == "postgres":
+        return PostgresStateStore()
+    if kind != "memory":
+        logger.warning(f"STATE_STORE desconocido ({kind}), se usa el almacén en memoria")
+    return MemoryStateStore()
+
+
+state_store = create_state_store()
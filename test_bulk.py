@@ -0,0 +1,92 @@
+"""
+Pruebas de la importación y exportación en bloque de productos.
+
+Las de la base de datos necesitan un PostgreSQL local en DATABASE_URL; los datos se
+crean en un esquema propio (bulk_test) que se borra al terminar.
+
+Uso:
+    python -m unittest test_bulk -v
+"""
+import csv
+import io
+import os
+import unittest
+from decimal import Decimal
+
+from bulk import parse_import
+from test_support import ScratchSchemaTestCase
+
+URLS = [f"https://www.amazon.es/dp/B00000000{i}" for i in range(3)]
+
+
+class ParseImportTest(unittest.TestCase):
+
+    def test_lines_are_normalized_and_deduplicated(self):
+        text = (
+            "# Lista de la compra\n"
+            f"{URLS[0]}?ref=abc\n"
+            "\n"
+            f"Auriculares: https://www.amazon.es/Auriculares-Inalambricos/dp/B000000001/ref=sr_1_1\n"
+            f"{URLS[0]}\n"
+            "https://example.com/dp/B000000009\n"
+        )
+        urls, invalid = parse_import(text)
+        self.assertEqual(urls, URLS[:2])
+        self.assertEqual(invalid, ["https://example.com/dp/B000000009"])
+
+    def test_csv_with_url_column(self):
+        text = f"name,url\nUno,{URLS[0]}\nDos,{URLS[1]}\nTres,no es una url\n"
+        self.assertEqual(parse_import(text, "productos.csv"), (URLS[:2], ["no es una url"]))
+
+    def test_csv_without_header_uses_first_column(self):
+        text = f"{URLS[0]},Uno\n{URLS[2]},Tres\n"
+        self.assertEqual(parse_import(text, "productos.CSV"), ([URLS[0], URLS[2]], []))
+
+    def test_jsonl(self):
+        text = f'{{"url": "{URLS[1]}", "name": "Dos"}}\n{{"name": "sin url"}}\n'
+        self.assertEqual(parse_import(text, "productos.jsonl"), ([URLS[1]], [""]))
+
+
+@unittest.skipUnless(os.getenv("DATABASE_URL"), "Necesita un PostgreSQL local en DATABASE_URL")
+class BulkDatabaseTest(ScratchSchemaTestCase):
+    SCHEMA = "bulk_test"
+
+    def setUp(self):
+        with self.database.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("TRUNCATE users, products, price_history, scrape_targets CASCADE")
+
+    def test_import_queues_scrapes(self):
+        from bulk import import_products
+
+        self.database.add_user(1)
+        self.database.add_product(1, URLS[0], "Uno", Decimal("10.00"), "EUR", "available")
+        self.assertEqual(import_products(1, URLS), 2)
+        self.assertEqual(import_products(1, URLS), 0)
+        with self.database.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT url FROM scrape_targets ORDER BY url")
+                self.assertEqual([row["url"] for row in cursor.fetchall()], URLS)
+
+        products = {row["url"]: row for row in self.database.get_all_products()}
+        self.database.set_product_names([(products[URLS[1]]["id"], "Dos"), (products[URLS[0]]["id"], "Otro")])
+        names = {row["url"]: row["name"] for row in self.database.get_products(1)}
+        self.assertEqual(names, {URLS[0]: "Uno", URLS[1]: "Dos", URLS[2]: None})
+
+    def test_export_streams_history(self):
+        from bulk import EXPORT_COLUMNS, write_export
+
+        self.database.add_user(1)
+        product_id = self.database.add_product(1, URLS[0], "Uno", Decimal("10.00"), "EUR", "available")
+        self.database.add_product(1, URLS[1], "Dos")
+        self.database.record_price_observations([(product_id, Decimal("9.50"), "EUR", "available")])
+
+        out = io.StringIO(newline="")
+        self.assertEqual(write_export(1, out), 3)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(tuple(rows[0]), EXPORT_COLUMNS)
+        self.assertEqual([(row[0], row[4]) for row in rows[1:]], [(URLS[0], "10.00"), (URLS[0], "9.50"), (URLS[1], "")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest import mock
+
+import charts
+from charts import ChartCache, render_price_history
+
+
+def make_history(points, product_id=1, checked_at=None):
+    checked_at = checked_at or datetime(2024, 1, 1) + timedelta(days=points)
+    return [
+        {"product_id": product_id, "timestamp": datetime(2024, 1, 1) + timedelta(days=i),
+         "amount": Decimal(100 + i % 7), "currency": "EUR", "checked_at": checked_at}
+        for i in range(points)
+    ]
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_renders_png_in_memory(self):
+        png = render_price_history(make_history(30))
+        self.assertTrue(png.startswith(b"\x89PNG\r\n\x1a\n"))
+
+    def test_renders_downsampled_series_with_band(self):
+        series = [dict(row, low=row["amount"] - 5, high=row["amount"] + 5) for row in make_history(200)]
+        self.assertTrue(render_price_history(series).startswith(b"\x89PNG"))
+
+    def test_parallel_renders_are_independent(self):
+        # Sin estado global de pyplot: cada hilo dibuja su propia figura
+        histories = [make_history(10 + i) for i in range(8)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            parallel = list(executor.map(render_price_history, histories))
+        self.assertEqual(parallel, [render_price_history(history) for history in histories])
+
+
+class ChartCacheTest(unittest.TestCase):
+
+    def test_renders_once_until_history_changes(self):
+        cache = ChartCache(max_size=10)
+        history = make_history(20)
+        with mock.patch.object(charts, "render_price_history", wraps=render_price_history) as render:
+            first = cache.get_or_render(1, history)
+            self.assertEqual(cache.get_or_render(1, history), first)
+            self.assertEqual(render.call_count, 1)
+
+            # Un precio nuevo cambia la clave
+            cache.get_or_render(1, make_history(21))
+            self.assertEqual(render.call_count, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_new_check_invalidates_same_looking_series(self):
+        # Una bajada que se recupera dentro del último tramo solo cambia su mínimo: mismos
+        # timestamps, último precio y número de puntos, pero otra comprobación
+        cache = ChartCache(max_size=10)
+        history = make_history(20)
+        dipped = make_history(20, checked_at=history[-1]["checked_at"] + timedelta(hours=1))
+        for point in dipped:
+            point["low"] = point["high"] = point["amount"]
+        dipped[-1]["low"] = Decimal(50)
+        with mock.patch.object(charts, "render_price_history", wraps=render_price_history) as render:
+            cache.get_or_render(1, history)
+            cache.get_or_render(1, dipped)
+            # Otro rango pedido es otra gráfica
+            cache.get_or_render(1, dipped, points=50)
+            self.assertEqual(render.call_count, 3)
+
+    def test_concurrent_requests_share_one_render(self):
+        cache = ChartCache(max_size=10)
+        history = make_history(20)
+        with mock.patch.object(charts, "render_price_history", wraps=render_price_history) as render:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(lambda _: cache.get_or_render(1, history), range(8)))
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(len(set(results)), 1)
+
+    def test_lru_eviction(self):
+        cache = ChartCache(max_size=2)
+        for product_id in (1, 2, 3):
+            cache.put((product_id,), b"png")
+        self.assertIsNone(cache.get((1,)))
+        self.assertEqual(cache.get((3,)), b"png")
+
+
+if __name__ == "__main__":
+    unittest.main()
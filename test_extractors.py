@@ -0,0 +1,139 @@
+"""
+Pruebas de los extractores de título y precio con las distintas plantillas de Amazon.
+
+Uso:
+    python -m unittest test_extractors -v
+"""
+import unittest
+from decimal import Decimal
+
+from extractors import (
+    EXTRACTORS, RESPONSE_CAPTCHA, RESPONSE_DOG, RESPONSE_GEO_REDIRECT, RESPONSE_OK, RESPONSE_UNAVAILABLE,
+    IncrementalExtractor, LxmlExtractor, SoupExtractor, classify_page, classify_response, extract_product,
+)
+
+TITLE = '<span id="productTitle" class="a-size-large">\n   Auriculares  inalámbricos \n</span>'
+
+PAGES = {
+    "core_price": (
+        '<div id="corePriceDisplay_desktop_feature_div"><span class="a-price aok-align-center">'
+        '<span class="a-offscreen">1.234,56 €</span><span aria-hidden="true">1.234,56 €</span></span></div>'
+        '<span class="a-price"><span class="a-offscreen">9,99 €</span></span>',
+        Decimal("1234.56"), "EUR",
+    ),
+    "priceblock": ('<span id="priceblock_dealprice">$1,099.00</span>', Decimal("1099.00"), "USD"),
+    "whole_fraction": (
+        '<span class="a-price-symbol">£</span><span class="a-price-whole">49.</span><span class="a-price-fraction">95</span>',
+        Decimal("49.95"), "GBP",
+    ),
+    "offscreen_only": ('<span class="a-price a-text-price"><span class="a-offscreen">¥3,480</span></span>', Decimal("3480.0"), "JPY"),
+    "unavailable": ('<div id="availability"><span>No disponible por el momento.</span></div>', None, None),
+}
+
+
+def page(body, title=TITLE):
+    return f"<html><head><title>Amazon</title></head><body><div>{title}</div><div>{body}</div></body></html>"
+
+
+class ExtractorsTest(unittest.TestCase):
+
+    def test_layouts(self):
+        for extractor in (LxmlExtractor(), SoupExtractor()):
+            for layout, (body, amount, currency) in PAGES.items():
+                with self.subTest(extractor=extractor.name, layout=layout):
+                    fields = extractor.extract(page(body))
+                    self.assertEqual(fields.title, "Auriculares inalámbricos")
+                    self.assertEqual(fields.amount, amount)
+                    self.assertEqual(fields.currency, currency)
+
+    def test_chain_falls_back_when_page_not_recognized(self):
+        calls = []
+
+        class Blind:
+            name = "blind"
+
+            def extract(self, html):
+                calls.append(self.name)
+                return LxmlExtractor().extract("<html></html>")
+
+        fields = extract_product(page(PAGES["priceblock"][0]), extractors=[Blind()] + EXTRACTORS)
+        self.assertEqual(calls, ["blind"])
+        self.assertEqual(fields.amount, Decimal("1099.00"))
+
+    def test_chain_stops_on_unavailable_page(self):
+        soup_calls = []
+        soup = SoupExtractor()
+        original = soup.extract
+        soup.extract = lambda html: soup_calls.append(1) or original(html)
+        fields = extract_product(page(PAGES["unavailable"][0]), extractors=[LxmlExtractor(), soup])
+        self.assertEqual(fields.title, "Auriculares inalámbricos")
+        self.assertIsNone(fields.amount)
+        self.assertEqual(soup_calls, [])
+
+
+class IncrementalExtractorTest(unittest.TestCase):
+
+    def feed(self, html, chunk_size=64):
+        data = html.encode("utf-8")
+        extractor = IncrementalExtractor("utf-8")
+        for start in range(0, len(data), chunk_size):
+            if extractor.feed(data[start:start + chunk_size]):
+                break
+        return extractor, extractor.close()
+
+    def test_stops_after_title_and_price(self):
+        html = page(PAGES["core_price"][0] + "<div>reseñas</div>" * 5000)
+        extractor, fields = self.feed(html)
+        self.assertTrue(extractor.done)
+        self.assertLess(extractor.bytes_read, len(html) // 10)
+        self.assertEqual(fields, LxmlExtractor().extract(html))
+
+    def test_falls_back_to_full_extraction(self):
+        for layout in ("whole_fraction", "offscreen_only", "unavailable"):
+            with self.subTest(layout=layout):
+                html = page(PAGES[layout][0])
+                extractor, fields = self.feed(html)
+                self.assertFalse(extractor.done)
+                self.assertEqual(fields, LxmlExtractor().extract(html))
+
+
+CAPTCHA_PAGE = (
+    '<html><head><title>Amazon.es</title></head><body><h4>Introduce los caracteres que ves a continuación</h4>'
+    '<form method="get" action="/errors/validateCaptcha"><input id="captchacharacters" name="field-keywords"></form>'
+    '</body></html>'
+)
+DOG_PAGE = (
+    '<html><head><title>Amazon.es</title></head><body><a href="/ref=cs_503_logo">'
+    '<img alt="Lo sentimos. Se ha producido un error"></a></body></html>'
+)
+URL = "https://www.amazon.es/dp/B08N5WRWNW"
+
+
+class ClassifyTest(unittest.TestCase):
+
+    def test_pages(self):
+        self.assertEqual(classify_page(CAPTCHA_PAGE), RESPONSE_CAPTCHA)
+        self.assertEqual(classify_page(DOG_PAGE.encode()), RESPONSE_DOG)
+        self.assertEqual(classify_page(page(PAGES["core_price"][0])), RESPONSE_OK)
+
+    def test_product_page_mentioning_markers_is_ok(self):
+        html = page(PAGES["core_price"][0] + "<p>Dogs of Amazon</p>")
+        self.assertEqual(classify_page(html), RESPONSE_OK)
+
+    def test_responses(self):
+        self.assertEqual(classify_response(URL, URL, 200, CAPTCHA_PAGE), RESPONSE_CAPTCHA)
+        self.assertEqual(classify_response(URL, URL, 503, DOG_PAGE), RESPONSE_DOG)
+        self.assertEqual(classify_response(URL, URL, 503, b"<html>Service Unavailable</html>"), RESPONSE_DOG)
+        self.assertEqual(classify_response(URL, URL, 503), RESPONSE_OK)
+        self.assertEqual(classify_response(URL, URL, 404), RESPONSE_UNAVAILABLE)
+        self.assertEqual(classify_response(URL, URL, 200, page(PAGES["priceblock"][0])), RESPONSE_OK)
+
+    def test_redirects(self):
+        self.assertEqual(classify_response(URL, "https://www.amazon.com/dp/B08N5WRWNW", 200), RESPONSE_GEO_REDIRECT)
+        self.assertEqual(classify_response(URL, "https://www.amazon.es/ref=cs_404_link", 200), RESPONSE_GEO_REDIRECT)
+        # Una variante del mismo producto en el mismo marketplace es una respuesta válida
+        self.assertEqual(classify_response(URL, "https://www.amazon.es/dp/B08N5WRWNX?th=1", 200), RESPONSE_OK)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import threading
+import time
+import unittest
+import urllib.request
+
+import metrics
+from metrics import Counter, Gauge, Histogram, StageProfiler
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counter_and_gauge_render(self):
+        counter = Counter("test_requests_total", "Peticiones", ["proxy", "outcome"])
+        counter.inc(proxy="http://1.2.3.4:80", outcome="ok")
+        counter.inc(2, proxy="http://1.2.3.4:80", outcome="ok")
+        gauge = Gauge("test_pending", "Pendientes")
+        gauge.set(7)
+        text = metrics.render()
+        self.assertIn("# TYPE test_requests_total counter", text)
+        self.assertIn('test_requests_total{proxy="http://1.2.3.4:80",outcome="ok"} 3', text)
+        self.assertIn("test_pending 7", text)
+        self.assertIn("process_cpu_seconds_total", text)
+
+    def test_labels_must_match(self):
+        counter = Counter("test_labels_total", "Etiquetas", ["function"])
+        with self.assertRaises(ValueError):
+            counter.inc(kind="db")
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("test_seconds", "Duración", ["stage"], buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value, stage="parse")
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{stage="parse",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="parse",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{stage="parse",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{stage="parse"} 4', lines)
+        self.assertEqual(histogram.count(stage="parse"), 4)
+
+    def test_metrics_endpoint(self):
+        Counter("test_endpoint_total", "Endpoint").inc()
+        server = metrics.start_metrics_server(port=0)
+        self.assertIsNone(server)
+        server = metrics.start_metrics_server(port=_free_port(), host="127.0.0.1")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics", timeout=5) as response:
+                self.assertIn("text/plain", response.headers["Content-Type"])
+                self.assertIn("test_endpoint_total 1", response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class StageProfilerTest(unittest.TestCase):
+
+    def test_samples_are_attributed_to_stage(self):
+        profiler = StageProfiler({"parse"}, interval=0.001)
+
+        def busy_parse():
+            self.assertTrue(profiler.enter("parse"))
+            try:
+                deadline = time.monotonic() + 0.2
+                while time.monotonic() < deadline:
+                    sum(range(1000))
+            finally:
+                profiler.exit()
+
+        # Las etapas no perfiladas no cuentan
+        self.assertFalse(profiler.enter("db"))
+        profiler.start()
+        thread = threading.Thread(target=busy_parse)
+        thread.start()
+        thread.join()
+        profiler.stop()
+
+        self.assertGreater(profiler.summary().get("parse", 0), 10)
+        self.assertIn("busy_parse", profiler.collapsed("parse"))
+        self.assertEqual(profiler.collapsed("db"), "")
+
+
+def _free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+if __name__ == "__main__":
+    unittest.main()
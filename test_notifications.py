@@ -0,0 +1,120 @@
+import asyncio
+import time
+import unittest
+
+from telegram.error import Forbidden, RetryAfter, TimedOut
+
+from notifications import MAX_MESSAGE_LENGTH, NotificationDispatcher, PriceChange, build_messages
+
+
+class FakeBot:
+    """Bot que guarda los mensajes enviados y puede fallar en los primeros envíos."""
+
+    def __init__(self, errors=None):
+        self.sent = []
+        self.errors = list(errors or [])
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await asyncio.sleep(0)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((time.monotonic(), chat_id, text))
+
+
+def change(i):
+    return PriceChange(f"Producto {i}", "9,99 €", "12,50 €")
+
+
+class BuildMessagesTest(unittest.TestCase):
+
+    def test_single_change_keeps_message(self):
+        (message,) = build_messages([change(1)])
+        self.assertTrue(message.startswith("El precio del producto ha cambiado:"))
+        self.assertIn("9,99 €", message)
+
+    def test_digest_groups_changes(self):
+        (message,) = build_messages([change(i) for i in range(3)])
+        self.assertTrue(message.startswith("Han cambiado los precios de 3 productos:"))
+        for i in range(3):
+            self.assertIn(f"Producto {i}", message)
+
+    def test_digest_is_split_at_telegram_limit(self):
+        messages = build_messages([change(i) for i in range(200)])
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(all(len(message) <= MAX_MESSAGE_LENGTH for message in messages))
+        self.assertEqual(sum(message.count("Nuevo precio") for message in messages), 200)
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def run_dispatcher(self, dispatcher, changes):
+        async def run():
+            for chat_id, item in changes:
+                dispatcher.add(chat_id, item)
+            started = time.monotonic()
+            dispatcher.flush()
+            # flush no espera al envío
+            self.assertLess(time.monotonic() - started, 0.05)
+            await asyncio.wait_for(dispatcher.join(), timeout=10)
+        asyncio.run(run())
+
+    def test_one_message_per_chat_and_cycle(self):
+        bot = FakeBot()
+        dispatcher = NotificationDispatcher(bot, global_rate=1000, chat_rate=1000)
+        self.run_dispatcher(dispatcher, [(1, change(1)), (2, change(2)), (1, change(3))])
+        self.assertEqual(sorted(chat_id for _, chat_id, _ in bot.sent), [1, 2])
+        self.assertEqual(dispatcher.stats["digests"], 1)
+
+    def test_per_chat_rate_does_not_block_other_chats(self):
+        bot = FakeBot()
+        dispatcher = NotificationDispatcher(bot, global_rate=1000, chat_rate=10)
+        # 4 mensajes al chat 1 (resumen partido) y uno a cada uno de otros 5 chats
+        changes = [(1, PriceChange("x" * 3000, "1", "2")) for _ in range(4)]
+        changes += [(chat_id, change(chat_id)) for chat_id in range(2, 7)]
+        self.run_dispatcher(dispatcher, changes)
+
+        chat_1 = [sent_at for sent_at, chat_id, _ in bot.sent if chat_id == 1]
+        self.assertEqual(len(chat_1), 4)
+        gaps = [b - a for a, b in zip(chat_1, chat_1[1:])]
+        self.assertTrue(all(gap >= 0.08 for gap in gaps), gaps)
+        # Los demás chats se atienden sin esperar a que termine el chat 1
+        others = [sent_at for sent_at, chat_id, _ in bot.sent if chat_id != 1]
+        self.assertLess(max(others), chat_1[-1])
+
+    def test_global_rate(self):
+        bot = FakeBot()
+        dispatcher = NotificationDispatcher(bot, global_rate=20, chat_rate=1000)
+        self.run_dispatcher(dispatcher, [(chat_id, change(chat_id)) for chat_id in range(40)])
+        self.assertEqual(len(bot.sent), 40)
+        # 20 de ráfaga inicial y 20 más a 20/s
+        self.assertGreaterEqual(bot.sent[-1][0] - bot.sent[0][0], 0.9)
+
+    def test_retry_after_pauses_and_retries(self):
+        bot = FakeBot(errors=[RetryAfter(1)])
+        dispatcher = NotificationDispatcher(bot, global_rate=1000, chat_rate=1000, concurrency=1)
+        started = time.monotonic()
+        self.run_dispatcher(dispatcher, [(1, change(1)), (2, change(2))])
+        self.assertEqual(sorted(chat_id for _, chat_id, _ in bot.sent), [1, 2])
+        self.assertEqual(dispatcher.stats["flood_waits"], 1)
+        self.assertGreaterEqual(min(sent_at for sent_at, _, _ in bot.sent) - started, 0.9)
+
+    def test_repeated_flood_waits_are_dropped_after_max_attempts(self):
+        bot = FakeBot(errors=[RetryAfter(1), RetryAfter(1)])
+        dispatcher = NotificationDispatcher(bot, global_rate=1000, chat_rate=1000, concurrency=1, max_attempts=2)
+        # join() termina aunque Telegram siga pidiendo esperar
+        self.run_dispatcher(dispatcher, [(1, change(1))])
+        self.assertEqual(bot.sent, [])
+        self.assertEqual(dispatcher.stats["flood_waits"], 2)
+        self.assertEqual(dispatcher.stats["dropped"], 1)
+
+    def test_network_errors_are_retried_and_forbidden_dropped(self):
+        bot = FakeBot(errors=[TimedOut(), Forbidden("bloqueado")])
+        dispatcher = NotificationDispatcher(bot, global_rate=1000, chat_rate=1000, concurrency=1, retry_delay=0.01)
+        self.run_dispatcher(dispatcher, [(1, change(1)), (2, change(2))])
+        self.assertEqual(len(bot.sent), 1)
+        self.assertEqual(dispatcher.stats["retries"], 1)
+        self.assertEqual(dispatcher.stats["dropped"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
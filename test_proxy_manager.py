@@ -0,0 +1,201 @@
+"""
+Simulador del gestor de proxies: compara la latencia media por descarga frente a la
+rotación round-robin (itertools.cycle) con proxies falsos de distinta calidad.
+
+Uso:
+    python -m unittest test_proxy_manager -v
+"""
+import itertools
+import json
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import price_tracker
+from proxies import ProxyManager
+from ratelimit import CircuitBreaker, RetryBudget
+from test_support import SimulatedClock
+
+TIMEOUT = 10.0      # Coste de un intento fallido (timeout de la petición)
+MAX_ATTEMPTS = 5
+
+
+class FakeProxy:
+    def __init__(self, url, failure_rate, latency):
+        self.url = url
+        self.failure_rate = failure_rate
+        self.latency = latency
+
+    def attempt(self, rng):
+        """Devuelve (éxito, segundos empleados)."""
+        if rng.random() < self.failure_rate:
+            return False, TIMEOUT
+        return True, rng.expovariate(1 / self.latency)
+
+
+FAKE_PROXIES = [
+    FakeProxy("http://10.0.0.1:8080", 0.02, 0.4),
+    FakeProxy("https://10.0.0.2:8443", 0.05, 0.8),
+    FakeProxy("socks5://10.0.0.3:1080", 0.10, 1.5),
+    FakeProxy("http://10.0.0.4:8080", 0.60, 2.0),
+    FakeProxy("http://10.0.0.5:8080", 0.95, 3.0),
+    FakeProxy("socks5://10.0.0.6:1080", 1.00, 3.0),
+]
+
+
+def simulate(pick, report, clock, rng, fetches):
+    """Simula descargas con reintentos; devuelve la latencia media por descarga."""
+    total = 0.0
+    for _ in range(fetches):
+        elapsed = 0.0
+        for _ in range(MAX_ATTEMPTS):
+            proxy = pick()
+            ok, cost = proxy.attempt(rng)
+            elapsed += cost
+            clock.now += cost
+            report(proxy, ok, cost)
+            if ok:
+                break
+        total += elapsed
+        clock.now += 1.0  # Tiempo entre descargas
+    return total / fetches
+
+
+class ProxyManagerSimulationTest(unittest.TestCase):
+
+    def make_manager(self, clock, seed=1):
+        manager = ProxyManager([{"url": proxy.url} for proxy in FAKE_PROXIES], clock=clock, rng=random.Random(seed))
+        by_url = {proxy.url: proxy for proxy in FAKE_PROXIES}
+        return manager, by_url
+
+    def test_lower_mean_latency_than_round_robin(self):
+        fetches = 3000
+
+        clock = SimulatedClock()
+        cycle = itertools.cycle(FAKE_PROXIES)
+        round_robin = simulate(lambda: next(cycle), lambda *args: None, clock, random.Random(7), fetches)
+
+        clock = SimulatedClock()
+        manager, by_url = self.make_manager(clock)
+        states = {}
+
+        def pick():
+            state = manager.acquire()
+            states[state.url] = state
+            return by_url[state.url]
+
+        def report(proxy, ok, cost):
+            state = states[proxy.url]
+            if ok:
+                manager.report_success(state, cost)
+            else:
+                manager.report_failure(state, "timeout", cost)
+
+        adaptive = simulate(pick, report, clock, random.Random(7), fetches)
+
+        self.assertLess(adaptive, round_robin * 0.5,
+                        f"Latencia media por descarga: round-robin {round_robin:.2f} s, gestor de salud {adaptive:.2f} s")
+
+    def test_quarantine_uses_exponential_backoff(self):
+        clock = SimulatedClock()
+        manager = ProxyManager([{"url": "http://10.0.0.9:8080"}], clock=clock)
+        state = manager.acquire()
+
+        manager.report_failure(state, "timeout")
+        self.assertIs(manager.acquire(), state)
+
+        manager.report_failure(state, "timeout")
+        first = state.quarantined_until - clock.now
+        self.assertIsNone(manager.acquire())
+
+        clock.now = state.quarantined_until
+        manager.report_failure(state, "timeout")
+        self.assertAlmostEqual(state.quarantined_until - clock.now, first * 2)
+
+        clock.now = state.quarantined_until
+        manager.report_success(state, 0.5)
+        self.assertIs(manager.acquire(), state)
+
+    def test_supports_all_listed_schemes(self):
+        manager = ProxyManager([
+            {"type": "HTTP", "url": "http://10.0.0.1:80"},
+            {"type": "HTTPS", "url": "https://10.0.0.2:443"},
+            {"type": "SOCKS5", "url": "socks5://10.0.0.3:1080"},
+        ])
+        self.assertEqual({proxy["type"] for proxy in manager.snapshot()}, {"http", "https", "socks5"})
+
+    def test_hot_reload_keeps_stats(self):
+        clock = SimulatedClock()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "proxies.json")
+            with open(path, "w") as f:
+                json.dump([{"url": "http://10.0.0.1:80"}], f)
+            manager = ProxyManager([], proxies_file=path, clock=clock)
+            state = manager.acquire()
+            manager.report_success(state, 0.3)
+
+            with open(path, "w") as f:
+                f.write("http://10.0.0.1:80\nsocks5://10.0.0.2:1080\n")
+            os.utime(path, (1, 1))
+            clock.now += 60
+            manager.reload_if_changed()
+
+            snapshot = {proxy["url"]: proxy for proxy in manager.snapshot()}
+            self.assertEqual(set(snapshot), {"http://10.0.0.1:80", "socks5://10.0.0.2:1080"})
+            self.assertEqual(snapshot["http://10.0.0.1:80"]["latency_ewma"], 0.3)
+
+
+class FetchRouteTest(unittest.TestCase):
+    """Elección de ruta de fetch_with_retries cuando hay circuitos de proxy abiertos."""
+
+    URL = "https://www.amazon.es/dp/B08HM5L35D"
+    PROXIES = ["http://10.0.0.1:8080", "http://10.0.0.2:8080"]
+
+    def setUp(self):
+        self.clock = SimulatedClock()
+        self.breaker = CircuitBreaker("proxy", threshold=0.5, window=4, min_requests=2, cooldown=60,
+                                      probe_interval=30, clock=self.clock)
+        # Sin presupuesto de reintentos: solo cabe el primer intento
+        self.budget = RetryBudget(ratio=0, min_per_second=0, max_balance=0, clock=self.clock)
+        manager = ProxyManager([{"url": url} for url in self.PROXIES], clock=self.clock)
+        for name, value in (("proxy_manager", manager), ("proxy_breaker", self.breaker), ("retry_budget", self.budget),
+                            ("domain_breaker", CircuitBreaker("marketplace", clock=self.clock))):
+            patcher = mock.patch.object(price_tracker, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def open_circuit(self, key):
+        for _ in range(2):
+            self.breaker.record(key, True)
+
+    def routes(self):
+        attempts = price_tracker._FetchAttempts(self.URL)
+        return attempts, [(proxy.url if proxy else None, delay) for _, proxy, delay in attempts]
+
+    def test_open_proxy_is_skipped_within_attempt(self):
+        self.open_circuit(self.PROXIES[0])
+        _, routes = self.routes()
+        self.assertEqual(routes, [(self.PROXIES[1], 0.0)])
+
+    def test_falls_back_to_direct(self):
+        for url in self.PROXIES:
+            self.open_circuit(url)
+        _, routes = self.routes()
+        self.assertEqual(routes, [(None, 0.0)])
+
+    def test_no_route_gives_up_without_retrying(self):
+        for key in (*self.PROXIES, "direct"):
+            self.open_circuit(key)
+        with mock.patch.object(self.budget, "try_retry", wraps=self.budget.try_retry) as try_retry:
+            attempts, routes = self.routes()
+        self.assertEqual(routes, [])
+        try_retry.assert_not_called()
+        with self.assertRaises(price_tracker.BlockedResponse) as raised:
+            attempts.give_up()
+        self.assertEqual(raised.exception.kind, "circuit_open")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""
+Pruebas del limitador por dominio/proxy, del presupuesto de reintentos y de los cortacircuitos.
+
+Uso:
+    python -m unittest test_ratelimit -v
+"""
+import unittest
+from email.utils import formatdate
+
+from ratelimit import CircuitBreaker, RateLimiter, RetryBudget, TokenBucket, parse_retry_after
+from test_support import SimulatedClock
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        clock = SimulatedClock()
+        bucket = TokenBucket(rate=2.0, capacity=3, clock=clock)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        clock.now += 0.5
+        self.assertEqual(bucket.reserve(), 0.0)
+
+    def test_pause_blocks_tokens(self):
+        clock = SimulatedClock()
+        bucket = TokenBucket(rate=10.0, capacity=10, clock=clock)
+        bucket.pause(30)
+        self.assertAlmostEqual(bucket.reserve(), 30)
+        clock.now += 30
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_aimd_on_429(self):
+        clock = SimulatedClock()
+        limiter = RateLimiter(4.0, 5, min_rate=0.5, max_rate=8.0, clock=clock)
+        limiter.observe("amazon.es", 429, "12")
+        self.assertEqual(limiter.rates()["amazon.es"], 2.0)
+        self.assertAlmostEqual(limiter.bucket("amazon.es").reserve(), 12)
+
+        for _ in range(5):
+            limiter.observe("amazon.es", 429)
+        self.assertEqual(limiter.rates()["amazon.es"], 0.5)
+
+        for _ in range(10):
+            limiter.observe("amazon.es", 200)
+        self.assertAlmostEqual(limiter.rates()["amazon.es"], 1.0)
+        # Los dominios son independientes
+        self.assertEqual(limiter.bucket("amazon.com").rate, 4.0)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("7"), 7.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("mañana"))
+        self.assertAlmostEqual(parse_retry_after(formatdate(1000, usegmt=True), now=990), 10.0)
+
+
+class RetryBudgetTest(unittest.TestCase):
+
+    def test_retries_bounded_by_ratio(self):
+        clock = SimulatedClock()
+        budget = RetryBudget(ratio=0.25, min_per_second=0.0, clock=clock)
+        for _ in range(100):
+            budget.record_request()
+        retries = sum(budget.try_retry() for _ in range(100))
+        self.assertEqual(retries, 25)
+        self.assertEqual(budget.exhausted, 75)
+
+    def test_minimum_retries_per_second(self):
+        clock = SimulatedClock()
+        budget = RetryBudget(ratio=0.0, min_per_second=0.5, clock=clock)
+        self.assertFalse(budget.try_retry())
+        clock.now += 2
+        self.assertTrue(budget.try_retry())
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def make_breaker(self, clock):
+        return CircuitBreaker("test", threshold=0.5, window=10, min_requests=4, cooldown=60,
+                              max_cooldown=240, probe_interval=30, clock=clock)
+
+    def test_opens_above_block_rate(self):
+        clock = SimulatedClock()
+        breaker = self.make_breaker(clock)
+        for blocked in (False, True, False):
+            breaker.record("amazon.es", blocked)
+        self.assertEqual(breaker.state("amazon.es"), CircuitBreaker.CLOSED)
+        breaker.record("amazon.es", True)
+        self.assertEqual(breaker.state("amazon.es"), CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow("amazon.es"))
+        self.assertFalse(breaker.available("amazon.es"))
+        # Las demás claves no se ven afectadas
+        self.assertTrue(breaker.allow("amazon.de"))
+
+    def test_probes_slowly_then_closes(self):
+        clock = SimulatedClock()
+        breaker = self.make_breaker(clock)
+        for _ in range(4):
+            breaker.record("proxy", True)
+        clock.now += 60
+        self.assertTrue(breaker.available("proxy"))
+        self.assertTrue(breaker.allow("proxy"))
+        self.assertEqual(breaker.state("proxy"), CircuitBreaker.HALF_OPEN)
+        # Un solo sondeo por intervalo
+        self.assertFalse(breaker.allow("proxy"))
+        breaker.record("proxy", False)
+        self.assertEqual(breaker.state("proxy"), CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow("proxy"))
+
+    def test_blocked_probe_doubles_cooldown(self):
+        clock = SimulatedClock()
+        breaker = self.make_breaker(clock)
+        changes = []
+        breaker._on_change = lambda name, key, state: changes.append(state)
+        for _ in range(4):
+            breaker.record("proxy", True)
+        clock.now += 60
+        self.assertTrue(breaker.allow("proxy"))
+        breaker.record("proxy", True)
+        clock.now += 60
+        self.assertFalse(breaker.allow("proxy"))
+        clock.now += 60
+        self.assertTrue(breaker.allow("proxy"))
+        self.assertEqual(changes, ["open", "half_open", "open", "half_open"])
+
+
+if __name__ == "__main__":
+    unittest.main()
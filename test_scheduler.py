@@ -0,0 +1,179 @@
+"""
+Pruebas y simulación de la planificación de los workers: con el mismo presupuesto de
+descargas, detecta antes los cambios de precio que recorrer el catálogo en bucle.
+
+La simulación reproduce en memoria la reserva de claim_scrape_targets (productos
+vencidos por orden de next_due_at, presupuesto global en token bucket y, si sobra,
+adelanto de productos no descargados en los últimos min_interval segundos) y
+replanifica cada producto con plan_next_check, igual que worker.process_targets.
+
+Uso:
+    python -m unittest test_scheduler -v
+"""
+import bisect
+import random
+import unittest
+from collections import namedtuple
+
+from scheduler import plan_next_check
+
+Info = namedtuple("Info", ["amount", "status"])
+
+HOUR = 3600.0
+
+
+class SimulatedTargets:
+    """Tabla scrape_targets en memoria con la política de reserva de claim_scrape_targets."""
+
+    def __init__(self, urls, budget_per_minute, min_interval=60.0, fill_budget=True):
+        self.rows = {url: {
+            "url": url, "next_due_at": 0.0, "taken_at": None, "changes": 0.0, "observed_hours": 0.0,
+            "last_change_at": None, "last_checked_at": None, "last_amount": None, "last_status": None,
+            "failures": 0,
+        } for url in urls}
+        self.rate = budget_per_minute / 60.0
+        self.capacity = max(budget_per_minute, 1.0)
+        self.min_interval = min_interval
+        self.fill_budget = fill_budget
+        self.tokens = 0.0
+        self.updated_at = 0.0
+
+    def claim(self, now, limit):
+        available = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        ready = [
+            row for row in self.rows.values()
+            if row["next_due_at"] <= now
+            or (self.fill_budget and (row["taken_at"] is None or row["taken_at"] <= now - self.min_interval))
+        ]
+        ready.sort(key=lambda row: row["next_due_at"])
+        ready = ready[:max(min(limit, int(available)), 0)]
+        self.tokens, self.updated_at = available - len(ready), now
+        for row in ready:
+            row["taken_at"] = now
+        return [dict(row, db_now=now) for row in ready]
+
+    def complete(self, updates):
+        for (url, next_due_at, changes, observed_hours, last_change_at, last_checked_at,
+             amount, status, _interval, failures) in updates:
+            self.rows[url].update(
+                next_due_at=next_due_at, changes=changes, observed_hours=observed_hours,
+                last_change_at=last_change_at, last_checked_at=last_checked_at,
+                last_amount=amount, last_status=status, failures=failures,
+            )
+
+
+def make_urls(count):
+    return [f"https://www.amazon.es/dp/B{i:09d}" for i in range(count)]
+
+
+def subscribers(count):
+    return [{"id": i} for i in range(count)]
+
+
+def change_times(rng, rate_per_hour, duration):
+    times, now = [], 0.0
+    while True:
+        now += rng.expovariate(rate_per_hour / HOUR)
+        if now >= duration:
+            return times
+        times.append(now)
+
+
+def simulate(pick, urls, changes, duration, warmup=0.0, step=60.0):
+    """
+    Devuelve el retraso medio (s) entre un cambio de precio y su detección, sin
+    contar los cambios anteriores a `warmup` (mientras la planificación aprende la
+    volatilidad; en producción parte de los cambios de los últimos 30 días en scrape_targets).
+    """
+    clock_steps = int(duration / step)
+    seen = {url: 0 for url in urls}
+    delays = []
+    for tick in range(clock_steps):
+        now = tick * step
+        for url in pick(now):
+            version = bisect.bisect_right(changes[url], now)
+            for change in changes[url][seen[url]:version]:
+                if change >= warmup:
+                    delays.append(now - change)
+            seen[url] = version
+    return sum(delays) / len(delays)
+
+
+class WorkerSchedulingTest(unittest.TestCase):
+
+    def test_detects_changes_sooner_than_round_robin(self):
+        rng = random.Random(3)
+        duration = 48 * HOUR
+        warmup = 12 * HOUR
+        budget = 20  # descargas por minuto
+        urls = make_urls(600)
+        # 5 % de productos muy volátiles (un cambio cada ~30 min); el resto casi estáticos
+        rates = {url: (2.0 if i % 20 == 0 else 1 / (24 * 30)) for i, url in enumerate(urls)}
+        changes = {url: change_times(rng, rate, duration) for url, rate in rates.items()}
+
+        position = [0]
+
+        def round_robin(now):
+            picked = [urls[(position[0] + i) % len(urls)] for i in range(budget)]
+            position[0] += budget
+            return picked
+
+        fixed = simulate(round_robin, urls, changes, duration, warmup)
+
+        targets = SimulatedTargets(urls, budget)
+        jitter = random.Random(1)
+
+        def worker(now):
+            claimed = targets.claim(now, limit=50)
+            targets.complete([
+                plan_next_check(target, subscribers(1), Info(bisect.bisect_right(changes[target["url"]], now), "available"),
+                                now, 60, 6 * HOUR, jitter)
+                for target in claimed
+            ])
+            return [target["url"] for target in claimed]
+
+        adaptive_delay = simulate(worker, urls, changes, duration, warmup)
+        self.assertLess(adaptive_delay, fixed * 0.5,
+                        f"Retraso medio de detección: bucle completo {fixed / 60:.1f} min, workers {adaptive_delay / 60:.1f} min")
+
+    def test_budget_and_order(self):
+        targets = SimulatedTargets(make_urls(100), budget_per_minute=10)
+        for i, row in enumerate(targets.rows.values()):
+            row["next_due_at"] = 100.0 - i
+        claimed = targets.claim(60.0, limit=50)
+        self.assertEqual(len(claimed), 10)
+        self.assertEqual([target["next_due_at"] for target in claimed], [float(i) for i in range(1, 11)])
+        self.assertEqual(targets.claim(60.0, limit=50), [])
+        self.assertEqual(len(targets.claim(120.0, limit=50)), 10)
+        self.assertEqual(len(targets.claim(180.0, limit=4)), 4)
+
+    def test_subscribers_and_bounds(self):
+        popular, lonely = make_urls(2)
+        targets = SimulatedTargets([popular, lonely], budget_per_minute=1000)
+        claimed = {target["url"]: target for target in targets.claim(60.0, limit=10)}
+        intervals = {
+            url: plan_next_check(claimed[url], subscribers(count), Info(1, "available"), 60.0,
+                                 60, 24 * HOUR, random.Random(1))[8]
+            for url, count in ((popular, 16), (lonely, 1))
+        }
+        self.assertLess(intervals[popular], intervals[lonely])
+        self.assertLessEqual(intervals[lonely], 24 * HOUR)
+
+    def test_errors_back_off(self):
+        url, = make_urls(1)
+        targets = SimulatedTargets([url], budget_per_minute=1000)
+        update = None
+        for now in (60.0, 120.0):
+            target, = targets.claim(now, limit=10)
+            update = plan_next_check(target, subscribers(1), Info(None, "error"), now, 60, 6 * HOUR, random.Random(1))
+            targets.complete([update])
+        self.assertEqual(update[8], 240)
+        self.assertEqual(update[9], 2)
+
+        target, = targets.claim(7 * HOUR, limit=10)
+        update = plan_next_check(target, subscribers(1), Info(1, "available"), 7 * HOUR, 60, 6 * HOUR, random.Random(1))
+        self.assertEqual(update[9], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from price_tracker import ProductInfo, ScrapeCache
+from test_support import SimulatedClock
+
+KEY = ScrapeCache.key_for("https://www.amazon.es/dp/B08HM5L35D")
+INFO = ProductInfo("Producto", Decimal("10.00"), "EUR", "available")
+
+
+class CountingLoader:
+    def __init__(self, result=INFO, delay=0.0):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.result
+
+
+class ScrapeCacheTest(unittest.TestCase):
+
+    def test_entries_expire_after_ttl(self):
+        clock = SimulatedClock()
+        cache = ScrapeCache(ttl=60, max_size=10, clock=clock)
+        loader = CountingLoader()
+        self.assertEqual(cache.get_or_load(KEY, loader), INFO)
+        clock.now += 59
+        self.assertEqual(cache.get_or_load(KEY, loader), INFO)
+        self.assertEqual(loader.calls, 1)
+
+        clock.now += 1
+        self.assertIsNone(cache.get(KEY))
+        cache.get_or_load(KEY, loader)
+        self.assertEqual(loader.calls, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+    def test_errors_are_not_cached(self):
+        cache = ScrapeCache(ttl=60, max_size=10)
+        loader = CountingLoader(ProductInfo("Error al obtener el producto", None, None, "error"))
+        cache.get_or_load(KEY, loader)
+        cache.get_or_load(KEY, loader)
+        self.assertEqual(loader.calls, 2)
+
+    def test_lru_eviction(self):
+        cache = ScrapeCache(ttl=60, max_size=2)
+        for asin in ("B000000001", "B000000002", "B000000003"):
+            cache.put(("es", asin), INFO)
+        self.assertIsNone(cache.get(("es", "B000000001")))
+        self.assertEqual(cache.get(("es", "B000000003")), INFO)
+
+        # Leer una entrada la convierte en la más reciente
+        cache.get(("es", "B000000002"))
+        cache.put(("es", "B000000004"), INFO)
+        self.assertIsNone(cache.get(("es", "B000000003")))
+        self.assertEqual(cache.get(("es", "B000000002")), INFO)
+
+    def test_concurrent_requests_share_one_download(self):
+        cache = ScrapeCache(ttl=60, max_size=10)
+        loader = CountingLoader(delay=0.05)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: cache.get_or_load(KEY, loader), range(8)))
+        self.assertEqual(loader.calls, 1)
+        self.assertEqual(results, [INFO] * 8)
+
+    def test_owner_exception_reaches_waiters(self):
+        cache = ScrapeCache(ttl=60, max_size=10)
+        started, release = threading.Event(), threading.Event()
+
+        def failing_loader():
+            started.set()
+            release.wait(5)
+            raise RuntimeError("Captcha")
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            owner = executor.submit(cache.get_or_load, KEY, failing_loader)
+            self.assertTrue(started.wait(5))
+            waiters = [executor.submit(cache.get_or_load, KEY, failing_loader) for _ in range(3)]
+            deadline = time.monotonic() + 5
+            while cache.coalesced < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            for future in (owner, *waiters):
+                with self.assertRaisesRegex(RuntimeError, "Captcha"):
+                    future.result(5)
+        self.assertEqual((cache.misses, cache.coalesced), (1, 3))
+
+        # El fallo no queda en caché ni como descarga en curso: la siguiente petición descarga de nuevo
+        loader = CountingLoader()
+        self.assertEqual(cache.get_or_load(KEY, loader), INFO)
+        self.assertEqual(loader.calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
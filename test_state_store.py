@@ -0,0 +1,83 @@
+"""
+Pruebas del almacén de estado de las conversaciones del menú.
+
+Las del almacén en PostgreSQL necesitan un PostgreSQL local en DATABASE_URL; los
+datos se crean en un esquema propio (state_store_test) que se borra al terminar.
+
+Uso:
+    python -m unittest test_state_store -v
+"""
+import asyncio
+import os
+import unittest
+
+from state_store import MemoryStateStore
+from test_support import ScratchSchemaTestCase, SimulatedClock
+
+
+class MemoryStateStoreTest(unittest.TestCase):
+
+    def test_entries_expire(self):
+        clock = SimulatedClock()
+        store = MemoryStateStore(ttl=60, max_size=10, clock=clock)
+        store.set(1, {"state": "waiting_for_url"})
+        clock.now += 59
+        self.assertEqual(store.get(1), {"state": "waiting_for_url"})
+        clock.now += 1
+        self.assertIsNone(store.get(1))
+        self.assertEqual(len(store), 0)
+
+    def test_purge_removes_expired(self):
+        clock = SimulatedClock()
+        store = MemoryStateStore(ttl=60, max_size=10, clock=clock)
+        store.set(1, {"state": "waiting_for_url"})
+        clock.now += 30
+        store.set(2, {"state": "waiting_for_check"})
+        clock.now += 30
+        self.assertEqual(store.purge(), 1)
+        self.assertEqual(len(store), 1)
+
+    def test_lru_eviction(self):
+        store = MemoryStateStore(ttl=60, max_size=2)
+        store.set(1, {"state": "waiting_for_url"})
+        store.set(2, {"state": "waiting_for_remove"})
+        store.get(1)
+        store.set(3, {"state": "waiting_for_check"})
+        self.assertIsNone(store.get(2))
+        self.assertIsNotNone(store.get(1))
+
+    def test_pop_only_once(self):
+        store = MemoryStateStore(ttl=60, max_size=10)
+
+        async def scenario():
+            await store.aset(1, {"state": "waiting_for_history"})
+            return await store.apop(1), await store.apop(1)
+
+        self.assertEqual(asyncio.run(scenario()), ({"state": "waiting_for_history"}, None))
+
+
+@unittest.skipUnless(os.getenv("DATABASE_URL"), "Necesita un PostgreSQL local en DATABASE_URL")
+class PostgresStateStoreTest(ScratchSchemaTestCase):
+    SCHEMA = "state_store_test"
+
+    def test_state_survives_new_store(self):
+        from state_store import PostgresStateStore
+
+        PostgresStateStore(ttl=60).set(1, {"state": "waiting_for_url"})
+        # Otra instancia (otro proceso o una réplica) ve el mismo estado
+        store = PostgresStateStore(ttl=60)
+        self.assertEqual(store.get(1), {"state": "waiting_for_url"})
+        self.assertEqual(store.pop(1), {"state": "waiting_for_url"})
+        self.assertIsNone(store.pop(1))
+
+    def test_expired_states_are_ignored_and_purged(self):
+        from state_store import PostgresStateStore
+
+        store = PostgresStateStore(ttl=-1)
+        store.set(2, {"state": "waiting_for_check"})
+        self.assertIsNone(store.get(2))
+        self.assertEqual(store.purge(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+"""
+Utilidades compartidas por las pruebas: un reloj simulado y la base de las pruebas
+que trabajan en un esquema propio de PostgreSQL.
+"""
+import unittest
+
+
+class SimulatedClock:
+    """Reloj que solo avanza cuando la prueba cambia `now`."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ScratchSchemaTestCase(unittest.TestCase):
+    """
+    Crea las tablas en el esquema SCHEMA antes de las pruebas de la clase y lo borra
+    al terminar. Todas las conexiones del pool trabajan en ese esquema.
+
+    Las subclases definen SCHEMA y tienen la base de datos en cls.database.
+    """
+    SCHEMA = None
+
+    @classmethod
+    def setUpClass(cls):
+        import database
+
+        cls.database = database
+        database.close_pool()
+        database.DB_CONFIG["options"] = f"-c search_path={cls.SCHEMA}"
+        with database.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {cls.SCHEMA} CASCADE")
+                cursor.execute(f"CREATE SCHEMA {cls.SCHEMA}")
+        database.init_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.database.get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP SCHEMA IF EXISTS {cls.SCHEMA} CASCADE")
+        cls.database.close_pool()
+        cls.database.DB_CONFIG.pop("options", None)
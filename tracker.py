@@ -1,11 +1,12 @@
 from telegram.ext import Application, CommandHandler
 from commands import start, add_url, list_urls, check_price, remove_url, show_history, help_command, button_handler, menu_handler
+from commands import import_urls, export_history
 from dotenv import load_dotenv
 import os
 import asyncio
 from threading import Thread
 from database import init_db
-from price_checker import check_prices
+from metrics import start_metrics_server
 from telegram.ext import CallbackQueryHandler
 from commands import handle_user_input
 from telegram.ext import MessageHandler, filters
@@ -16,37 +17,50 @@ load_dotenv()
 # Leer el token del archivo .env
 TOKEN = os.getenv("TOKEN")
 PORT = int(os.environ.get("PORT", 8443))  # Puerto asignado por Render
+# Updates de Telegram procesados a la vez; el trabajo bloqueante va a los ejecutores de executors.py
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))
+
+# Las descargas las hacen los procesos de worker.py; con EMBEDDED_WORKER=1 el bot
+# ejecuta además un worker en un hilo (despliegues de un solo proceso)
+EMBEDDED_WORKER = os.environ.get("EMBEDDED_WORKER", "0").lower() in ("1", "true", "yes")
 
 if not TOKEN:
     raise ValueError("El token no está configurado en el archivo .env")
 
-def run_scheduler():
+def run_embedded_worker():
     """
-    Configura y ejecuta el scheduler para tareas periódicas en un hilo separado.
+    Ejecuta un worker de descargas (ver worker.py) en el event loop de este hilo.
     """
-    async def periodic_check(interval):
-        while True:
-            await asyncio.create_task(check_prices())
-            await asyncio.sleep(interval)
+    from worker import run_worker
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    loop.run_until_complete(periodic_check(60))  # Ejecutar cada 60 segundos
+    loop.run_until_complete(run_worker())
 
-def start_scheduler():
+def start_embedded_worker():
     """
-    Inicia el scheduler en un hilo separado.
+    Inicia el worker embebido en un hilo separado.
     """
-    thread = Thread(target=run_scheduler, daemon=True)
+    thread = Thread(target=run_embedded_worker, daemon=True)
     thread.start()
 
-# Configuración del bot
-def main():
-    # Inicializar la base de datos
-    init_db()
+def build_application(request=None, base_url=None):
+    """
+    Crea la aplicación del bot con todos sus handlers registrados.
 
-    # Crear la aplicación del bot
-    application = Application.builder().token(TOKEN).build()
+    Args:
+        request (telegram.request.BaseRequest, optional): Cliente HTTP de la Bot API. Por defecto el de la librería.
+        base_url (str, optional): URL base de la Bot API (p. ej. un servidor local). Por defecto la de Telegram.
+
+    Returns:
+        telegram.ext.Application: Aplicación lista para arrancar.
+    """
+    builder = Application.builder().token(TOKEN).concurrent_updates(CONCURRENT_UPDATES)
+    if request is not None:
+        builder = builder.request(request)
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     # Registrar comandos
     application.add_handler(CommandHandler("start", start))
@@ -56,12 +70,29 @@ def main():
     application.add_handler(CommandHandler("remove", remove_url))
     application.add_handler(CommandHandler("history", show_history))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("import", import_urls))
+    application.add_handler(CommandHandler("export", export_history))
+    # Un documento con /import en el pie no llega como comando
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), import_urls))
 
     application.add_handler(CallbackQueryHandler(menu_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_input))
+    return application
+
+# Configuración del bot
+def main():
+    # Inicializar la base de datos
+    init_db()
+
+    # Crear la aplicación del bot
+    application = build_application()
+
+    # El bot solo atiende Telegram salvo que se pida un worker embebido
+    if EMBEDDED_WORKER:
+        start_embedded_worker()
 
-    # Iniciar el scheduler en un hilo separado
-    start_scheduler()
+    # Métricas de Prometheus en un puerto local, junto al webhook
+    start_metrics_server()
 
     # Iniciar el bot con Webhook
     application.run_webhook(
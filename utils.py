@@ -1,10 +1,8 @@
 import re
+from decimal import Decimal
 
 import requests
 
-# Diccionario para almacenar el estado de cada usuario
-user_states = {}
-
 
 def is_valid_amazon_url(url: str) -> bool:
     """
@@ -43,10 +41,149 @@ def escape_markdown_v2(text: str) -> str:
     escape_chars = r"_*[]()~`>#+-=|{}.!" 
     return ''.join(f"\\{char}" if char in escape_chars else char for char in text)
 
+# Marketplace (amazon.es, amazon.co.uk...) y ASIN de una URL de producto
+AMAZON_PRODUCT_REGEX = re.compile(
+    r'^https?:\/\/(?:www\.)?(amazon\.[a-z]{2,3}(?:\.[a-z]{2,3})?)\/'
+    r'(?:.*\/)?(?:dp|gp\/product)\/([A-Z0-9]{10})'
+)
+
+
+def get_product_key(url: str):
+    """
+    Normaliza una URL de Amazon a su marketplace y ASIN.
+
+    Args:
+        url (str): URL del producto.
+
+    Returns:
+        tuple: (marketplace, ASIN), o None si la URL no es de un producto de Amazon.
+    """
+    match = AMAZON_PRODUCT_REGEX.match(url)
+    if not match:
+        return None
+    return match.group(1).lower(), match.group(2)
+
+
 def simplify_amazon_url(url: str) -> str:
-    ###if "/dp/" in url:
-    ###    return url.split("/dp/")[0] + "/dp/" + url.split("/dp/")[1].split("/")[0]
-    return url
+    """
+    Reduce una URL de producto de Amazon a su forma canónica https://www.<marketplace>/dp/<ASIN>.
+
+    Args:
+        url (str): URL del producto.
+
+    Returns:
+        str: URL canónica, o la URL original si no se reconoce el producto.
+    """
+    key = get_product_key(url)
+    if not key:
+        return url
+    marketplace, asin = key
+    return f"https://www.{marketplace}/dp/{asin}"
+
+
+
+# Símbolos de las monedas de los marketplaces de Amazon
+CURRENCY_SYMBOLS = {
+    "EUR": "€",
+    "USD": "$",
+    "GBP": "£",
+    "JPY": "¥",
+    "INR": "₹",
+}
+
+
+def parse_amount(whole: str, fraction: str = "") -> Decimal:
+    """
+    Convierte las partes entera y decimal de un precio de Amazon en un Decimal.
+
+    Args:
+        whole (str): Parte entera tal como aparece en la página (p. ej. "1.234," o "1,234.").
+        fraction (str): Parte decimal (p. ej. "56").
+
+    Returns:
+        Decimal: Importe, o None si no contiene dígitos.
+    """
+    whole_digits = re.sub(r"\D", "", whole or "")
+    fraction_digits = re.sub(r"\D", "", fraction or "")
+    if not whole_digits:
+        return None
+    return Decimal(f"{whole_digits}.{fraction_digits or '0'}")
 
 
+def currency_from_symbol(symbol: str, default: str = "EUR") -> str:
+    """Devuelve el código ISO de la moneda correspondiente a un símbolo de precio."""
+    symbol = (symbol or "").strip()
+    for code, currency_symbol in CURRENCY_SYMBOLS.items():
+        if symbol == currency_symbol or symbol.upper() == code:
+            return code
+    return default
 
+
+PRICE_NUMBER_REGEX = re.compile(r"\d[\d.,\s]*")
+
+
+def parse_price_text(text: str, default_currency: str = "EUR") -> tuple:
+    """
+    Interpreta un precio completo tal como lo muestra Amazon ("1.234,56 €", "$1,234.56", "¥1,234").
+
+    El último separador se toma como decimal solo si le siguen una o dos cifras; en
+    otro caso es un separador de miles.
+
+    Args:
+        text (str): Texto del precio.
+        default_currency (str): Moneda si el texto no incluye símbolo reconocible.
+
+    Returns:
+        tuple: (importe, moneda), o (None, None) si el texto no contiene un precio.
+    """
+    match = PRICE_NUMBER_REGEX.search(text or "")
+    if not match:
+        return None, None
+    number = re.sub(r"\s", "", match.group()).rstrip(".,")
+    separator = max(number.rfind("."), number.rfind(","))
+    if separator != -1 and len(number) - separator - 1 in (1, 2):
+        amount = parse_amount(number[:separator], number[separator + 1:])
+    else:
+        amount = parse_amount(number)
+
+    symbol = (text[:match.start()] + text[match.end():]).strip().upper()
+    currency = default_currency
+    for code, currency_symbol in CURRENCY_SYMBOLS.items():
+        if code in symbol or currency_symbol in symbol:
+            currency = code
+            break
+    return amount, currency
+
+
+def format_price(amount: Decimal, currency: str = "EUR") -> str:
+    """
+    Formatea un importe para mostrarlo al usuario, p. ej. "1234,56 €".
+
+    Args:
+        amount (Decimal): Importe.
+        currency (str): Código ISO de la moneda.
+
+    Returns:
+        str: Precio formateado.
+    """
+    symbol = CURRENCY_SYMBOLS.get(currency, currency or "")
+    return f"{amount:.2f}".replace(".", ",") + f" {symbol}".rstrip()
+
+
+def describe_price(amount: Decimal, currency: str, status: str) -> str:
+    """
+    Texto que se muestra al usuario para un precio almacenado, según su disponibilidad.
+
+    Args:
+        amount (Decimal): Importe, o None.
+        currency (str): Código ISO de la moneda.
+        status (str): "available", "unavailable" o "error".
+
+    Returns:
+        str: Precio formateado o mensaje de no disponibilidad.
+    """
+    if status == "available" and amount is not None:
+        return format_price(amount, currency)
+    if status == "unavailable":
+        return "Precio no disponible"
+    return "Error al obtener el precio"
@@ -0,0 +1,136 @@
+# worker.py
+"""
+Worker de descargas: reserva en PostgreSQL los productos que toca comprobar,
+los descarga, registra los precios y los replanifica.
+
+Se pueden arrancar tantos workers como se quiera, en uno o varios hosts, contra la
+misma base de datos: cada producto se reserva con un lease (SELECT ... FOR UPDATE
+SKIP LOCKED), así que no se descarga dos veces en la misma ronda, y si un worker se
+cae sus productos vuelven a la cola cuando el lease expira.
+
+Uso:
+    python worker.py              # bucle continuo
+    python worker.py --once       # procesa lo vencido y termina
+"""
+import argparse
+import asyncio
+import os
+import socket
+import time
+
+from database import (
+    claim_scrape_targets, complete_scrape_targets, get_target_subscribers, init_db, refresh_history_partitions,
+)
+from logger import config_logger
+from metrics import CYCLE_SECONDS, SCHEDULE_LAG, start_metrics_server
+from price_checker import check_prices, notifier
+from price_tracker import ProductInfo
+from scheduler import (
+    FETCH_BUDGET_PER_MINUTE, MAX_REFRESH_INTERVAL, MIN_REFRESH_INTERVAL, SCHEDULER_FILL_BUDGET,
+    plan_next_check,
+)
+
+logger = config_logger()
+
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+# Productos reservados por tanda y duración del lease (debe cubrir la descarga de la tanda entera)
+WORKER_BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", 50))
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", 300))
+# Espera cuando no hay nada que descargar
+WORKER_IDLE_SLEEP = float(os.getenv("WORKER_IDLE_SLEEP", 5))
+# Cada cuánto se comprueba que existen las particiones de price_history de los próximos meses
+PARTITIONS_CHECK_INTERVAL = float(os.getenv("PARTITIONS_CHECK_INTERVAL", 3600))
+# Puerto de /metrics del worker; desactivado por defecto porque varios workers comparten host
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 0))
+
+FAILED = ProductInfo("Error al obtener el producto", None, None, "error")
+
+
+async def process_targets(worker_id: str, targets: list):
+    """
+    Descarga una tanda de productos reservados y los libera con su nueva planificación.
+
+    Args:
+        worker_id (str): Identificador del worker que tiene los leases.
+        targets (list): Filas devueltas por claim_scrape_targets.
+    """
+    # Instante según el reloj de la base de datos, común a todos los hosts
+    started = time.monotonic()
+    db_now = targets[0]["db_now"]
+    for target in targets:
+        # Retraso respecto a la hora planificada: crece si los workers no dan abasto
+        SCHEDULE_LAG.observe(max(db_now - target["next_due_at"].timestamp(), 0.0))
+
+    subscribers = {}
+    products = await asyncio.to_thread(get_target_subscribers, [target["url"] for target in targets])
+    if products is None:
+        logger.error("No se pudieron cargar las suscripciones; los leases expirarán solos.")
+        return
+    for product in products:
+        subscribers.setdefault(product["target_url"], []).append(product)
+
+    results = {}
+    saved = await check_prices(products, on_result=lambda url, info: results.__setitem__(url, info))
+    if not saved:
+        # Sin replanificar: next_due_at no avanza y la tanda se vuelve a comprobar al expirar los leases
+        logger.error(f"Worker {worker_id}: no se guardaron los resultados de la tanda; los leases expirarán solos.")
+        return
+
+    updates, orphans = [], []
+    for target in targets:
+        if target["url"] not in subscribers:
+            orphans.append(target["url"])
+            continue
+        now = db_now + time.monotonic() - started
+        # Una descarga que no llegó a producir resultado cuenta como fallo
+        info = results.get(target["url"], FAILED)
+        updates.append(plan_next_check(target, subscribers[target["url"]], info, now, MIN_REFRESH_INTERVAL, MAX_REFRESH_INTERVAL))
+    await asyncio.to_thread(complete_scrape_targets, worker_id, updates, orphans)
+    CYCLE_SECONDS.observe(time.monotonic() - started, kind="worker_batch")
+
+
+async def run_worker(worker_id: str = WORKER_ID, once: bool = False):
+    """
+    Bucle del worker: reserva productos, los procesa y repite.
+
+    Args:
+        worker_id (str): Identificador del worker (por defecto host:pid).
+        once (bool): Terminar cuando no quede nada que reservar en lugar de esperar.
+    """
+    logger.info(f"Worker {worker_id} iniciado")
+    partitions_checked = time.monotonic()
+    while True:
+        if time.monotonic() - partitions_checked >= PARTITIONS_CHECK_INTERVAL:
+            await asyncio.to_thread(refresh_history_partitions)
+            partitions_checked = time.monotonic()
+        targets = await asyncio.to_thread(
+            claim_scrape_targets, worker_id, WORKER_BATCH_SIZE, LEASE_SECONDS, MIN_REFRESH_INTERVAL,
+            SCHEDULER_FILL_BUDGET, FETCH_BUDGET_PER_MINUTE / 60.0, max(FETCH_BUDGET_PER_MINUTE, 1.0),
+        )
+        if targets:
+            try:
+                await process_targets(worker_id, targets)
+            except Exception as e:
+                logger.error(f"Error al procesar la tanda del worker {worker_id}: {e}")
+            continue
+        if once:
+            logger.info(f"Worker {worker_id}: no quedan productos vencidos")
+            await notifier.join()
+            return
+        await asyncio.sleep(WORKER_IDLE_SLEEP)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker de descargas de precios")
+    parser.add_argument("--id", default=WORKER_ID, help="Identificador del worker (por defecto host:pid)")
+    parser.add_argument("--once", action="store_true", help="Procesar los productos vencidos y terminar")
+    parser.add_argument("--metrics-port", type=int, default=WORKER_METRICS_PORT, help="Puerto de /metrics (0 = desactivado)")
+    args = parser.parse_args()
+
+    init_db()
+    start_metrics_server(args.metrics_port)
+    asyncio.run(run_worker(args.id, once=args.once))
+
+
+if __name__ == "__main__":
+    main()